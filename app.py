@@ -1,4 +1,5 @@
 from flask import Flask, render_template, request, redirect, url_for, session, jsonify
+import click
 from werkzeug.security import generate_password_hash, check_password_hash
 import os
 import secrets
@@ -6,30 +7,73 @@ import random
 import string
 from datetime import datetime, timedelta
 import json
+import time
+import hashlib
 
 from utils.database import (
     init_db, create_user, get_user_by_username, get_user_by_id,
     create_bot, get_user_bots, get_bot_by_id, delete_bot,
-    update_bot_webhook, toggle_bot_ai, update_bot_gemini_key, update_bot_ton_wallet,
+    update_bot_webhook, toggle_bot_ai, update_bot_gemini_key, update_bot_ai_cache, update_bot_ton_wallet,
     get_bot_commands, add_command, update_command, delete_command,
     get_mining_settings, save_mining_settings,
     get_shop_items, add_shop_item, delete_shop_item,
     get_tasks, add_task, delete_task,
-    get_or_create_user_progress, update_user_progress,
-    log_analytics_event, get_bot_analytics
+    log_analytics_event, get_bot_analytics, get_bots_analytics, get_pool_stats, analytics_writer, config_cache,
+    get_bot_config_stamp,
+    rebuild_analytics_rollups
+)
+from utils.crypto import encrypt_token, decrypt_token, forget_secret, get_secret_cache_stats
+from utils.telegram_api import get_telegram_client, get_telegram_stats, validate_bot_token, verify_webapp_init_data
+from utils.ai import get_bot_ai_response, gemini_clients, ai_response_cache
+from utils.ai_pool import AIExecutor, CircuitOpenError, StreamedReply
+from utils.conversations import ConversationStore
+from utils.http_cache import static_file_version, static_cache_control, conditional_page
+from utils.commands import get_command_router
+from utils.lifecycle import register_service
+from utils.updates import UpdateDispatcher
+from utils.dedup import UpdateDeduplicator
+from utils.outbox import OutboundScheduler
+from utils.polling import UpdatePoller, TELEGRAM_UPDATE_MODE
+from utils.broadcast import (
+    BroadcastRunner, BROADCAST_ACTIONS, create_broadcast, get_broadcasts, set_broadcast_status, count_broadcast_recipients
+)
+from utils.mining import (
+    apply_taps, read_progress, purchase_item as buy_shop_item, progress_cache, leaderboard, progress_notifier,
+    progress_etag,
+    MAX_TAPS_PER_SECOND, MAX_TAPS_PER_BATCH
 )
-from utils.crypto import encrypt_token, decrypt_token
-from utils.telegram_api import TelegramBotAPI, validate_bot_token
-from utils.ai import get_ai_response
 
 app = Flask(__name__)
 app.secret_key = os.getenv('SESSION_SECRET', secrets.token_hex(32))
 
+PROGRESS_LONG_POLL_TIMEOUT = float(os.getenv('PROGRESS_LONG_POLL_TIMEOUT', 25))
+PROGRESS_LONG_POLL_RECHECK = float(os.getenv('PROGRESS_LONG_POLL_RECHECK', 5))
+PROGRESS_POLL_INTERVAL = int(os.getenv('PROGRESS_POLL_INTERVAL', 30))
+
+@app.url_defaults
+def add_static_version(endpoint, values):
+    # url_for('static', ...) gets ?v=<content hash>, so changed files get new URLs and can be cached for good.
+    if endpoint == 'static' and 'filename' in values and 'v' not in values:
+        version = static_file_version(app.static_folder, values['filename'])
+        if version:
+            values['v'] = version
+
 @app.after_request
 def add_header(response):
-    response.headers['Cache-Control'] = 'no-store, no-cache, must-revalidate, post-check=0, pre-check=0, max-age=0'
-    response.headers['Pragma'] = 'no-cache'
-    response.headers['Expires'] = '-1'
+    if request.endpoint == 'static':
+        response.headers['Cache-Control'] = static_cache_control(app.static_folder, request.view_args['filename'],
+                                                                 request.args.get('v'))
+        response.headers.pop('Expires', None)
+        return response
+    if 'Cache-Control' in response.headers:
+        # Set by the view, e.g. conditional_page for mini-app pages.
+        return response
+    if 'user_id' in session or response.is_json:
+        response.headers['Cache-Control'] = 'no-store, no-cache, must-revalidate, post-check=0, pre-check=0, max-age=0'
+        response.headers['Pragma'] = 'no-cache'
+        response.headers['Expires'] = '-1'
+    else:
+        response.headers['Cache-Control'] = 'no-cache'
     return response
 
 init_db()
@@ -121,14 +165,9 @@ def logout():
 def dashboard():
     user_id = session['user_id']
     bots = get_user_bots(user_id)
+    analytics = get_bots_analytics([bot['id'] for bot in bots])
     
-    bot_stats = []
-    for bot in bots:
-        analytics = get_bot_analytics(bot['id'])
-        bot_stats.append({
-            'bot': dict(bot),
-            'stats': analytics
-        })
+    bot_stats = [{'bot': dict(bot), 'stats': analytics[bot['id']]} for bot in bots]
     
     return render_template('dashboard.html', bot_stats=bot_stats)
 
@@ -185,6 +224,10 @@ def delete_bot_route(bot_id):
         return jsonify({'success': False, 'message': 'Unauthorized'}), 403
     
     delete_bot(bot_id)
+    ai_response_cache.invalidate(bot_id)
+    conversations.clear(bot_id)
+    forget_secret(bot['bot_token'])
+    forget_secret(bot['gemini_api_key'])
     return jsonify({'success': True, 'redirect': url_for('dashboard')})
 
 @app.route('/bot/<int:bot_id>/setup-webhook', methods=['POST'])
@@ -202,7 +245,7 @@ def setup_webhook(bot_id):
     else:
         webhook_url = f"{request.host_url.rstrip('/')}/webhook/{bot_id}"
     
-    api = TelegramBotAPI(bot_token)
+    api = get_telegram_client(bot_token)
     result = api.set_webhook(webhook_url)
     
     if result.get('ok'):
@@ -225,6 +268,18 @@ def toggle_ai_route(bot_id):
     if enabled and gemini_key:
         encrypted_key = encrypt_token(gemini_key)
         update_bot_gemini_key(bot_id, encrypted_key)
+        forget_secret(bot['gemini_api_key'])
+
+    if 'cache_enabled' in request.form:
+        try:
+            cache_ttl = int(request.form['cache_ttl']) if request.form.get('cache_ttl') else None
+            cache_size = int(request.form['cache_size']) if request.form.get('cache_size') else None
+        except ValueError:
+            return jsonify({'success': False, 'message': 'Cache TTL and size must be whole numbers'}), 400
+        if (cache_ttl is not None and cache_ttl < 0) or (cache_size is not None and cache_size < 0):
+            return jsonify({'success': False, 'message': 'Cache TTL and size cannot be negative'}), 400
+        update_bot_ai_cache(bot_id, request.form['cache_enabled'] == 'true', cache_ttl, cache_size)
+        ai_response_cache.invalidate(bot_id)
     
     toggle_bot_ai(bot_id, enabled)
     return jsonify({'success': True, 'message': f'AI {"enabled" if enabled else "disabled"}'})
@@ -409,15 +464,43 @@ def user_detail(bot_id, telegram_user_id):
         return redirect(url_for('dashboard'))
     
     from utils.database import get_user_analytics
-    user_progress = get_or_create_user_progress(bot_id, telegram_user_id)
+    user_progress = read_progress(bot_id, telegram_user_id, get_mining_settings(bot_id))
     user_analytics = get_user_analytics(bot_id, telegram_user_id)
     
     return render_template('user_detail.html',
                          bot=dict(bot),
                          telegram_user_id=telegram_user_id,
-                         user_progress=dict(user_progress),
+                         user_progress=user_progress,
                          analytics=user_analytics)
 
+WEBAPP_TEMPLATES = {
+    'ai': 'webapp_ai.html',
+    'payment': 'webapp_payment.html',
+    'quiz': 'webapp_quiz.html',
+    'news': 'webapp_news.html',
+    'referral': 'webapp_referral.html',
+    'fitness': 'webapp_fitness.html',
+    'event': 'webapp_event.html',
+}
+
+def _render_webapp(bot, template, telegram_user_id):
+    bot_id = bot['id']
+    if template == 'webapp_payment.html':
+        return render_template(template,
+                             bot=dict(bot),
+                             shop_items=get_shop_items(bot_id),
+                             telegram_user_id=telegram_user_id)
+    if template == 'webapp.html':
+        return render_template(template,
+                             bot=dict(bot),
+                             mining_settings=get_mining_settings(bot_id),
+                             shop_items=get_shop_items(bot_id),
+                             tasks=get_tasks(bot_id),
+                             telegram_user_id=telegram_user_id)
+    return render_template(template,
+                         bot=dict(bot),
+                         telegram_user_id=telegram_user_id)
+
 @app.route('/bot/<int:bot_id>/webapp', defaults={'webapp_type': 'mining'})
 @app.route('/bot/<int:bot_id>/webapp/', defaults={'webapp_type': 'mining'})
 @app.route('/bot/<int:bot_id>/webapp/<webapp_type>')
@@ -428,150 +511,211 @@ def webapp(bot_id, webapp_type):
         return "Bot not found", 404
     
     telegram_user_id = request.args.get('user_id', 12345)
+    template = WEBAPP_TEMPLATES.get(webapp_type, 'webapp.html')
     
-    if webapp_type == 'ai':
-        return render_template('webapp_ai.html', 
-                             bot=dict(bot),
-                             telegram_user_id=telegram_user_id)
-    elif webapp_type == 'payment':
-        shop_items = get_shop_items(bot_id)
-        return render_template('webapp_payment.html',
-                             bot=dict(bot),
-                             shop_items=shop_items,
-                             telegram_user_id=telegram_user_id)
-    elif webapp_type == 'quiz':
-        return render_template('webapp_quiz.html',
-                             bot=dict(bot),
-                             telegram_user_id=telegram_user_id)
-    elif webapp_type == 'news':
-        return render_template('webapp_news.html',
-                             bot=dict(bot),
-                             telegram_user_id=telegram_user_id)
-    elif webapp_type == 'referral':
-        return render_template('webapp_referral.html',
-                             bot=dict(bot),
-                             telegram_user_id=telegram_user_id)
-    elif webapp_type == 'fitness':
-        return render_template('webapp_fitness.html',
-                             bot=dict(bot),
-                             telegram_user_id=telegram_user_id)
-    elif webapp_type == 'event':
-        return render_template('webapp_event.html',
-                             bot=dict(bot),
-                             telegram_user_id=telegram_user_id)
-    else:
-        mining_settings = get_mining_settings(bot_id)
-        shop_items = get_shop_items(bot_id)
-        tasks = get_tasks(bot_id)
-        
-        return render_template('webapp.html', 
-                             bot=dict(bot),
-                             mining_settings=mining_settings,
-                             shop_items=shop_items,
-                             tasks=tasks,
-                             telegram_user_id=telegram_user_id)
+    # The page only changes with the bot's configuration or the template, so reopening it is usually a 304.
+    version, changed_at = get_bot_config_stamp(bot_id)
+    template_mtime = os.stat(os.path.join(app.root_path, app.template_folder, template)).st_mtime
+    etag = hashlib.sha1(repr((bot_id, template, telegram_user_id, version, template_mtime)).encode()).hexdigest()[:16]
+    last_modified = max(changed_at or 0, int(template_mtime))
+    return conditional_page(etag, last_modified, lambda: _render_webapp(bot, template, telegram_user_id))
 
 @app.route('/bot/<int:bot_id>/tap', methods=['POST'])
 def tap(bot_id):
-    data = request.get_json()
+    data = request.get_json(silent=True) or {}
     telegram_user_id = data.get('telegram_user_id')
     
     if not telegram_user_id:
         return jsonify({'success': False, 'message': 'User ID required'}), 400
     
-    progress = get_or_create_user_progress(bot_id, telegram_user_id)
+    try:
+        telegram_user_id = int(telegram_user_id)
+    except (ValueError, TypeError):
+        return jsonify({'success': False, 'message': 'Invalid user ID'}), 400
+    
     mining_settings = get_mining_settings(bot_id)
     
     if not mining_settings:
         return jsonify({'success': False, 'message': 'Mining not configured'}), 400
     
-    current_energy = progress['energy']
-    if current_energy <= 0:
+    progress, applied = apply_taps(bot_id, telegram_user_id, mining_settings)
+    if not applied:
         return jsonify({'success': False, 'message': 'No energy'}), 400
     
-    tap_reward = mining_settings['tap_reward']
-    new_balance = progress['coin_balance'] + tap_reward
-    new_energy = current_energy - 1
-    new_taps = progress['total_taps'] + 1
-    
-    update_user_progress(bot_id, telegram_user_id, new_balance, new_energy, new_taps)
-    log_analytics_event(bot_id, telegram_user_id, 'tap')
-    
     return jsonify({
         'success': True,
-        'coin_balance': new_balance,
-        'energy': new_energy,
-        'total_taps': new_taps
+        'coin_balance': progress['coin_balance'],
+        'energy': progress['energy'],
+        'total_taps': progress['total_taps']
     })
 
-@app.route('/bot/<int:bot_id>/get-progress', methods=['GET'])
-def get_progress(bot_id):
-    telegram_user_id = request.args.get('user_id')
+@app.route('/bot/<int:bot_id>/tap-batch', methods=['POST'])
+def tap_batch(bot_id):
+    data = request.get_json() or {}
+    telegram_user_id = data.get('telegram_user_id')
+    timestamps = data.get('timestamps') or []
     
     if not telegram_user_id:
         return jsonify({'success': False, 'message': 'User ID required'}), 400
     
-    progress = get_or_create_user_progress(bot_id, int(telegram_user_id))
+    try:
+        telegram_user_id = int(telegram_user_id)
+        count = int(data.get('count', len(timestamps)))
+        timestamps = [float(ts) for ts in timestamps]
+    except (ValueError, TypeError):
+        return jsonify({'success': False, 'message': 'Invalid tap batch'}), 400
+    
+    if count < 1 or count > MAX_TAPS_PER_BATCH:
+        return jsonify({'success': False, 'message': 'Invalid tap count'}), 400
+    
+    if timestamps:
+        # Client timestamps are milliseconds; they must match the count and a human tap rate
+        span_seconds = (max(timestamps) - min(timestamps)) / 1000
+        if len(timestamps) != count or count > (span_seconds + 1) * MAX_TAPS_PER_SECOND:
+            return jsonify({'success': False, 'message': 'Implausible tap rate'}), 400
+    
     mining_settings = get_mining_settings(bot_id)
     
-    if progress['last_tap_time']:
-        last_tap = datetime.fromisoformat(progress['last_tap_time'])
-        time_passed = (datetime.now() - last_tap).total_seconds()
-        energy_recovered = int(time_passed * mining_settings['energy_recharge_rate'] / 60)
-        new_energy = min(progress['energy'] + energy_recovered, mining_settings['max_energy'])
-        
-        if new_energy != progress['energy']:
-            update_user_progress(bot_id, int(telegram_user_id), progress['coin_balance'], new_energy, progress['total_taps'])
-            progress = get_or_create_user_progress(bot_id, int(telegram_user_id))
+    if not mining_settings:
+        return jsonify({'success': False, 'message': 'Mining not configured'}), 400
+    
+    progress, applied = apply_taps(bot_id, telegram_user_id, mining_settings, count, MAX_TAPS_PER_SECOND)
     
     return jsonify({
         'success': True,
+        'applied': applied,
+        'rejected': count - applied,
         'coin_balance': progress['coin_balance'],
         'energy': progress['energy'],
-        'total_taps': progress['total_taps'],
-        'level': progress['level']
+        'total_taps': progress['total_taps']
     })
 
+@app.route('/bot/<int:bot_id>/get-progress', methods=['GET'])
+def get_progress(bot_id):
+    telegram_user_id = request.args.get('user_id', type=int)
+    
+    if not telegram_user_id:
+        return jsonify({'success': False, 'message': 'User ID required'}), 400
+    
+    # Long-poll: with ?wait=N and a matching If-None-Match the request is held until the progress
+    # changes. Only PROGRESS_LONG_POLL_WAITERS requests wait at once; the rest get their 304 at
+    # once with Retry-After and poll again later. Changes made by other worker processes are not
+    # notified here, so the progress is re-read every few seconds while waiting.
+    wait = min(request.args.get('wait', 0, type=float), PROGRESS_LONG_POLL_TIMEOUT)
+    mining_settings = get_mining_settings(bot_id)
+    progress = read_progress(bot_id, telegram_user_id, mining_settings)
+    etag = progress_etag(progress)
+    retry_after = None
+    
+    if wait > 0 and request.if_none_match.contains(etag):
+        deadline = time.monotonic() + wait
+        with progress_notifier.listen((bot_id, telegram_user_id)) as changed:
+            if changed is None:
+                retry_after = PROGRESS_POLL_INTERVAL
+            while changed is not None:
+                # Read after registering, so a change that lands in between still wakes us.
+                progress = read_progress(bot_id, telegram_user_id, mining_settings)
+                etag = progress_etag(progress)
+                remaining = deadline - time.monotonic()
+                if not request.if_none_match.contains(etag) or remaining <= 0:
+                    break
+                changed.wait(min(remaining, PROGRESS_LONG_POLL_RECHECK))
+                changed.clear()
+    
+    if request.if_none_match.contains(etag):
+        response = app.response_class(status=304)
+    else:
+        response = jsonify({
+            'success': True,
+            'coin_balance': progress['coin_balance'],
+            'energy': progress['energy'],
+            'total_taps': progress['total_taps'],
+            'level': progress['level']
+        })
+    response.set_etag(etag)
+    if retry_after is not None:
+        response.headers['Retry-After'] = str(retry_after)
+    return response
+
+@app.route('/bot/<int:bot_id>/leaderboard', methods=['GET'])
+def get_leaderboard(bot_id):
+    telegram_user_id = request.args.get('user_id', type=int)
+    limit = max(1, min(request.args.get('limit', 10, type=int), 100))
+    
+    board = leaderboard.snapshot(bot_id, telegram_user_id, limit)
+    return jsonify({'success': True, **board})
+
+@app.route('/bot/<int:bot_id>/broadcasts', methods=['GET', 'POST'])
+@login_required
+def bot_broadcasts(bot_id):
+    bot = get_bot_by_id(bot_id)
+    if not bot or bot['user_id'] != session['user_id']:
+        return jsonify({'success': False, 'message': 'Unauthorized'}), 403
+    
+    if request.method == 'POST':
+        message = request.form.get('message', '').strip()
+        if not message:
+            return jsonify({'success': False, 'message': 'Message is required'}), 400
+        broadcast_id, total_recipients = create_broadcast(bot_id, message)
+        broadcast_runner.wake()
+        return jsonify({'success': True, 'message': f'Broadcast started for {total_recipients} users',
+                        'broadcast_id': broadcast_id, 'total_recipients': total_recipients})
+    
+    return jsonify({'success': True, 'broadcasts': [dict(row) for row in get_broadcasts(bot_id)],
+                    'recipients': count_broadcast_recipients(bot_id)})
+
+@app.route('/bot/<int:bot_id>/broadcasts/<int:broadcast_id>/<action>', methods=['POST'])
+@login_required
+def bot_broadcast_action(bot_id, broadcast_id, action):
+    bot = get_bot_by_id(bot_id)
+    if not bot or bot['user_id'] != session['user_id']:
+        return jsonify({'success': False, 'message': 'Unauthorized'}), 403
+    if action not in BROADCAST_ACTIONS:
+        return jsonify({'success': False, 'message': 'Unknown action'}), 404
+    
+    if not set_broadcast_status(bot_id, broadcast_id, action):
+        return jsonify({'success': False, 'message': f'Cannot {action} this broadcast'}), 409
+    broadcast_runner.wake()
+    return jsonify({'success': True, 'message': f'Broadcast {action} requested'})
+
 @app.route('/bot/<int:bot_id>/purchase-item', methods=['POST'])
 def purchase_item(bot_id):
-    data = request.get_json()
+    data = request.get_json(silent=True) or {}
     telegram_user_id = data.get('telegram_user_id')
     item_id = data.get('item_id')
+    purchase_id = data.get('purchase_id')
     
     if not telegram_user_id or not item_id:
         return jsonify({'success': False, 'message': 'Missing parameters'}), 400
     
-    shop_items = get_shop_items(bot_id)
-    item = next((i for i in shop_items if i['id'] == item_id), None)
+    try:
+        telegram_user_id = int(telegram_user_id)
+        item_id = int(item_id)
+    except (ValueError, TypeError):
+        return jsonify({'success': False, 'message': 'Invalid parameters'}), 400
     
-    if not item:
-        return jsonify({'success': False, 'message': 'Item not found'}), 404
+    result = buy_shop_item(bot_id, telegram_user_id, item_id, get_mining_settings(bot_id),
+                           str(purchase_id) if purchase_id else None)
     
-    if item['currency'] != 'coins':
+    if result['status'] == 'not_found':
+        return jsonify({'success': False, 'message': 'Item not found'}), 404
+    if result['status'] == 'wrong_currency':
         return jsonify({'success': False, 'message': 'This item requires TON payment'}), 400
-    
-    progress = get_or_create_user_progress(bot_id, int(telegram_user_id))
-    
-    if progress['coin_balance'] < item['price']:
+    if result['status'] == 'insufficient':
         return jsonify({'success': False, 'message': 'Insufficient coins'}), 400
     
-    new_balance = progress['coin_balance'] - int(item['price'])
-    update_user_progress(bot_id, int(telegram_user_id), new_balance, progress['energy'], progress['total_taps'])
-    log_analytics_event(bot_id, telegram_user_id, 'shop_purchase', {'item_id': item_id, 'price': item['price']})
-    
     return jsonify({
         'success': True,
-        'coin_balance': new_balance,
+        'coin_balance': result['coin_balance'],
+        'duplicate': result['status'] == 'duplicate',
         'message': 'Purchase successful!'
     })
 
-@app.route('/webhook/<int:bot_id>', methods=['POST'])
-def webhook_handler(bot_id):
+def process_update(bot_id, update, base_url):
+    """Reply to one Telegram update; runs on an update worker thread"""
     bot = get_bot_by_id(bot_id)
     if not bot:
-        return 'Bot not found', 404
-    
-    update = request.get_json()
+        return
     
     if 'message' in update:
         message = update['message']
@@ -579,8 +723,8 @@ def webhook_handler(bot_id):
         telegram_user_id = message['from']['id']
         text = message.get('text', '')
         
-        bot_token = decrypt_token(bot['bot_token'])
-        api = TelegramBotAPI(bot_token)
+        # Replies go through the outbox, which paces them to Telegram's limits.
+        api = outbox.client(bot_id)
         
         log_analytics_event(bot_id, telegram_user_id, 'message', {'text': text})
         
@@ -590,67 +734,137 @@ def webhook_handler(bot_id):
             log_analytics_event(bot_id, telegram_user_id, 'command', command)
             
             if command == 'webapp':
-                webapp_url = f"{request.host_url.rstrip('/')}/bot/{bot_id}/webapp?user_id={telegram_user_id}"
+                webapp_url = f"{base_url}/bot/{bot_id}/webapp?user_id={telegram_user_id}"
                 keyboard = api.create_web_app_keyboard('🎮 Open Mini-App', webapp_url)
                 api.send_message(chat_id, '🎮 Click the button below to open the mini-app:', keyboard)
-                return 'OK'
-            
-            if command == 'start':
-                # Check if there's a custom start command
-                commands = get_bot_commands(bot_id)
-                start_cmd = next((cmd for cmd in commands if cmd['command'] == 'start'), None)
-                
-                if start_cmd:
-                    if start_cmd['response_type'] == 'url_button':
-                        # Replace BOT_ID placeholder with actual bot_id
-                        url_link = start_cmd['url_link'].replace('BOT_ID', str(bot_id))
-                        webapp_url = f"{request.host_url.rstrip('/')}{url_link}?user_id={telegram_user_id}"
-                        keyboard = api.create_web_app_keyboard(start_cmd['button_text'], webapp_url)
-                        api.send_message(chat_id, start_cmd['response_content'], keyboard)
-                    elif start_cmd['response_type'] == 'text':
-                        api.send_message(chat_id, start_cmd['response_content'])
-                    elif start_cmd['response_type'] == 'photo':
-                        api.send_photo(chat_id, start_cmd['response_content'])
-                    return 'OK'
+                return
             
-            commands = get_bot_commands(bot_id)
-            for cmd in commands:
-                if cmd['command'] == command:
-                    if cmd['response_type'] == 'text':
-                        api.send_message(chat_id, cmd['response_content'])
-                    elif cmd['response_type'] == 'photo':
-                        api.send_photo(chat_id, cmd['response_content'])
-                    elif cmd['response_type'] == 'url_button':
-                        # Replace BOT_ID placeholder
-                        url_link = cmd['url_link'].replace('BOT_ID', str(bot_id))
-                        
-                        # Check if it's an internal webapp URL (contains /bot/)
-                        if '/bot/' in url_link:
-                            # Internal webapp - add user_id parameter
-                            webapp_url = f"{request.host_url.rstrip('/')}{url_link}?user_id={telegram_user_id}"
-                            keyboard = api.create_web_app_keyboard(cmd['button_text'], webapp_url)
-                        else:
-                            # External URL - use web_app to load it seamlessly in Telegram
-                            keyboard = api.create_web_app_keyboard(cmd['button_text'], url_link)
-                        
-                        api.send_message(chat_id, cmd['response_content'], keyboard)
-                    return 'OK'
+            compiled = get_command_router(bot_id).get(command)
+            if compiled:
+                compiled.send(api, chat_id, base_url, telegram_user_id)
+                return
             
             if bot['ai_enabled']:
-                gemini_key = decrypt_token(bot['gemini_api_key']) if bot['gemini_api_key'] else None
-                ai_response = get_ai_response(text, gemini_key)
-                if ai_response:
-                    api.send_message(chat_id, ai_response)
-                    return 'OK'
+                reply_with_ai(bot, api, chat_id, telegram_user_id, text, fallback=f"Unknown command: /{command}")
+                return
             
             api.send_message(chat_id, f"Unknown command: /{command}")
         
         elif bot['ai_enabled']:
-            gemini_key = decrypt_token(bot['gemini_api_key']) if bot['gemini_api_key'] else None
-            ai_response = get_ai_response(text, gemini_key)
-            if ai_response:
-                api.send_message(chat_id, ai_response)
+            reply_with_ai(bot, api, chat_id, telegram_user_id, text)
+
+def _outbox_client(bot_id):
+    bot = get_bot_by_id(bot_id)
+    if not bot:
+        return None
+    return get_telegram_client(decrypt_token(bot['bot_token']))
+
+outbox = register_service(OutboundScheduler(_outbox_client))
+
+ai_executor = register_service(AIExecutor())
+
+conversations = ConversationStore()
+
+def reply_with_ai(bot, api, chat_id, telegram_user_id, text, fallback=None):
+    """Answer `text` on the AI pool, streaming the reply into the chat; sends `fallback` if no reply comes"""
+    api.send_chat_action(chat_id)
+    gemini_key = decrypt_token(bot['gemini_api_key']) if bot['gemini_api_key'] else None
+    # Streamed edits need the sent message's id, so they skip the outbox queue but book its rate limits.
+    stream = StreamedReply(_outbox_client(bot['id']), chat_id,
+                           reserve=lambda max_wait: outbox.reserve(bot['id'], chat_id, max_wait))
+
+    def generate(timeout):
+        history = conversations.history(bot['id'], telegram_user_id)
+        reply = get_bot_ai_response(bot, text, gemini_key, timeout, stream.update, history)
+        if reply:
+            conversations.add_turn(bot['id'], telegram_user_id, text, reply)
+        if reply and stream.started:
+            stream.finish(reply)
+        elif reply:
+            api.send_message(chat_id, reply, parse_mode=None)
+        return reply
+
+    def done(future):
+        if future.cancelled():
+            return
+        if future.exception() is not None:
+            print(f"AI Error: {future.exception()}")
+        elif future.result():
+            return
+        if fallback and not stream.started:
+            api.send_message(chat_id, fallback)
+
+    future = ai_executor.submit(bot['id'], generate)
+    if future is None:
+        print(f"AI pool full, no reply for bot {bot['id']}")
+        if fallback:
+            api.send_message(chat_id, fallback)
+        return
+    future.add_done_callback(done)
+
+broadcast_runner = register_service(BroadcastRunner())
+
+def _handle_queued_update(job):
+    process_update(*job)
+
+update_dispatcher = register_service(UpdateDispatcher(_handle_queued_update))
+
+update_dedup = UpdateDeduplicator()
+
+def enqueue_update(bot_id, update, base_url):
+    """Queue a Telegram update for process_update; returns False if the queue is full"""
+    message = update.get('message')
+    if not isinstance(message, dict) or 'chat' not in message or 'from' not in message:
+        # Nothing process_update acts on.
+        return True
+    if not update_dedup.accept(bot_id, update['update_id']):
+        # Redelivery of an update we already have; it was handled or is queued.
+        return True
+    # Updates for the same chat are handled in order.
+    if not update_dispatcher.submit((bot_id, message['chat']['id']), (bot_id, update, base_url)):
+        update_dedup.forget(bot_id, update['update_id'])
+        return False
+    return True
+
+def public_base_url():
+    """Base URL for links sent to users when there is no request to take it from"""
+    if os.getenv('PUBLIC_BASE_URL'):
+        return os.getenv('PUBLIC_BASE_URL').rstrip('/')
+    replit_domain = os.getenv('REPLIT_DOMAINS')
+    if replit_domain:
+        return f"https://{replit_domain.split(',')[0]}"
+    return 'http://localhost:5000'
+
+update_poller = register_service(UpdatePoller(_outbox_client,
+                                             lambda bot_id, update: enqueue_update(bot_id, update, public_base_url())))
+
+def start_services():
+    """Start the background senders and, in polling mode, the update poller.
+
+    Called by the process that serves requests (gunicorn.conf.py, or the
+    reloader child under `python app.py`), never at import, so CLI commands
+    and the reloader's watcher process send nothing.
+    """
+    # Messages left in the outbox by a previous run are sent without waiting for new traffic.
+    outbox.start()
+    broadcast_runner.start()
+    if TELEGRAM_UPDATE_MODE == 'polling':
+        update_poller.start()
+
+@app.route('/webhook/<int:bot_id>', methods=['POST'])
+def webhook_handler(bot_id):
+    bot = get_bot_by_id(bot_id)
+    if not bot:
+        return 'Bot not found', 404
+    
+    update = request.get_json(silent=True)
+    if not isinstance(update, dict) or not isinstance(update.get('update_id'), int):
+        return 'Invalid update', 400
     
+    # Acknowledge right away; the update is handled on a worker thread.
+    if not enqueue_update(bot_id, update, request.host_url.rstrip('/')):
+        # Telegram retries the update later when the queue has room again.
+        return 'Busy', 503
     return 'OK'
 
 @app.route('/templates')
@@ -665,6 +879,29 @@ def api_user_bots():
     bots = get_user_bots(user_id)
     return jsonify({'success': True, 'bots': [{'id': bot['id'], 'bot_name': bot['bot_name']} for bot in bots]})
 
+@app.route('/api/metrics')
+@login_required
+def api_metrics():
+    return jsonify({
+        'success': True,
+        'db_pool': get_pool_stats(),
+        'analytics_writer': analytics_writer.stats(),
+        'progress_cache': progress_cache.stats(),
+        'config_cache': config_cache.stats(),
+        'progress_listeners': progress_notifier.stats(),
+        'update_dispatcher': update_dispatcher.stats(),
+        'telegram': get_telegram_stats(),
+        'outbox': outbox.stats(),
+        'broadcasts': broadcast_runner.stats(),
+        'update_poller': update_poller.stats(),
+        'update_dedup': update_dedup.stats(),
+        'secret_cache': get_secret_cache_stats(),
+        'gemini_clients': gemini_clients.stats(),
+        'ai_response_cache': ai_response_cache.stats(),
+        'ai_pool': ai_executor.stats(),
+        'ai_conversations': conversations.stats()
+    })
+
 @app.route('/api/ai-chat', methods=['POST'])
 def api_ai_chat():
     data = request.get_json()
@@ -680,7 +917,32 @@ def api_ai_chat():
         return jsonify({'success': False, 'message': 'AI not enabled'}), 400
     
     gemini_key = decrypt_token(bot['gemini_api_key']) if bot['gemini_api_key'] else None
-    ai_response = get_ai_response(message, gemini_key)
+    # The body's user_id is not proof of anything, so the Telegram chat's memory is only
+    # shared when the Mini App's initData is signed with this bot's token; any other
+    # browser gets a conversation of its own, keyed by an id kept in its session.
+    verified_user_id = verify_webapp_init_data(data.get('init_data'), decrypt_token(bot['bot_token']))
+    if verified_user_id is not None:
+        memory_key = verified_user_id
+    else:
+        memory_key = ('web', session.setdefault('ai_chat_id', secrets.token_urlsafe(16)))
+
+    def generate(timeout):
+        history = conversations.history(bot['id'], memory_key)
+        reply = get_bot_ai_response(bot, message, gemini_key, timeout, history=history)
+        if reply:
+            conversations.add_turn(bot['id'], memory_key, message, reply)
+        return reply
+
+    future = ai_executor.submit(bot['id'], generate)
+    if future is None:
+        return jsonify({'success': False, 'message': 'AI is busy, please try again'}), 503
+    try:
+        ai_response = future.result(timeout=ai_executor.timeout + 1)
+    except CircuitOpenError:
+        return jsonify({'success': False, 'message': 'AI temporarily unavailable'}), 503
+    except Exception as e:
+        print(f"AI Error: {e}")
+        ai_response = None
     
     if ai_response:
         log_analytics_event(bot_id, telegram_user_id, 'ai_chat', {'message': message})
@@ -728,5 +990,28 @@ def import_template():
     
     return jsonify({'success': True, 'message': 'Template imported successfully'})
 
+@app.cli.command('rebuild-analytics')
+@click.option('--bot-id', type=int, default=None, help='Only rebuild rollups for this bot')
+def rebuild_analytics_command(bot_id):
+    """Backfill the analytics rollup tables from raw events"""
+    rebuild_analytics_rollups(bot_id)
+    click.echo('Analytics rollups rebuilt')
+
+@app.cli.command('poll-updates')
+def poll_updates_command():
+    """Fetch updates for all bots with getUpdates instead of webhooks"""
+    start_services()
+    update_poller.start()
+    click.echo('Polling for updates; press Ctrl+C to stop')
+    try:
+        while True:
+            time.sleep(60)
+            click.echo(f"Polling stats: {update_poller.stats()}")
+    except KeyboardInterrupt:
+        pass
+
 if __name__ == '__main__':
+    # The reloader runs this file twice: a watcher, then the child that serves requests.
+    if os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+        start_services()
     app.run(host='0.0.0.0', port=5000, debug=True)
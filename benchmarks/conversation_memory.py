@@ -0,0 +1,50 @@
+"""Memory used by AI conversation memory with 100k active conversations.
+
+Run from the project root: python benchmarks/conversation_memory.py
+Fills a ConversationStore with CONVERSATIONS conversations of EXCHANGES
+exchanges each (a short question and a few-hundred-character reply), then
+reports what tracemalloc sees. The unbounded row keeps every turn, to
+show what storing the full history would cost.
+"""
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utils.conversations import ConversationStore
+
+CONVERSATIONS = 100000
+EXCHANGES = 12
+QUESTION = 'How many coins do I need for the next level, and which task pays best?'
+REPLY = ('You need 2,500 more coins to reach level 4. The daily check-in task pays 500 coins, '
+         'inviting a friend pays 1,000, and joining the channel pays 250. Tapping regenerates '
+         'one energy point every few seconds, so spending energy before it caps out is the '
+         'fastest way to level up. ') * 2
+
+def fill(store):
+    for exchange in range(EXCHANGES):
+        for user_id in range(CONVERSATIONS):
+            # Unique strings, so the measurement is not flattered by sharing.
+            store.add_turn(1, user_id, f'{QUESTION} #{exchange}.{user_id}', f'{REPLY} #{exchange}.{user_id}')
+
+def measure(name, store):
+    tracemalloc.start()
+    started = time.perf_counter()
+    fill(store)
+    elapsed = time.perf_counter() - started
+    used = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    stats = store.stats()
+    print(f"{name:<12} {used / 2**20:>9.1f} {used / CONVERSATIONS:>11.0f} "
+          f"{stats['tokens'] / CONVERSATIONS:>12.0f} {CONVERSATIONS * EXCHANGES / elapsed:>10.0f}")
+
+def main():
+    print(f'{CONVERSATIONS} conversations x {EXCHANGES} exchanges')
+    print(f"{'store':<12} {'MiB':>9} {'bytes/conv':>11} {'tokens/conv':>12} {'turns/s':>10}")
+    measure('bounded', ConversationStore(max_conversations=CONVERSATIONS))
+    measure('unbounded', ConversationStore(max_tokens=10**9, max_turns=10**9, max_conversations=CONVERSATIONS))
+
+if __name__ == '__main__':
+    main()
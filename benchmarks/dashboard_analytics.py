@@ -0,0 +1,55 @@
+"""Compare per-bot get_bot_analytics calls with one get_bots_analytics call.
+
+Run from the project root: python benchmarks/dashboard_analytics.py
+Uses a throwaway database in a temporary directory.
+"""
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utils import database as db
+
+BOT_COUNTS = [1, 10, 50, 200]
+EVENTS_PER_BOT = 200
+ROUNDS = 20
+
+def seed(user_id, bot_count):
+    bot_ids = [db.create_bot(user_id, f'bot{i}', 'token', f'bot{i}', '') for i in range(bot_count)]
+    rows = []
+    for bot_id in bot_ids:
+        for i in range(EVENTS_PER_BOT):
+            event_type = 'command' if i % 5 == 0 else 'message'
+            rows.append((bot_id, i % 40, event_type, f'"cmd{i % 7}"' if event_type == 'command' else None))
+    db.write_analytics_events(rows)
+    return bot_ids
+
+def measure(fn):
+    statements = []
+    with db.db_connection() as conn:
+        conn.set_trace_callback(statements.append)
+        started = time.perf_counter()
+        for _ in range(ROUNDS):
+            fn()
+        elapsed = (time.perf_counter() - started) / ROUNDS
+        conn.set_trace_callback(None)
+    return len(statements) // ROUNDS, elapsed * 1000
+
+def main():
+    workdir = tempfile.mkdtemp()
+    db.DATABASE_FILE = os.path.join(workdir, 'bench.db')
+    db.init_db()
+
+    print(f"{'bots':>6} {'loop queries':>13} {'loop ms':>9} {'bulk queries':>13} {'bulk ms':>9}")
+    for bot_count in BOT_COUNTS:
+        user_id = db.create_user(f'user{bot_count}', f'user{bot_count}@bench.local', 'x')
+        bot_ids = seed(user_id, bot_count)
+
+        loop_queries, loop_ms = measure(lambda: [db.get_bot_analytics(bot_id) for bot_id in bot_ids])
+        bulk_queries, bulk_ms = measure(lambda: db.get_bots_analytics(bot_ids))
+        print(f"{bot_count:>6} {loop_queries:>13} {loop_ms:>9.2f} {bulk_queries:>13} {bulk_ms:>9.2f}")
+
+if __name__ == '__main__':
+    main()
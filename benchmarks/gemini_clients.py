@@ -0,0 +1,54 @@
+"""Per-call cost of getting a Gemini model ready, before and after the client registry.
+
+Run from the project root: python benchmarks/gemini_clients.py
+GenerativeServiceClient.generate_content is replaced by a local stub that
+returns a canned reply, so no request leaves the machine and the numbers
+show only the setup done around each call.
+"""
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import google.ai.generativelanguage as glm
+import google.generativeai as genai
+
+from utils import ai
+
+ROUNDS = 500
+API_KEYS = [f'bench-key-{i}' for i in range(4)]
+
+def stub_generate_content(self, request, **kwargs):
+    return glm.GenerateContentResponse(candidates=[
+        glm.Candidate(content=glm.Content(parts=[glm.Part(text='ok')]), finish_reason=1)
+    ])
+
+def old_get_ai_response(message, api_key):
+    # What get_ai_response did before: global configure and a new model per call.
+    genai.configure(api_key=api_key)
+    model = genai.GenerativeModel('gemini-pro')
+    return model.generate_content(message).text
+
+def measure(fn):
+    started = time.perf_counter()
+    for i in range(ROUNDS):
+        assert fn('hi', API_KEYS[i % len(API_KEYS)]) == 'ok'
+    return (time.perf_counter() - started) / ROUNDS * 1e6
+
+def main():
+    glm.GenerativeServiceClient.generate_content = stub_generate_content
+
+    results = [
+        ('configure + new model per call', measure(old_get_ai_response)),
+        ('client registry', measure(ai.get_ai_response)),
+    ]
+
+    baseline = results[0][1]
+    print(f"{'path':<32} {'us/call':>9} {'speedup':>8}")
+    for name, micros in results:
+        print(f"{name:<32} {micros:>9.1f} {baseline / micros:>7.1f}x")
+    print(ai.gemini_clients.stats())
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,51 @@
+"""Per-message cost of decrypting a bot token, before and after caching.
+
+Run from the project root: python benchmarks/secret_decryption.py
+Compares the old path (read the key file and build a Fernet on every
+call), a cached Fernet, and a hit in the decrypted-secret cache. Uses a
+throwaway key file in a temporary directory.
+"""
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from cryptography.fernet import Fernet
+
+from utils import crypto
+
+ROUNDS = 20000
+
+def uncached_decrypt(encrypted_token):
+    # What decrypt_token did before: key file read and Fernet construction per call.
+    f = Fernet(crypto.get_encryption_key())
+    return f.decrypt(encrypted_token.encode()).decode()
+
+def measure(fn, arg):
+    started = time.perf_counter()
+    for _ in range(ROUNDS):
+        fn(arg)
+    return (time.perf_counter() - started) / ROUNDS * 1e6
+
+def main():
+    crypto.ENCRYPTION_KEY_FILE = os.path.join(tempfile.mkdtemp(), 'key')
+    crypto.reload_keys()
+    encrypted = crypto.encrypt_token('123456789:AAExampleBotTokenForBenchmarking000')
+
+    fernet = crypto.get_fernet()
+    results = [
+        ('key file + new Fernet per call', measure(uncached_decrypt, encrypted)),
+        ('cached Fernet', measure(lambda token: fernet.decrypt(token.encode()).decode(), encrypted)),
+        ('decrypt_token (cache hit)', measure(crypto.decrypt_token, encrypted)),
+    ]
+
+    baseline = results[0][1]
+    print(f"{'path':<32} {'us/call':>9} {'speedup':>8}")
+    for name, micros in results:
+        print(f"{name:<32} {micros:>9.2f} {baseline / micros:>7.1f}x")
+    print(crypto.get_secret_cache_stats())
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,76 @@
+"""Measure how many updates per second UpdatePoller can ingest.
+
+Run from the project root: python benchmarks/update_ingestion.py
+Telegram is replaced by an in-memory stub that answers every getUpdates
+with a full batch immediately, so the numbers show the poller's own
+overhead (offset bookkeeping, thread hand-off and the dispatcher queue),
+not network latency. Uses a throwaway database in a temporary directory.
+"""
+import os
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utils import database as db
+from utils.polling import UpdatePoller
+from utils.updates import UpdateDispatcher
+
+BOT_COUNTS = [1, 10, 100]
+BATCH_SIZE = 100
+DURATION = 3.0
+
+class StubClient:
+    """Answers getUpdates with the next BATCH_SIZE updates after `offset`"""
+
+    def get_updates(self, offset=None, timeout=25, limit=100, allowed_updates=None):
+        start = offset or 1
+        return {'ok': True, 'result': [
+            {'update_id': update_id,
+             'message': {'chat': {'id': update_id % 50}, 'from': {'id': update_id % 50}, 'text': 'hi'}}
+            for update_id in range(start, start + limit)
+        ]}
+
+    def delete_webhook(self):
+        return {'ok': True}
+
+def run(bot_count):
+    handled = 0
+    lock = threading.Lock()
+
+    def handle(job):
+        nonlocal handled
+        with lock:
+            handled += 1
+
+    dispatcher = UpdateDispatcher(handle, workers=8, max_pending=50000)
+    client = StubClient()
+    poller = UpdatePoller(lambda bot_id: client,
+                          lambda bot_id, update: dispatcher.submit((bot_id, update['message']['chat']['id']),
+                                                                   (bot_id, update)),
+                          workers=16, batch_size=BATCH_SIZE, get_bots=lambda: list(range(1, bot_count + 1)))
+    poller.start()
+    time.sleep(DURATION)
+    poller.stop()
+    dispatcher.stop()
+    stats = poller.stats()
+    return stats['updates'] / DURATION, handled / DURATION, stats['polls'], stats['deferred']
+
+def main():
+    workdir = tempfile.mkdtemp()
+    db.DATABASE_FILE = os.path.join(workdir, 'bench.db')
+    db.init_db()
+    # Offsets reference bots, so create as many as the largest run needs.
+    user_id = db.create_user('bench', 'bench@bench.local', 'x')
+    for i in range(max(BOT_COUNTS)):
+        db.create_bot(user_id, f'bot{i}', 'token', f'bot{i}', '')
+
+    print(f"{'bots':>6} {'ingested/s':>12} {'handled/s':>11} {'polls':>7} {'deferred':>9}")
+    for bot_count in BOT_COUNTS:
+        ingested, handled, polls, deferred = run(bot_count)
+        print(f"{bot_count:>6} {ingested:>12.0f} {handled:>11.0f} {polls:>7} {deferred:>9}")
+
+if __name__ == '__main__':
+    main()
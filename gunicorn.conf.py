@@ -0,0 +1,6 @@
+# Read by gunicorn from the working directory (`gunicorn app:app ...`).
+
+def post_worker_init(worker):
+    # Background services start in each worker, never in the master or at import.
+    from app import start_services
+    start_services()
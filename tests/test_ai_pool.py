@@ -0,0 +1,61 @@
+"""Run from the project root: python -m unittest discover tests"""
+import os
+import sys
+import threading
+import time
+import unittest
+from concurrent.futures import Future
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utils.ai_pool import AIExecutor, CircuitOpenError
+
+def fail(timeout):
+    raise RuntimeError('upstream down')
+
+def ok(timeout):
+    return 'ok'
+
+class HalfOpenBreakerTest(unittest.TestCase):
+    """A half-open circuit must close again once a trial call gets through."""
+
+    def setUp(self):
+        self.executor = AIExecutor(workers=2, per_bot=1, max_pending=1, timeout=5,
+                                   breaker_failures=1, breaker_cooldown=0)
+        # One failure opens the circuit; with no cooldown it is half-open right away.
+        with self.assertRaises(RuntimeError):
+            self.executor.submit(1, fail).result(timeout=5)
+
+    def tearDown(self):
+        self.executor.stop()
+
+    def test_rejected_submit_keeps_the_trial_call(self):
+        release = threading.Event()
+        blocker = self.executor.submit(2, lambda timeout: release.wait(5))
+        try:
+            self.assertIsNone(self.executor.submit(1, ok))
+        finally:
+            release.set()
+        blocker.result(timeout=5)
+        self.assertEqual(self.executor.submit(1, ok).result(timeout=5), 'ok')
+
+    def test_trial_call_expired_in_queue_is_released(self):
+        breaker = self.executor._breakers[1]
+        self.assertTrue(breaker.allow(time.monotonic()))
+        # Run the trial call as if it had waited past its deadline in the queue.
+        expired = Future()
+        with self.executor._lock:
+            self.executor._pending += 1
+            self.executor._running[1] = 1
+        self.executor._run(1, (expired, ok, time.monotonic() - 10))
+        self.assertIsInstance(expired.exception(), TimeoutError)
+        self.assertEqual(self.executor.submit(1, ok).result(timeout=5), 'ok')
+
+    def test_still_open_refuses(self):
+        self.executor._breakers[1].cooldown = 60
+        self.executor._breakers[1].record_failure(time.monotonic())
+        with self.assertRaises(CircuitOpenError):
+            self.executor.submit(1, ok).result(timeout=5)
+
+if __name__ == '__main__':
+    unittest.main()
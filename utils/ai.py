@@ -1,24 +1,137 @@
-import google.generativeai as genai
 import os
+import threading
+import time
+from collections import OrderedDict
 
-def init_gemini(api_key=None):
-    if api_key:
-        genai.configure(api_key=api_key)
-    elif os.getenv('GEMINI_API_KEY'):
-        genai.configure(api_key=os.getenv('GEMINI_API_KEY'))
-    else:
+import google.ai.generativelanguage as glm
+
+from utils.ai_cache import AIResponseCache
+
+GEMINI_MODEL = os.getenv('GEMINI_MODEL', 'gemini-pro')
+GEMINI_CLIENT_CACHE_SIZE = int(os.getenv('GEMINI_CLIENT_CACHE_SIZE', 256))
+GEMINI_CLIENT_IDLE_TTL = float(os.getenv('GEMINI_CLIENT_IDLE_TTL', 1800))
+AI_TIMEOUT = float(os.getenv('AI_TIMEOUT', 30))
+
+class GeminiClientRegistry:
+    """One GenerativeServiceClient per API key, built once and reused.
+
+    Each client is configured with its own key, so bots with different keys
+    never touch the process-global `genai.configure` state and cannot
+    overwrite each other's key. Clients are kept in least-recently-used order; the oldest is dropped when more
+    than `max_size` are cached, and clients idle for `idle_ttl` seconds are
+    dropped on the next lookup.
+    """
+
+    def __init__(self, max_size=GEMINI_CLIENT_CACHE_SIZE, idle_ttl=GEMINI_CLIENT_IDLE_TTL):
+        self.max_size = max_size
+        self.idle_ttl = idle_ttl
+        self._clients = OrderedDict()
+        self._lock = threading.Lock()
+        self._stats = {'hits': 0, 'created': 0, 'evicted_idle': 0, 'evicted_lru': 0}
+
+    def get(self, api_key):
+        now = time.monotonic()
+        with self._lock:
+            self._evict_idle(now)
+            entry = self._clients.get(api_key)
+            if entry is not None:
+                entry[1] = now
+                self._clients.move_to_end(api_key)
+                self._stats['hits'] += 1
+                return entry[0]
+
+        # Built outside the lock; a concurrent miss for the same key just builds a spare.
+        client = glm.GenerativeServiceClient(client_options={'api_key': api_key})
+
+        with self._lock:
+            entry = self._clients.get(api_key)
+            if entry is not None:
+                entry[1] = now
+                self._clients.move_to_end(api_key)
+                return entry[0]
+            self._clients[api_key] = [client, now]
+            self._stats['created'] += 1
+            while len(self._clients) > self.max_size:
+                self._clients.popitem(last=False)
+                self._stats['evicted_lru'] += 1
+        return client
+
+    def _evict_idle(self, now):
+        # Entries are in last-used order, so idle ones are all at the front.
+        while self._clients:
+            key, entry = next(iter(self._clients.items()))
+            if now - entry[1] < self.idle_ttl:
+                break
+            del self._clients[key]
+            self._stats['evicted_idle'] += 1
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats['clients'] = len(self._clients)
+        stats['max_size'] = self.max_size
+        return stats
+
+gemini_clients = GeminiClientRegistry()
+
+def get_gemini_client(api_key=None):
+    """The cached client for `api_key`, falling back to GEMINI_API_KEY; None without a key"""
+    api_key = api_key or os.getenv('GEMINI_API_KEY')
+    if not api_key:
+        return None
+    return gemini_clients.get(api_key)
+
+def _reply_text(response):
+    # Blocked or empty candidates give '' rather than raising like `.text` does.
+    if not response.candidates:
+        return ''
+    return ''.join(part.text for part in response.candidates[0].content.parts)
+
+def generate_reply(message, api_key=None, timeout=AI_TIMEOUT, on_text=None, history=None):
+    """Generate a reply, raising on upstream errors; None without a key or for an empty reply.
+
+    The call is abandoned after `timeout` seconds. With `on_text`, the reply
+    is streamed and `on_text(text_so_far)` is called as chunks arrive.
+    `history` holds earlier turns as returned by ConversationStore.history.
+    """
+    client = get_gemini_client(api_key)
+    if not client:
         return None
-    
-    return genai.GenerativeModel('gemini-pro')
+    turns = (history or []) + [{'role': 'user', 'parts': [message]}]
+    request = glm.GenerateContentRequest(
+        model=f'models/{GEMINI_MODEL}',
+        contents=[glm.Content(role=turn['role'], parts=[glm.Part(text=text) for text in turn['parts']])
+                  for turn in turns])
+    if on_text is None:
+        text = _reply_text(client.generate_content(request, timeout=timeout))
+    else:
+        text = ''
+        for chunk in client.stream_generate_content(request, timeout=timeout):
+            chunk_text = _reply_text(chunk)
+            if chunk_text:
+                text += chunk_text
+                on_text(text)
+    return text or None
 
 def get_ai_response(message, api_key=None):
     try:
-        model = init_gemini(api_key)
-        if not model:
-            return None
-        
-        response = model.generate_content(message)
-        return response.text
+        return generate_reply(message, api_key)
     except Exception as e:
         print(f"AI Error: {e}")
         return None
+
+ai_response_cache = AIResponseCache()
+
+def get_bot_ai_response(bot, message, api_key=None, timeout=AI_TIMEOUT, on_text=None, history=None):
+    """generate_reply for a bot, served from its response cache unless the bot turned caching off.
+
+    Cached and coalesced replies are returned without calling `on_text`.
+    Only messages without history are cached, since context changes the answer;
+    with conversation memory that means the first message of a conversation.
+    Keying on the history instead would fill the cache with one-off entries
+    that push out the shared ones.
+    """
+    return ai_response_cache.get_or_compute(bot['id'], GEMINI_MODEL, message,
+                                            lambda: generate_reply(message, api_key, timeout, on_text, history),
+                                            enabled=bool(bot['ai_cache_enabled']) and not history,
+                                            ttl=bot['ai_cache_ttl'], size=bot['ai_cache_size'])
@@ -0,0 +1,104 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+
+AI_CACHE_TTL = int(os.getenv('AI_CACHE_TTL', 3600))
+AI_CACHE_SIZE = int(os.getenv('AI_CACHE_SIZE', 500))
+
+def normalize_prompt(prompt):
+    """Case- and whitespace-insensitive form of a prompt, used as the cache key"""
+    return ' '.join(prompt.split()).casefold()
+
+class _Flight:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+class AIResponseCache:
+    """Caches AI replies per (bot, model, normalized prompt).
+
+    Every bot has its own LRU partition, so one busy bot cannot evict
+    another's answers; the TTL and size come from the bot's settings, with
+    AI_CACHE_TTL and AI_CACHE_SIZE as defaults. A miss for a prompt that is
+    already being generated waits for that call instead of starting a second
+    one. Empty replies (None) are never cached, so a failed call is retried
+    by the next message. Bots with caching turned off always go upstream.
+    """
+
+    def __init__(self, default_ttl=AI_CACHE_TTL, default_size=AI_CACHE_SIZE):
+        self.default_ttl = default_ttl
+        self.default_size = default_size
+        self._bots = {}
+        self._inflight = {}
+        self._lock = threading.Lock()
+        self._stats = {'hits': 0, 'misses': 0, 'coalesced': 0, 'bypassed': 0, 'expired': 0, 'evicted': 0}
+
+    def get_or_compute(self, bot_id, model, prompt, compute, enabled=True, ttl=None, size=None):
+        """Cached reply for the prompt, or the result of `compute()` (cached if not None)"""
+        ttl = self.default_ttl if ttl is None else ttl
+        size = self.default_size if size is None else size
+        if not enabled or ttl <= 0 or size <= 0:
+            with self._lock:
+                self._stats['bypassed'] += 1
+            return compute()
+
+        key = (model, normalize_prompt(prompt))
+        now = time.monotonic()
+        with self._lock:
+            entries = self._bots.get(bot_id)
+            entry = entries.get(key) if entries else None
+            if entry is not None:
+                if entry[1] > now:
+                    entries.move_to_end(key)
+                    self._stats['hits'] += 1
+                    return entry[0]
+                del entries[key]
+                self._stats['expired'] += 1
+
+            flight = self._inflight.get((bot_id, key))
+            leader = flight is None
+            if leader:
+                flight = self._inflight[(bot_id, key)] = _Flight()
+                self._stats['misses'] += 1
+            else:
+                self._stats['coalesced'] += 1
+
+        if not leader:
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.result
+
+        try:
+            flight.result = compute()
+        except Exception as e:
+            flight.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._inflight[(bot_id, key)]
+                if flight.result is not None:
+                    entries = self._bots.setdefault(bot_id, OrderedDict())
+                    entries[key] = (flight.result, time.monotonic() + ttl)
+                    entries.move_to_end(key)
+                    while len(entries) > size:
+                        entries.popitem(last=False)
+                        self._stats['evicted'] += 1
+            flight.done.set()
+        return flight.result
+
+    def invalidate(self, bot_id):
+        """Drop every cached reply for a bot, e.g. after its AI settings change"""
+        with self._lock:
+            self._bots.pop(bot_id, None)
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats['bots'] = len(self._bots)
+            stats['entries'] = sum(len(entries) for entries in self._bots.values())
+        lookups = stats['hits'] + stats['misses'] + stats['coalesced']
+        stats['hit_ratio'] = (stats['hits'] + stats['coalesced']) / lookups if lookups else 0.0
+        return stats
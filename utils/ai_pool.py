@@ -0,0 +1,251 @@
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from utils.ai import AI_TIMEOUT
+
+AI_WORKERS = int(os.getenv('AI_WORKERS', 16))
+AI_PER_BOT_CONCURRENCY = int(os.getenv('AI_PER_BOT_CONCURRENCY', 4))
+AI_MAX_PENDING = int(os.getenv('AI_MAX_PENDING', 500))
+AI_BREAKER_FAILURES = int(os.getenv('AI_BREAKER_FAILURES', 5))
+AI_BREAKER_COOLDOWN = float(os.getenv('AI_BREAKER_COOLDOWN', 30))
+AI_STREAM_EDIT_INTERVAL = float(os.getenv('AI_STREAM_EDIT_INTERVAL', 1.0))
+
+TELEGRAM_MESSAGE_LIMIT = 4096
+
+class CircuitOpenError(Exception):
+    """Raised for AI calls refused because the bot's upstream keeps failing"""
+
+class CircuitBreaker:
+    """Opens after `failures` failures in a row and refuses calls for `cooldown`
+    seconds; after that a single trial call decides whether it closes again."""
+
+    def __init__(self, failures, cooldown):
+        self.failures = failures
+        self.cooldown = cooldown
+        self._count = 0
+        self._open_until = 0.0
+        self._probing = False
+
+    def allow(self, now):
+        if self._count < self.failures:
+            return True
+        if now < self._open_until or self._probing:
+            return False
+        self._probing = True
+        return True
+
+    def release_probe(self):
+        """Let another trial call through, e.g. when the last one never ran"""
+        self._probing = False
+
+    def record_failure(self, now):
+        self._probing = False
+        self._count += 1
+        if self._count >= self.failures:
+            self._open_until = now + self.cooldown
+
+    def is_open(self, now):
+        return self._count >= self.failures and (now < self._open_until or self._probing)
+
+class AIExecutor:
+    """Bounded worker pool for AI generations, so slow replies never hold request threads.
+
+    `submit(bot_id, job)` returns a Future for `job(timeout)`, where
+    `timeout` is what is left of the `timeout` seconds allowed from submit
+    to finish; jobs still queued when that runs out fail with TimeoutError.
+    At most `per_bot` jobs of one bot run at once and the rest wait their
+    turn, so a busy bot cannot take the whole pool. Beyond `max_pending`
+    jobs in total `submit` returns None. After `breaker_failures` failed
+    jobs in a row a bot's circuit opens: for `breaker_cooldown` seconds its
+    jobs fail at once with CircuitOpenError instead of waiting on an
+    upstream that is down.
+    """
+
+    def __init__(self, workers=AI_WORKERS, per_bot=AI_PER_BOT_CONCURRENCY, max_pending=AI_MAX_PENDING,
+                 timeout=AI_TIMEOUT, breaker_failures=AI_BREAKER_FAILURES, breaker_cooldown=AI_BREAKER_COOLDOWN):
+        self.workers = workers
+        self.per_bot = per_bot
+        self.max_pending = max_pending
+        self.timeout = timeout
+        self.breaker_failures = breaker_failures
+        self.breaker_cooldown = breaker_cooldown
+        self._running = {}
+        self._waiting = {}
+        self._breakers = {}
+        self._pending = 0
+        self._lock = threading.Lock()
+        self._executor = None
+        self._pid = None
+        self._stats = {'submitted': 0, 'completed': 0, 'failed': 0, 'expired': 0, 'rejected': 0,
+                       'short_circuited': 0, 'total_wait_time': 0.0, 'max_wait_time': 0.0}
+
+    def _ensure_started(self):
+        # Created lazily so each forked worker process gets its own pool.
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            self._running, self._waiting, self._pending = {}, {}, 0
+            self._executor = None
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='ai-worker')
+
+    def submit(self, bot_id, job):
+        future = Future()
+        now = time.monotonic()
+        with self._lock:
+            # Capacity first: a rejected submit must not use up a half-open breaker's trial call.
+            if self._pending >= self.max_pending:
+                self._stats['rejected'] += 1
+                return None
+            breaker = self._breakers.get(bot_id)
+            if breaker is not None and not breaker.allow(now):
+                self._stats['short_circuited'] += 1
+                future.set_exception(CircuitOpenError(f'AI temporarily disabled for bot {bot_id} after repeated failures'))
+                return future
+            self._ensure_started()
+            self._pending += 1
+            self._stats['submitted'] += 1
+            entry = (future, job, now)
+            if self._running.get(bot_id, 0) < self.per_bot:
+                self._running[bot_id] = self._running.get(bot_id, 0) + 1
+                self._executor.submit(self._run, bot_id, entry)
+            else:
+                self._waiting.setdefault(bot_id, deque()).append(entry)
+        return future
+
+    def _run(self, bot_id, entry):
+        future, job, queued_at = entry
+        started = time.monotonic()
+        remaining = queued_at + self.timeout - started
+        result = error = None
+        if remaining <= 0:
+            error = TimeoutError(f'AI request waited {started - queued_at:.1f}s in the queue')
+        else:
+            try:
+                result = job(remaining)
+            except Exception as e:
+                error = e
+
+        now = time.monotonic()
+        with self._lock:
+            self._pending -= 1
+            if remaining <= 0:
+                self._stats['expired'] += 1
+                # The job never reached the upstream, so it says nothing about it; if it was the
+                # half-open trial call, the next job gets to be one.
+                breaker = self._breakers.get(bot_id)
+                if breaker is not None:
+                    breaker.release_probe()
+            elif error is not None:
+                self._stats['failed'] += 1
+                breaker = self._breakers.get(bot_id)
+                if breaker is None:
+                    breaker = self._breakers[bot_id] = CircuitBreaker(self.breaker_failures, self.breaker_cooldown)
+                breaker.record_failure(now)
+            else:
+                self._stats['completed'] += 1
+                self._breakers.pop(bot_id, None)
+            self._stats['total_wait_time'] += started - queued_at
+            self._stats['max_wait_time'] = max(self._stats['max_wait_time'], started - queued_at)
+
+            waiting = self._waiting.get(bot_id)
+            if waiting:
+                # The slot passes straight to the bot's next job.
+                self._executor.submit(self._run, bot_id, waiting.popleft())
+                if not waiting:
+                    del self._waiting[bot_id]
+            elif self._running[bot_id] > 1:
+                self._running[bot_id] -= 1
+            else:
+                del self._running[bot_id]
+
+        if error is not None:
+            future.set_exception(error)
+        else:
+            future.set_result(result)
+
+    def stop(self, timeout=5.0):
+        """Stop taking queued jobs; generations already running finish on their own"""
+        with self._lock:
+            executor = self._executor if self._pid == os.getpid() else None
+            self._executor = None
+            waiting, self._waiting = self._waiting, {}
+        if executor is not None:
+            executor.shutdown(wait=False, cancel_futures=True)
+        for entries in waiting.values():
+            for future, job, queued_at in entries:
+                future.cancel()
+
+    def stats(self):
+        now = time.monotonic()
+        with self._lock:
+            stats = dict(self._stats)
+            stats['running'] = sum(self._running.values())
+            stats['queued'] = sum(len(entries) for entries in self._waiting.values())
+            stats['open_circuits'] = sum(1 for breaker in self._breakers.values() if breaker.is_open(now))
+        started = stats['completed'] + stats['failed'] + stats['expired']
+        stats['avg_wait_time'] = stats['total_wait_time'] / started if started else 0.0
+        stats['workers'] = self.workers
+        stats['per_bot'] = self.per_bot
+        return stats
+
+class StreamedReply:
+    """Shows a reply in a Telegram chat while it is being generated.
+
+    The first `update` sends a message and later ones edit it, at most once
+    per `edit_interval` seconds; `finish` always shows the complete text.
+    Text past Telegram's 4096-character limit continues in a new message.
+    Sent as plain text, since a partial reply may cut HTML markup in half.
+    With `reserve`, every send first books the chat's rate limit:
+    `reserve(max_wait)` returns the seconds to wait, or None when that
+    would exceed `max_wait`. Intermediate edits that would have to wait are
+    skipped rather than holding up the generation.
+    """
+
+    def __init__(self, api, chat_id, edit_interval=AI_STREAM_EDIT_INTERVAL, reserve=None):
+        self.api = api
+        self.chat_id = chat_id
+        self.edit_interval = edit_interval
+        self.reserve = reserve
+        self.message_id = None
+        self.started = False
+        self._offset = 0
+        self._shown = ''
+        self._last_edit = 0.0
+
+    def update(self, text, final=False):
+        self.started = True
+        now = time.monotonic()
+        if not final and self.message_id is not None and now - self._last_edit < self.edit_interval:
+            return
+        while len(text) - self._offset > TELEGRAM_MESSAGE_LIMIT:
+            # A full part is final whatever the rest of the text does.
+            self._show(text[self._offset:self._offset + TELEGRAM_MESSAGE_LIMIT], True)
+            self.message_id = None
+            self._shown = ''
+            self._offset += TELEGRAM_MESSAGE_LIMIT
+        if self._show(text[self._offset:], final):
+            self._last_edit = now
+
+    def finish(self, text):
+        self.update(text, final=True)
+
+    def _show(self, part, final):
+        if not part or part == self._shown:
+            return True
+        if self.reserve is not None:
+            wait = self.reserve(None if final else 0)
+            if wait is None:
+                return False
+            time.sleep(wait)
+        if self.message_id is None:
+            result = self.api.send_message(self.chat_id, part, parse_mode=None)
+            if not result.get('ok'):
+                return True
+            self.message_id = result['result']['message_id']
+        else:
+            self.api.edit_message_text(self.chat_id, self.message_id, part)
+        self._shown = part
+        return True
@@ -0,0 +1,132 @@
+import os
+import threading
+import time
+from collections import deque
+
+ANALYTICS_BATCH_SIZE = int(os.getenv('ANALYTICS_BATCH_SIZE', 200))
+ANALYTICS_FLUSH_INTERVAL = float(os.getenv('ANALYTICS_FLUSH_INTERVAL', 1.0))
+ANALYTICS_MAX_BUFFER = int(os.getenv('ANALYTICS_MAX_BUFFER', 10000))
+ANALYTICS_OVERFLOW = os.getenv('ANALYTICS_OVERFLOW', 'drop_oldest')
+
+OVERFLOW_POLICIES = ('drop_oldest', 'drop_newest', 'block')
+
+class AnalyticsWriter:
+    """Write-behind buffer for analytics rows.
+
+    Rows are queued in memory and a background thread hands them to
+    `write_batch` in groups of up to `batch_size`, at least every
+    `flush_interval` seconds. The buffer holds at most `max_buffer` rows;
+    `overflow` decides whether a full buffer drops the oldest row, drops
+    the new row, or blocks the caller until the flusher catches up.
+    """
+
+    def __init__(self, write_batch, batch_size=ANALYTICS_BATCH_SIZE,
+                 flush_interval=ANALYTICS_FLUSH_INTERVAL, max_buffer=ANALYTICS_MAX_BUFFER,
+                 overflow=ANALYTICS_OVERFLOW):
+        if overflow not in OVERFLOW_POLICIES:
+            raise ValueError(f'Unknown overflow policy: {overflow}')
+        self.write_batch = write_batch
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_buffer = max_buffer
+        self.overflow = overflow
+        self._buffer = deque()
+        self._lock = threading.Lock()
+        self._not_empty = threading.Condition(self._lock)
+        self._not_full = threading.Condition(self._lock)
+        self._write_lock = threading.Lock()
+        self._thread = None
+        self._pid = None
+        self._stopping = False
+        self._stats = {'submitted': 0, 'written': 0, 'dropped': 0, 'failed': 0,
+                       'batches': 0, 'last_flush_time': 0.0, 'max_flush_time': 0.0}
+
+    def _ensure_started(self):
+        # Started lazily so each forked worker process gets its own flusher.
+        if self._thread is not None and self._pid == os.getpid() and self._thread.is_alive():
+            return
+        self._pid = os.getpid()
+        self._stopping = False
+        self._thread = threading.Thread(target=self._run, name='analytics-flusher', daemon=True)
+        self._thread.start()
+
+    def submit(self, row):
+        with self._lock:
+            self._ensure_started()
+            while len(self._buffer) >= self.max_buffer:
+                if self.overflow == 'drop_newest':
+                    self._stats['dropped'] += 1
+                    return False
+                if self.overflow == 'drop_oldest':
+                    self._buffer.popleft()
+                    self._stats['dropped'] += 1
+                    break
+                self._not_full.wait()
+            self._buffer.append(row)
+            self._stats['submitted'] += 1
+            if len(self._buffer) >= self.batch_size:
+                self._not_empty.notify()
+        return True
+
+    def _take_batch(self):
+        batch = []
+        while self._buffer and len(batch) < self.batch_size:
+            batch.append(self._buffer.popleft())
+        if batch:
+            self._not_full.notify_all()
+        return batch
+
+    def _write(self, batch):
+        started = time.perf_counter()
+        try:
+            with self._write_lock:
+                self.write_batch(batch)
+        except Exception as e:
+            print(f"Analytics flush error: {e}")
+            with self._lock:
+                self._stats['failed'] += len(batch)
+            return
+        elapsed = time.perf_counter() - started
+        with self._lock:
+            self._stats['written'] += len(batch)
+            self._stats['batches'] += 1
+            self._stats['last_flush_time'] = elapsed
+            self._stats['max_flush_time'] = max(self._stats['max_flush_time'], elapsed)
+
+    def _run(self):
+        while True:
+            with self._lock:
+                if not self._stopping and len(self._buffer) < self.batch_size:
+                    self._not_empty.wait(self.flush_interval)
+                batch = self._take_batch()
+                stopping = self._stopping
+            if batch:
+                self._write(batch)
+            elif stopping:
+                return
+
+    def flush(self):
+        """Write everything buffered so far from the calling thread"""
+        while True:
+            with self._lock:
+                batch = self._take_batch()
+            if not batch:
+                return
+            self._write(batch)
+
+    def stop(self, timeout=5.0):
+        with self._lock:
+            self._stopping = True
+            self._not_empty.notify_all()
+            thread = self._thread
+        if thread is not None and thread.is_alive() and self._pid == os.getpid():
+            thread.join(timeout)
+        self.flush()
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats['buffered'] = len(self._buffer)
+        stats['max_buffer'] = self.max_buffer
+        stats['overflow'] = self.overflow
+        return stats
@@ -0,0 +1,203 @@
+import os
+import socket
+import threading
+import time
+
+from utils.database import db_connection
+from utils.outbox import PRIORITY_BULK, insert_outbox_rows
+
+BROADCAST_WINDOW = int(os.getenv('BROADCAST_WINDOW', 500))
+BROADCAST_TICK_INTERVAL = float(os.getenv('BROADCAST_TICK_INTERVAL', 1.0))
+BROADCAST_LEASE_SECONDS = float(os.getenv('BROADCAST_LEASE_SECONDS', 30))
+
+RESULT_QUEUED, RESULT_SENT, RESULT_FAILED, RESULT_SKIPPED = 0, 1, 2, 3
+
+# action -> (statuses it applies to, new status)
+BROADCAST_ACTIONS = {
+    'pause': (('running',), 'paused'),
+    'resume': (('paused',), 'running'),
+    'cancel': (('running', 'paused'), 'cancelled'),
+}
+
+def _count_recipients(conn, bot_id):
+    # The runner walks user_progress, so that is what the estimate counts too.
+    return conn.execute('SELECT COUNT(*) FROM user_progress WHERE bot_id = ?', (bot_id,)).fetchone()[0]
+
+def count_broadcast_recipients(bot_id):
+    """How many users a broadcast started now would be sent to"""
+    with db_connection() as conn:
+        return _count_recipients(conn, bot_id)
+
+def create_broadcast(bot_id, message):
+    """Queue a broadcast to every player of the bot; returns (broadcast_id, total_recipients)"""
+    with db_connection() as conn:
+        total = _count_recipients(conn, bot_id)
+        broadcast_id = conn.execute('''INSERT INTO broadcasts (bot_id, message, total_recipients)
+                                       VALUES (?, ?, ?) RETURNING id''', (bot_id, message, total)).fetchone()[0]
+        conn.commit()
+    return broadcast_id, total
+
+def get_broadcasts(bot_id, limit=20):
+    with db_connection() as conn:
+        return conn.execute('''SELECT id, message, status, total_recipients, queued, sent, failed, skipped,
+                                      created_at, finished_at
+                               FROM broadcasts WHERE bot_id = ? ORDER BY id DESC LIMIT ?''',
+                            (bot_id, limit)).fetchall()
+
+def set_broadcast_status(bot_id, broadcast_id, action):
+    """Pause, resume or cancel a broadcast; returns False if the action does not apply"""
+    from_statuses, status = BROADCAST_ACTIONS[action]
+    with db_connection() as conn:
+        updated = conn.execute(f'''UPDATE broadcasts SET status = ?
+                                    WHERE id = ? AND bot_id = ? AND finished_at IS NULL
+                                      AND status IN ({','.join('?' * len(from_statuses))})''',
+                               (status, broadcast_id, bot_id, *from_statuses)).rowcount
+        if updated and status == 'cancelled':
+            # Messages the dispatcher has not picked up yet are dropped; they are counted as skipped.
+            conn.execute('''UPDATE telegram_outbox SET status = 'cancelled', finished_at = CURRENT_TIMESTAMP
+                            WHERE status = 'pending' AND id IN (SELECT outbox_id FROM broadcast_results
+                                                                WHERE broadcast_id = ? AND status = 0)''',
+                         (broadcast_id,))
+        conn.commit()
+    return bool(updated)
+
+class BroadcastRunner:
+    """Feeds active broadcasts into the outbox and tracks their results.
+
+    Recipients are read from `user_progress` with keyset pagination on
+    telegram_user_id, at most `window` unsent messages per broadcast at a
+    time, so memory use does not grow with the audience. Each page is
+    queued in the outbox together with its result rows and the new cursor
+    in one transaction, so after a crash a broadcast resumes exactly where
+    it stopped. A broadcast is worked on by one process at a time, which
+    holds a lease on it that it renews every tick.
+    """
+
+    def __init__(self, window=BROADCAST_WINDOW, tick_interval=BROADCAST_TICK_INTERVAL,
+                 lease_seconds=BROADCAST_LEASE_SECONDS):
+        self.window = window
+        self.tick_interval = tick_interval
+        self.lease_seconds = lease_seconds
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._thread = None
+        self._pid = None
+        self._stopping = False
+        self._stats = {'ticks': 0, 'queued': 0, 'completed': 0, 'errors': 0, 'active': 0}
+
+    @property
+    def _owner(self):
+        return f'{socket.gethostname()}:{os.getpid()}'
+
+    def start(self):
+        with self._lock:
+            if self._thread is not None and self._pid == os.getpid() and self._thread.is_alive():
+                return
+            self._pid = os.getpid()
+            self._stopping = False
+            self._thread = threading.Thread(target=self._run, name='broadcast-runner', daemon=True)
+            self._thread.start()
+
+    def wake(self):
+        self.start()
+        self._wakeup.set()
+
+    def _run(self):
+        while not self._stopping:
+            try:
+                self.tick()
+            except Exception as e:
+                print(f"Broadcast error: {e}")
+                with self._lock:
+                    self._stats['errors'] += 1
+            self._wakeup.wait(self.tick_interval)
+            self._wakeup.clear()
+
+    def tick(self, now=None):
+        now = time.time() if now is None else now
+        with db_connection() as conn:
+            broadcasts = conn.execute('''UPDATE broadcasts SET runner = ?, lease_until = ?
+                                         WHERE finished_at IS NULL
+                                           AND (runner = ? OR lease_until IS NULL OR lease_until < ?)
+                                         RETURNING id''',
+                                      (self._owner, now + self.lease_seconds, self._owner, now)).fetchall()
+            conn.commit()
+        for broadcast in broadcasts:
+            self._advance(broadcast['id'])
+        with self._lock:
+            self._stats['ticks'] += 1
+            self._stats['active'] = len(broadcasts)
+
+    def _advance(self, broadcast_id):
+        with db_connection() as conn:
+            # Hold the write lock throughout so a concurrent pause or cancel is seen before queuing more.
+            conn.execute('BEGIN IMMEDIATE')
+            broadcast = conn.execute('SELECT bot_id, message, status, cursor_user_id FROM broadcasts WHERE id = ?',
+                                     (broadcast_id,)).fetchone()
+            if broadcast is None:
+                conn.rollback()
+                return
+            counts = {RESULT_SENT: 0, RESULT_FAILED: 0, RESULT_SKIPPED: 0}
+            for row in conn.execute('''UPDATE broadcast_results
+                                       SET status = CASE o.status WHEN 'sent' THEN 1 WHEN 'failed' THEN 2 ELSE 3 END
+                                       FROM telegram_outbox AS o
+                                       WHERE broadcast_results.broadcast_id = ? AND broadcast_results.status = 0
+                                         AND o.id = broadcast_results.outbox_id
+                                         AND o.status NOT IN ('pending', 'sending')
+                                       RETURNING broadcast_results.status''', (broadcast_id,)).fetchall():
+                counts[row[0]] += 1
+            # Outbox rows purged before their result was recorded
+            counts[RESULT_SKIPPED] += conn.execute('''UPDATE broadcast_results SET status = 3
+                                                      WHERE broadcast_id = ? AND status = 0 AND NOT EXISTS
+                                                          (SELECT 1 FROM telegram_outbox WHERE id = outbox_id)''',
+                                                   (broadcast_id,)).rowcount
+            outstanding = conn.execute('SELECT COUNT(*) FROM broadcast_results WHERE broadcast_id = ? AND status = 0',
+                                       (broadcast_id,)).fetchone()[0]
+
+            recipients = []
+            if broadcast['status'] == 'running' and outstanding < self.window:
+                cursor = broadcast['cursor_user_id']
+                recipients = [row[0] for row in conn.execute(
+                    '''SELECT telegram_user_id FROM user_progress
+                       WHERE bot_id = ? AND telegram_user_id > ? ORDER BY telegram_user_id LIMIT ?''',
+                    (broadcast['bot_id'], -2 ** 63 if cursor is None else cursor, self.window - outstanding))]
+
+            if recipients:
+                params = [{'chat_id': user_id, 'text': broadcast['message'], 'parse_mode': 'HTML'}
+                          for user_id in recipients]
+                outbox_ids = insert_outbox_rows(conn, [(broadcast['bot_id'], user_id, 'sendMessage', message_params,
+                                                        PRIORITY_BULK)
+                                                       for user_id, message_params in zip(recipients, params)])
+                conn.executemany('''INSERT OR IGNORE INTO broadcast_results (broadcast_id, telegram_user_id, outbox_id)
+                                    VALUES (?, ?, ?)''',
+                                 [(broadcast_id, user_id, outbox_id) for user_id, outbox_id in zip(recipients, outbox_ids)])
+
+            finished = not recipients and outstanding == 0 and broadcast['status'] != 'paused'
+            conn.execute('''UPDATE broadcasts
+                            SET sent = sent + ?, failed = failed + ?, skipped = skipped + ?, queued = queued + ?,
+                                cursor_user_id = COALESCE(?, cursor_user_id),
+                                status = CASE WHEN ? AND status = 'running' THEN 'completed' ELSE status END,
+                                finished_at = CASE WHEN ? THEN CURRENT_TIMESTAMP ELSE finished_at END
+                            WHERE id = ?''',
+                         (counts[RESULT_SENT], counts[RESULT_FAILED], counts[RESULT_SKIPPED], len(recipients),
+                          recipients[-1] if recipients else None, finished, finished, broadcast_id))
+            conn.commit()
+
+        with self._lock:
+            self._stats['queued'] += len(recipients)
+            self._stats['completed'] += finished
+
+    def stop(self, timeout=5.0):
+        self._stopping = True
+        self._wakeup.set()
+        if self._thread is not None and self._pid == os.getpid():
+            self._thread.join(timeout)
+            # Let another process take over straight away.
+            with db_connection() as conn:
+                conn.execute('UPDATE broadcasts SET lease_until = NULL WHERE runner = ? AND finished_at IS NULL',
+                             (self._owner,))
+                conn.commit()
+
+    def stats(self):
+        with self._lock:
+            return dict(self._stats)
@@ -0,0 +1,74 @@
+import json
+
+from utils.database import config_cache, get_bot_commands
+
+class CompiledCommand:
+    """One bot command, prepared once when the router is built.
+
+    The `BOT_ID` placeholder is already substituted and the keyboard JSON is
+    pre-rendered; for buttons that open this app's own web pages only the
+    host and the user id are filled in per message.
+    """
+
+    __slots__ = ('response_type', 'response_content', 'keyboard', 'keyboard_head', 'webapp_path', 'keyboard_tail')
+
+    def __init__(self, bot_id, row, internal_link=None):
+        self.response_type = row['response_type']
+        self.response_content = row['response_content']
+        self.keyboard = None
+        self.keyboard_head = self.webapp_path = self.keyboard_tail = None
+
+        if self.response_type != 'url_button':
+            return
+        url_link = (row['url_link'] or '').replace('BOT_ID', str(bot_id))
+        if internal_link is None:
+            internal_link = '/bot/' in url_link
+        if not internal_link:
+            self.keyboard = _web_app_keyboard(row['button_text'], url_link)
+            return
+        # Split the rendered keyboard around the URL so a message only fills in the host and user id.
+        marker = '\0'
+        rendered = _web_app_keyboard(row['button_text'], marker)
+        self.keyboard_head, _, self.keyboard_tail = rendered.rpartition(json.dumps(marker)[1:-1])
+        self.webapp_path = url_link
+
+    def render_keyboard(self, base_url, telegram_user_id):
+        if self.webapp_path is None:
+            return self.keyboard
+        url = f"{base_url}{self.webapp_path}?user_id={telegram_user_id}"
+        return self.keyboard_head + json.dumps(url)[1:-1] + self.keyboard_tail
+
+    def send(self, api, chat_id, base_url, telegram_user_id):
+        if self.response_type == 'text':
+            api.send_message(chat_id, self.response_content)
+        elif self.response_type == 'photo':
+            api.send_photo(chat_id, self.response_content)
+        elif self.response_type == 'url_button':
+            api.send_message(chat_id, self.response_content, self.render_keyboard(base_url, telegram_user_id))
+
+def _web_app_keyboard(button_text, web_app_url):
+    # Same markup as TelegramBotAPI.create_web_app_keyboard
+    return json.dumps({
+        'inline_keyboard': [[{
+            'text': button_text,
+            'web_app': {'url': web_app_url}
+        }]]
+    })
+
+def compile_commands(bot_id, commands):
+    """Dispatch table of command name -> CompiledCommand"""
+    router = {}
+    for row in commands:
+        if row['command'] in router:
+            continue
+        # /start buttons always open a page of this app.
+        internal_link = True if row['command'] == 'start' else None
+        router[row['command']] = CompiledCommand(bot_id, row, internal_link)
+    return router
+
+def _load_command_router(bot_id):
+    return compile_commands(bot_id, get_bot_commands(bot_id))
+
+def get_command_router(bot_id):
+    """Compiled commands of a bot, rebuilt only when its command set changes"""
+    return config_cache.get(bot_id, 'command_router', _load_command_router)
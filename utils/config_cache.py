@@ -0,0 +1,88 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+
+CONFIG_CACHE_SIZE = int(os.getenv('CONFIG_CACHE_SIZE', 4096))
+CONFIG_VERSION_CHECK_INTERVAL = float(os.getenv('CONFIG_VERSION_CHECK_INTERVAL', 1.0))
+
+class VersionedCache:
+    """Read-through cache for per-bot configuration, validated by a version counter.
+
+    Every cached value is tagged with the bot's config version at load time.
+    `get_version(bot_id)` reads the shared counter (bumped by database
+    triggers whenever the bot's configuration changes), but at most once per
+    `check_interval` seconds per bot, so other worker processes pick up
+    changes within that window. Writers in this process call `invalidate`
+    for an immediate refresh.
+    """
+
+    def __init__(self, get_version, max_entries=CONFIG_CACHE_SIZE, check_interval=CONFIG_VERSION_CHECK_INTERVAL):
+        self.get_version = get_version
+        self.max_entries = max_entries
+        self.check_interval = check_interval
+        self._entries = OrderedDict()
+        self._versions = {}
+        self._lock = threading.Lock()
+        self._stats = {'hits': 0, 'misses': 0, 'stale': 0, 'version_checks': 0, 'invalidations': 0}
+
+    def _current_version(self, bot_id, now):
+        with self._lock:
+            known = self._versions.get(bot_id)
+        if known is not None and now - known[1] < self.check_interval:
+            return known[0]
+        version = self.get_version(bot_id)
+        with self._lock:
+            self._stats['version_checks'] += 1
+            self._versions[bot_id] = (version, now)
+        return version
+
+    def get(self, bot_id, kind, load):
+        if self.max_entries <= 0:
+            return load(bot_id)
+        try:
+            bot_id = int(bot_id)
+        except (TypeError, ValueError):
+            return load(bot_id)
+
+        key = (bot_id, kind)
+        version = self._current_version(bot_id, time.monotonic())
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] == version:
+                self._entries.move_to_end(key)
+                self._stats['hits'] += 1
+                return entry[1]
+            self._stats['stale' if entry is not None else 'misses'] += 1
+
+        value = load(bot_id)
+        with self._lock:
+            self._entries[key] = (version, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return value
+
+    def invalidate(self, bot_id):
+        try:
+            bot_id = int(bot_id)
+        except (TypeError, ValueError):
+            return
+        with self._lock:
+            self._stats['invalidations'] += 1
+            self._versions.pop(bot_id, None)
+            for key in [key for key in self._entries if key[0] == bot_id]:
+                del self._entries[key]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._versions.clear()
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats['entries'] = len(self._entries)
+        lookups = stats['hits'] + stats['misses'] + stats['stale']
+        stats['hit_ratio'] = stats['hits'] / lookups if lookups else 0.0
+        return stats
@@ -0,0 +1,123 @@
+import os
+import threading
+import time
+from collections import OrderedDict, deque
+
+AI_MEMORY_TOKENS = int(os.getenv('AI_MEMORY_TOKENS', 1000))
+AI_MEMORY_MAX_TURNS = int(os.getenv('AI_MEMORY_MAX_TURNS', 10))
+AI_MEMORY_IDLE_TTL = float(os.getenv('AI_MEMORY_IDLE_TTL', 1800))
+AI_MEMORY_MAX_CONVERSATIONS = int(os.getenv('AI_MEMORY_MAX_CONVERSATIONS', 100000))
+
+def estimate_tokens(text):
+    """Rough token count (about four characters per token), good enough for budgeting"""
+    return len(text) // 4 + 1
+
+class _Conversation:
+    __slots__ = ('turns', 'tokens', 'last_used')
+
+    def __init__(self, now):
+        # Alternating user message / reply, oldest first.
+        self.turns = deque()
+        self.tokens = 0
+        self.last_used = now
+
+class ConversationStore:
+    """Recent AI chat turns per (bot, user), kept in memory to give replies context.
+
+    Each conversation keeps at most `max_turns` exchanges and about
+    `max_tokens` tokens; the oldest exchanges are dropped first, and a
+    single message longer than half the budget is cut short, so one long
+    reply cannot push out everything else. Conversations idle for
+    `idle_ttl` seconds are forgotten, and beyond `max_conversations` the
+    least recently used one goes. Nothing is written to the database.
+    """
+
+    def __init__(self, max_tokens=AI_MEMORY_TOKENS, max_turns=AI_MEMORY_MAX_TURNS,
+                 idle_ttl=AI_MEMORY_IDLE_TTL, max_conversations=AI_MEMORY_MAX_CONVERSATIONS):
+        self.max_tokens = max_tokens
+        self.max_turns = max_turns
+        self.idle_ttl = idle_ttl
+        self.max_conversations = max_conversations
+        self._conversations = OrderedDict()
+        self._tokens = 0
+        self._lock = threading.Lock()
+        self._stats = {'turns_added': 0, 'turns_dropped': 0, 'truncated': 0, 'evicted_idle': 0, 'evicted_lru': 0}
+
+    def history(self, bot_id, user_id):
+        """Earlier turns as Gemini contents: [{'role': 'user' | 'model', 'parts': [text]}, ...]"""
+        now = time.monotonic()
+        with self._lock:
+            self._evict_idle(now)
+            conversation = self._conversations.get((bot_id, user_id))
+            if conversation is None:
+                return []
+            turns = list(conversation.turns)
+        return [{'role': 'user' if i % 2 == 0 else 'model', 'parts': [text]} for i, text in enumerate(turns)]
+
+    def _fit(self, text):
+        limit = self.max_tokens // 2
+        if estimate_tokens(text) <= limit:
+            return text
+        self._stats['truncated'] += 1
+        return text[:(limit - 1) * 4]
+
+    def add_turn(self, bot_id, user_id, message, reply):
+        """Remember one exchange: the user's message and the reply it got"""
+        if self.max_turns <= 0 or self.max_tokens <= 0:
+            return
+        key = (bot_id, user_id)
+        now = time.monotonic()
+        with self._lock:
+            self._evict_idle(now)
+            conversation = self._conversations.get(key)
+            if conversation is None:
+                conversation = self._conversations[key] = _Conversation(now)
+            self._conversations.move_to_end(key)
+            conversation.last_used = now
+
+            message, reply = self._fit(message), self._fit(reply)
+            conversation.turns.extend((message, reply))
+            added = estimate_tokens(message) + estimate_tokens(reply)
+            conversation.tokens += added
+            self._tokens += added
+            self._stats['turns_added'] += 1
+            while conversation.turns and (len(conversation.turns) > 2 * self.max_turns or
+                                          conversation.tokens > self.max_tokens):
+                for _ in range(2):
+                    dropped = estimate_tokens(conversation.turns.popleft())
+                    conversation.tokens -= dropped
+                    self._tokens -= dropped
+                self._stats['turns_dropped'] += 1
+
+            while len(self._conversations) > self.max_conversations:
+                self._tokens -= self._conversations.popitem(last=False)[1].tokens
+                self._stats['evicted_lru'] += 1
+
+    def clear(self, bot_id, user_id=None):
+        """Forget one user's conversation with a bot, or all of the bot's when `user_id` is None"""
+        with self._lock:
+            if user_id is not None:
+                keys = [(bot_id, user_id)] if (bot_id, user_id) in self._conversations else []
+            else:
+                keys = [key for key in self._conversations if key[0] == bot_id]
+            for key in keys:
+                self._tokens -= self._conversations.pop(key).tokens
+
+    def _evict_idle(self, now):
+        # Kept in last-used order, so idle conversations are all at the front.
+        while self._conversations:
+            key, conversation = next(iter(self._conversations.items()))
+            if now - conversation.last_used < self.idle_ttl:
+                break
+            del self._conversations[key]
+            self._tokens -= conversation.tokens
+            self._stats['evicted_idle'] += 1
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats['conversations'] = len(self._conversations)
+            stats['tokens'] = self._tokens
+        stats['max_tokens'] = self.max_tokens
+        stats['max_conversations'] = self.max_conversations
+        return stats
@@ -1,8 +1,20 @@
 import os
-from cryptography.fernet import Fernet
+import threading
+import time
+from collections import OrderedDict
+
+from cryptography.fernet import Fernet, MultiFernet
 
 ENCRYPTION_KEY_FILE = '.encryption_key'
 
+SECRET_CACHE_SIZE = int(os.getenv('SECRET_CACHE_SIZE', 2048))
+SECRET_CACHE_TTL = float(os.getenv('SECRET_CACHE_TTL', 300))
+
+_fernet = None
+_lock = threading.Lock()
+_secrets = OrderedDict()
+_stats = {'hits': 0, 'misses': 0, 'expired': 0}
+
 def get_encryption_key():
     if os.path.exists(ENCRYPTION_KEY_FILE):
         with open(ENCRYPTION_KEY_FILE, 'rb') as f:
@@ -13,16 +25,67 @@ def get_encryption_key():
             f.write(key)
         return key
 
+def get_fernet():
+    """Fernet for the key file, built once per process.
+
+    The key file may hold several keys, one per line: the first encrypts,
+    and all of them are tried when decrypting, so keys can be rotated by
+    adding a new first line. Call `reload_keys` after changing the file.
+    """
+    global _fernet
+    with _lock:
+        if _fernet is None:
+            keys = [line.strip() for line in get_encryption_key().splitlines() if line.strip()]
+            _fernet = MultiFernet([Fernet(key) for key in keys])
+        return _fernet
+
+def reload_keys():
+    """Re-read the key file and drop every cached secret"""
+    global _fernet
+    with _lock:
+        _fernet = None
+        _secrets.clear()
+
 def encrypt_token(token):
     if not token:
         return None
-    key = get_encryption_key()
-    f = Fernet(key)
-    return f.encrypt(token.encode()).decode()
+    return get_fernet().encrypt(token.encode()).decode()
 
 def decrypt_token(encrypted_token):
+    """Decrypt a stored secret, served from a small TTL cache keyed by the ciphertext"""
     if not encrypted_token:
         return None
-    key = get_encryption_key()
-    f = Fernet(key)
-    return f.decrypt(encrypted_token.encode()).decode()
+    now = time.monotonic()
+    with _lock:
+        entry = _secrets.get(encrypted_token)
+        if entry is not None:
+            if entry[1] > now:
+                _secrets.move_to_end(encrypted_token)
+                _stats['hits'] += 1
+                return entry[0]
+            del _secrets[encrypted_token]
+            _stats['expired'] += 1
+        _stats['misses'] += 1
+
+    token = get_fernet().decrypt(encrypted_token.encode()).decode()
+    if SECRET_CACHE_SIZE > 0:
+        with _lock:
+            _secrets[encrypted_token] = (token, now + SECRET_CACHE_TTL)
+            _secrets.move_to_end(encrypted_token)
+            while len(_secrets) > SECRET_CACHE_SIZE:
+                _secrets.popitem(last=False)
+    return token
+
+def forget_secret(encrypted_token):
+    """Drop one cached secret, e.g. when the stored value is replaced or deleted"""
+    if encrypted_token:
+        with _lock:
+            _secrets.pop(encrypted_token, None)
+
+def get_secret_cache_stats():
+    with _lock:
+        stats = dict(_stats)
+        stats['entries'] = len(_secrets)
+    lookups = stats['hits'] + stats['misses']
+    stats['hit_ratio'] = stats['hits'] / lookups if lookups else 0.0
+    return stats
@@ -1,16 +1,169 @@
 import sqlite3
 import os
+import queue
+import threading
+import time
+from contextlib import contextmanager
 from datetime import datetime
 import json
 
+from utils.analytics import AnalyticsWriter
+from utils.lifecycle import register_service
+from utils.config_cache import VersionedCache
+
 DATABASE_FILE = 'botforge.db'
 
+DB_POOL_SIZE = int(os.getenv('DB_POOL_SIZE', 8))
+DB_POOL_TIMEOUT = float(os.getenv('DB_POOL_TIMEOUT', 30))
+DB_BUSY_TIMEOUT_MS = int(os.getenv('DB_BUSY_TIMEOUT_MS', 5000))
+DB_CACHE_SIZE_KB = int(os.getenv('DB_CACHE_SIZE_KB', 16384))
+
+# 'buffered' queues analytics rows for the background writer; 'sync' inserts
+# each event immediately (handy for tests and one-off scripts).
+ANALYTICS_WRITE_MODE = os.getenv('ANALYTICS_WRITE_MODE', 'buffered')
+
 def get_db_connection():
-    conn = sqlite3.connect(DATABASE_FILE)
+    """Open a new, fully configured connection (caller must close it)"""
+    conn = sqlite3.connect(DATABASE_FILE, timeout=DB_BUSY_TIMEOUT_MS / 1000, check_same_thread=False)
     conn.row_factory = sqlite3.Row
     conn.execute('PRAGMA foreign_keys = ON')
+    conn.execute('PRAGMA journal_mode = WAL')
+    conn.execute('PRAGMA synchronous = NORMAL')
+    conn.execute(f'PRAGMA busy_timeout = {DB_BUSY_TIMEOUT_MS}')
+    conn.execute(f'PRAGMA cache_size = -{DB_CACHE_SIZE_KB}')
+    conn.execute('PRAGMA temp_store = MEMORY')
     return conn
 
+class ConnectionPool:
+    """Bounded pool of long-lived SQLite connections shared by worker threads.
+
+    A thread that already holds a connection gets the same one back when it
+    borrows again, so helpers can call each other without exhausting the pool.
+    """
+
+    def __init__(self, max_size=DB_POOL_SIZE, timeout=DB_POOL_TIMEOUT):
+        self.max_size = max_size
+        self.timeout = timeout
+        self._idle = queue.LifoQueue()
+        self._created = 0
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._stats = {'hits': 0, 'misses': 0, 'waits': 0, 'wait_time': 0.0, 'max_wait_time': 0.0}
+
+    def _acquire(self):
+        try:
+            conn = self._idle.get_nowait()
+            with self._lock:
+                self._stats['hits'] += 1
+            return conn
+        except queue.Empty:
+            pass
+
+        with self._lock:
+            can_create = self._created < self.max_size
+            if can_create:
+                self._created += 1
+                self._stats['misses'] += 1
+        if can_create:
+            try:
+                return get_db_connection()
+            except Exception:
+                with self._lock:
+                    self._created -= 1
+                raise
+
+        started = time.perf_counter()
+        try:
+            conn = self._idle.get(timeout=self.timeout)
+        except queue.Empty:
+            raise RuntimeError(f'Timed out after {self.timeout}s waiting for a database connection')
+        waited = time.perf_counter() - started
+        with self._lock:
+            self._stats['waits'] += 1
+            self._stats['wait_time'] += waited
+            self._stats['max_wait_time'] = max(self._stats['max_wait_time'], waited)
+        return conn
+
+    def _release(self, conn):
+        try:
+            if conn.in_transaction:
+                conn.rollback()
+        except sqlite3.Error:
+            conn.close()
+            with self._lock:
+                self._created -= 1
+            return
+        self._idle.put(conn)
+
+    @contextmanager
+    def connection(self):
+        held = getattr(self._local, 'conn', None)
+        if held is not None:
+            self._local.depth += 1
+            try:
+                yield held
+            finally:
+                self._local.depth -= 1
+            return
+
+        conn = self._acquire()
+        self._local.conn = conn
+        self._local.depth = 1
+        try:
+            yield conn
+        except Exception:
+            if conn.in_transaction:
+                conn.rollback()
+            raise
+        finally:
+            self._local.conn = None
+            self._local.depth = 0
+            self._release(conn)
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats['size'] = self._created
+        stats['idle'] = self._idle.qsize()
+        stats['max_size'] = self.max_size
+        borrows = stats['hits'] + stats['misses'] + stats['waits']
+        stats['hit_ratio'] = stats['hits'] / borrows if borrows else 0.0
+        stats['avg_wait_time'] = stats['wait_time'] / stats['waits'] if stats['waits'] else 0.0
+        return stats
+
+    def close_all(self):
+        while True:
+            try:
+                conn = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            conn.close()
+            with self._lock:
+                self._created -= 1
+
+_pool = ConnectionPool()
+
+def db_connection():
+    """Borrow a pooled connection: `with db_connection() as conn: ...`"""
+    return _pool.connection()
+
+def get_pool_stats():
+    return _pool.stats()
+
+def _get_config_version(bot_id):
+    with db_connection() as conn:
+        row = conn.execute('SELECT version FROM bot_config_versions WHERE bot_id = ?', (bot_id,)).fetchone()
+        return row['version'] if row else 0
+
+config_cache = VersionedCache(_get_config_version)
+
+def get_bot_config_stamp(bot_id):
+    """(version, changed_at) of a bot's configuration; changed_at is unix time or None if unknown"""
+    with db_connection() as conn:
+        row = conn.execute('SELECT version, changed_at FROM bot_config_versions WHERE bot_id = ?',
+                           (bot_id,)).fetchone()
+        return (row['version'], row['changed_at']) if row else (0, None)
+
 def init_db():
     conn = get_db_connection()
     cursor = conn.cursor()
@@ -38,11 +191,21 @@ def init_db():
             ai_enabled BOOLEAN DEFAULT 0,
             gemini_api_key TEXT,
             ton_wallet TEXT,
+            ai_cache_enabled BOOLEAN DEFAULT 1,
+            ai_cache_ttl INTEGER,
+            ai_cache_size INTEGER,
             created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
             FOREIGN KEY (user_id) REFERENCES users(id) ON DELETE CASCADE
         )
     ''')
 
+    # AI response cache settings; NULL ttl/size fall back to the defaults in utils/ai_cache.py
+    bot_columns = [row['name'] for row in cursor.execute('PRAGMA table_info(bots)')]
+    if 'ai_cache_enabled' not in bot_columns:
+        cursor.execute('ALTER TABLE bots ADD COLUMN ai_cache_enabled BOOLEAN DEFAULT 1')
+        cursor.execute('ALTER TABLE bots ADD COLUMN ai_cache_ttl INTEGER')
+        cursor.execute('ALTER TABLE bots ADD COLUMN ai_cache_size INTEGER')
+
     cursor.execute('''
         CREATE TABLE IF NOT EXISTS commands (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -112,6 +275,7 @@ def init_db():
             telegram_user_id INTEGER NOT NULL,
             coin_balance INTEGER DEFAULT 0,
             energy INTEGER DEFAULT 1000,
+            energy_updated_at REAL,
             last_tap_time TIMESTAMP,
             total_taps INTEGER DEFAULT 0,
             level INTEGER DEFAULT 1,
@@ -122,6 +286,17 @@ def init_db():
         )
     ''')
 
+    # `energy` is stored as of `energy_updated_at` (unix time); regeneration is derived on read
+    progress_columns = [row['name'] for row in cursor.execute('PRAGMA table_info(user_progress)')]
+    if 'energy_updated_at' not in progress_columns:
+        cursor.execute('ALTER TABLE user_progress ADD COLUMN energy_updated_at REAL')
+        cursor.execute('''UPDATE user_progress SET energy_updated_at = CAST(strftime('%s', last_tap_time) AS REAL)
+                          WHERE last_tap_time IS NOT NULL''')
+    # Per-user tap rate bucket: tokens left as of `tap_tokens_at` (unix time)
+    if 'tap_tokens' not in progress_columns:
+        cursor.execute('ALTER TABLE user_progress ADD COLUMN tap_tokens REAL')
+        cursor.execute('ALTER TABLE user_progress ADD COLUMN tap_tokens_at REAL')
+
     cursor.execute('''
         CREATE TABLE IF NOT EXISTS analytics (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -134,360 +309,696 @@ def init_db():
         )
     ''')
 
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS purchases (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            bot_id INTEGER NOT NULL,
+            telegram_user_id INTEGER NOT NULL,
+            item_id INTEGER NOT NULL,
+            price REAL NOT NULL,
+            purchase_id TEXT,
+            coin_balance_after INTEGER,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            UNIQUE(bot_id, telegram_user_id, purchase_id),
+            FOREIGN KEY (bot_id) REFERENCES bots(id) ON DELETE CASCADE
+        )
+    ''')
+
+    # Rollups maintained by write_analytics_events so dashboards never scan `analytics`
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS analytics_rollup_bot (
+            bot_id INTEGER PRIMARY KEY,
+            total_events INTEGER NOT NULL DEFAULT 0,
+            total_messages INTEGER NOT NULL DEFAULT 0,
+            unique_users INTEGER NOT NULL DEFAULT 0,
+            FOREIGN KEY (bot_id) REFERENCES bots(id) ON DELETE CASCADE
+        )
+    ''')
+
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS analytics_rollup_daily (
+            bot_id INTEGER NOT NULL,
+            day TEXT NOT NULL,
+            event_type TEXT NOT NULL,
+            count INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (bot_id, day, event_type),
+            FOREIGN KEY (bot_id) REFERENCES bots(id) ON DELETE CASCADE
+        ) WITHOUT ROWID
+    ''')
+
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS analytics_rollup_commands (
+            bot_id INTEGER NOT NULL,
+            event_data TEXT NOT NULL,
+            count INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (bot_id, event_data),
+            FOREIGN KEY (bot_id) REFERENCES bots(id) ON DELETE CASCADE
+        ) WITHOUT ROWID
+    ''')
+
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS analytics_rollup_users (
+            bot_id INTEGER NOT NULL,
+            telegram_user_id INTEGER NOT NULL,
+            first_seen TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (bot_id, telegram_user_id),
+            FOREIGN KEY (bot_id) REFERENCES bots(id) ON DELETE CASCADE
+        ) WITHOUT ROWID
+    ''')
+
+    # Durable queue of outbound Bot API calls; see utils/outbox.py
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS telegram_outbox (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            bot_id INTEGER NOT NULL,
+            chat_id INTEGER NOT NULL,
+            method TEXT NOT NULL,
+            params TEXT NOT NULL,
+            priority INTEGER NOT NULL DEFAULT 0,
+            status TEXT NOT NULL DEFAULT 'pending',
+            attempts INTEGER NOT NULL DEFAULT 0,
+            not_before REAL NOT NULL DEFAULT 0,
+            claimed_at REAL,
+            last_error TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            finished_at TIMESTAMP,
+            FOREIGN KEY (bot_id) REFERENCES bots(id) ON DELETE CASCADE
+        )
+    ''')
+
+    # Broadcasts to every player of a bot; see utils/broadcast.py
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS broadcasts (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            bot_id INTEGER NOT NULL,
+            message TEXT NOT NULL,
+            status TEXT NOT NULL DEFAULT 'running',
+            cursor_user_id INTEGER,
+            total_recipients INTEGER NOT NULL DEFAULT 0,
+            queued INTEGER NOT NULL DEFAULT 0,
+            sent INTEGER NOT NULL DEFAULT 0,
+            failed INTEGER NOT NULL DEFAULT 0,
+            skipped INTEGER NOT NULL DEFAULT 0,
+            runner TEXT,
+            lease_until REAL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            finished_at TIMESTAMP,
+            FOREIGN KEY (bot_id) REFERENCES bots(id) ON DELETE CASCADE
+        )
+    ''')
+
+    # status: 0 queued, 1 sent, 2 failed, 3 skipped
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS broadcast_results (
+            broadcast_id INTEGER NOT NULL,
+            telegram_user_id INTEGER NOT NULL,
+            outbox_id INTEGER NOT NULL,
+            status INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (broadcast_id, telegram_user_id),
+            FOREIGN KEY (broadcast_id) REFERENCES broadcasts(id) ON DELETE CASCADE
+        ) WITHOUT ROWID
+    ''')
+
+    # Next getUpdates offset per bot when updates are long-polled; see utils/polling.py
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS bot_update_offsets (
+            bot_id INTEGER PRIMARY KEY,
+            next_offset INTEGER NOT NULL,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (bot_id) REFERENCES bots(id) ON DELETE CASCADE
+        )
+    ''')
+
+    # Recently accepted Telegram updates, for dropping redeliveries; see utils/dedup.py
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS processed_updates (
+            bot_id INTEGER NOT NULL,
+            update_id INTEGER NOT NULL,
+            received_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (bot_id, update_id)
+        ) WITHOUT ROWID
+    ''')
+
+    # Bumped by triggers whenever a bot's configuration changes; see utils/config_cache.py
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS bot_config_versions (
+            bot_id INTEGER PRIMARY KEY,
+            version INTEGER NOT NULL DEFAULT 0,
+            changed_at INTEGER
+        )
+    ''')
+
+    # `changed_at` (unix time of the last change) backs Last-Modified on mini-app pages
+    version_columns = [row['name'] for row in cursor.execute('PRAGMA table_info(bot_config_versions)')]
+    rebuild_triggers = 'changed_at' not in version_columns
+    if rebuild_triggers:
+        cursor.execute('ALTER TABLE bot_config_versions ADD COLUMN changed_at INTEGER')
+
+    for table, bot_column in (('bots', 'id'), ('commands', 'bot_id'), ('mining_settings', 'bot_id'),
+                              ('shop_items', 'bot_id'), ('tasks', 'bot_id')):
+        for event, row in (('INSERT', 'NEW'), ('UPDATE', 'NEW'), ('DELETE', 'OLD')):
+            if rebuild_triggers:
+                cursor.execute(f'DROP TRIGGER IF EXISTS trg_{table}_{event.lower()}_config_version')
+            cursor.execute(f'''
+                CREATE TRIGGER IF NOT EXISTS trg_{table}_{event.lower()}_config_version
+                AFTER {event} ON {table}
+                BEGIN
+                    INSERT INTO bot_config_versions (bot_id, version, changed_at)
+                    VALUES ({row}.{bot_column}, 1, CAST(strftime('%s', 'now') AS INTEGER))
+                    ON CONFLICT(bot_id) DO UPDATE SET version = version + 1, changed_at = excluded.changed_at;
+                END
+            ''')
+
     cursor.execute('CREATE INDEX IF NOT EXISTS idx_bots_user_id ON bots(user_id)')
     cursor.execute('CREATE INDEX IF NOT EXISTS idx_commands_bot_id ON commands(bot_id)')
     cursor.execute('CREATE INDEX IF NOT EXISTS idx_analytics_bot_id ON analytics(bot_id)')
     cursor.execute('CREATE INDEX IF NOT EXISTS idx_user_progress_bot_telegram ON user_progress(bot_id, telegram_user_id)')
+    cursor.execute('''CREATE INDEX IF NOT EXISTS idx_user_progress_leaderboard
+                      ON user_progress(bot_id, coin_balance DESC, telegram_user_id)''')
+
+    cursor.execute('''CREATE INDEX IF NOT EXISTS idx_telegram_outbox_queue
+                      ON telegram_outbox(status, priority, id)''')
+    cursor.execute('''CREATE INDEX IF NOT EXISTS idx_telegram_outbox_finished
+                      ON telegram_outbox(finished_at) WHERE finished_at IS NOT NULL''')
+
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_broadcasts_bot_id ON broadcasts(bot_id)')
+    cursor.execute('''CREATE INDEX IF NOT EXISTS idx_broadcast_results_queued
+                      ON broadcast_results(broadcast_id, outbox_id) WHERE status = 0''')
+
+    needs_backfill = (cursor.execute('SELECT 1 FROM analytics LIMIT 1').fetchone() is not None and
+                      cursor.execute('SELECT 1 FROM analytics_rollup_bot LIMIT 1').fetchone() is None)
 
     conn.commit()
     conn.close()
 
+    if needs_backfill:
+        rebuild_analytics_rollups()
+
 def create_user(username, email, password_hash):
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    try:
-        cursor.execute('INSERT INTO users (username, email, password) VALUES (?, ?, ?)',
-                      (username, email, password_hash))
-        conn.commit()
-        user_id = cursor.lastrowid
-        conn.close()
-        return user_id
-    except sqlite3.IntegrityError:
-        conn.close()
-        return None
+    with db_connection() as conn:
+        cursor = conn.cursor()
+        try:
+            cursor.execute('INSERT INTO users (username, email, password) VALUES (?, ?, ?)',
+                          (username, email, password_hash))
+            conn.commit()
+            user_id = cursor.lastrowid
+            return user_id
+        except sqlite3.IntegrityError:
+            return None
 
 def get_user_by_username(username):
-    conn = get_db_connection()
-    user = conn.execute('SELECT * FROM users WHERE username = ?', (username,)).fetchone()
-    conn.close()
-    return user
+    with db_connection() as conn:
+        return conn.execute('SELECT * FROM users WHERE username = ?', (username,)).fetchone()
 
 def get_user_by_id(user_id):
-    conn = get_db_connection()
-    user = conn.execute('SELECT * FROM users WHERE id = ?', (user_id,)).fetchone()
-    conn.close()
-    return user
+    with db_connection() as conn:
+        return conn.execute('SELECT * FROM users WHERE id = ?', (user_id,)).fetchone()
 
 def create_bot(user_id, bot_name, bot_token, bot_username, description):
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute('''INSERT INTO bots (user_id, bot_name, bot_token, bot_username, description)
-                     VALUES (?, ?, ?, ?, ?)''',
-                  (user_id, bot_name, bot_token, bot_username, description))
-    conn.commit()
-    bot_id = cursor.lastrowid
-    conn.close()
-    return bot_id
+    with db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute('''INSERT INTO bots (user_id, bot_name, bot_token, bot_username, description)
+                         VALUES (?, ?, ?, ?, ?)''',
+                      (user_id, bot_name, bot_token, bot_username, description))
+        conn.commit()
+        bot_id = cursor.lastrowid
+        return bot_id
+
+def get_bot_ids():
+    with db_connection() as conn:
+        return [row['id'] for row in conn.execute('SELECT id FROM bots ORDER BY id')]
+
+def get_update_offset(bot_id):
+    with db_connection() as conn:
+        row = conn.execute('SELECT next_offset FROM bot_update_offsets WHERE bot_id = ?', (bot_id,)).fetchone()
+        return row['next_offset'] if row else None
+
+def save_update_offset(bot_id, next_offset):
+    with db_connection() as conn:
+        conn.execute('''INSERT INTO bot_update_offsets (bot_id, next_offset) VALUES (?, ?)
+                        ON CONFLICT(bot_id) DO UPDATE SET next_offset = excluded.next_offset,
+                                                          updated_at = CURRENT_TIMESTAMP''',
+                     (bot_id, next_offset))
+        conn.commit()
 
 def get_user_bots(user_id):
-    conn = get_db_connection()
-    bots = conn.execute('SELECT * FROM bots WHERE user_id = ? ORDER BY created_at DESC',
-                       (user_id,)).fetchall()
-    conn.close()
-    return bots
+    with db_connection() as conn:
+        bots = conn.execute('SELECT * FROM bots WHERE user_id = ? ORDER BY created_at DESC',
+                           (user_id,)).fetchall()
+        return bots
+
+def _load_bot(bot_id):
+    with db_connection() as conn:
+        return conn.execute('SELECT * FROM bots WHERE id = ?', (bot_id,)).fetchone()
 
 def get_bot_by_id(bot_id):
-    conn = get_db_connection()
-    bot = conn.execute('SELECT * FROM bots WHERE id = ?', (bot_id,)).fetchone()
-    conn.close()
-    return bot
+    return config_cache.get(bot_id, 'bot', _load_bot)
 
 def delete_bot(bot_id):
-    conn = get_db_connection()
-    conn.execute('DELETE FROM bots WHERE id = ?', (bot_id,))
-    conn.commit()
-    conn.close()
+    with db_connection() as conn:
+        conn.execute('DELETE FROM bots WHERE id = ?', (bot_id,))
+        conn.commit()
+    config_cache.invalidate(bot_id)
 
 def update_bot_webhook(bot_id, webhook_url):
-    conn = get_db_connection()
-    conn.execute('UPDATE bots SET webhook_url = ? WHERE id = ?', (webhook_url, bot_id))
-    conn.commit()
-    conn.close()
+    with db_connection() as conn:
+        conn.execute('UPDATE bots SET webhook_url = ? WHERE id = ?', (webhook_url, bot_id))
+        conn.commit()
+    config_cache.invalidate(bot_id)
 
 def toggle_bot_ai(bot_id, enabled):
-    conn = get_db_connection()
-    conn.execute('UPDATE bots SET ai_enabled = ? WHERE id = ?', (enabled, bot_id))
-    conn.commit()
-    conn.close()
+    with db_connection() as conn:
+        conn.execute('UPDATE bots SET ai_enabled = ? WHERE id = ?', (enabled, bot_id))
+        conn.commit()
+    config_cache.invalidate(bot_id)
 
 def update_bot_gemini_key(bot_id, encrypted_key):
-    conn = get_db_connection()
-    conn.execute('UPDATE bots SET gemini_api_key = ? WHERE id = ?', (encrypted_key, bot_id))
-    conn.commit()
-    conn.close()
+    with db_connection() as conn:
+        conn.execute('UPDATE bots SET gemini_api_key = ? WHERE id = ?', (encrypted_key, bot_id))
+        conn.commit()
+    config_cache.invalidate(bot_id)
+
+def update_bot_ai_cache(bot_id, enabled, ttl=None, size=None):
+    with db_connection() as conn:
+        conn.execute('UPDATE bots SET ai_cache_enabled = ?, ai_cache_ttl = ?, ai_cache_size = ? WHERE id = ?',
+                     (enabled, ttl, size, bot_id))
+        conn.commit()
+    config_cache.invalidate(bot_id)
 
 def update_bot_ton_wallet(bot_id, ton_wallet_address):
-    conn = get_db_connection()
-    conn.execute('UPDATE bots SET ton_wallet = ? WHERE id = ?', (ton_wallet_address, bot_id))
-    conn.commit()
-    conn.close()
+    with db_connection() as conn:
+        conn.execute('UPDATE bots SET ton_wallet = ? WHERE id = ?', (ton_wallet_address, bot_id))
+        conn.commit()
+    config_cache.invalidate(bot_id)
 
 def get_bot_commands(bot_id):
-    conn = get_db_connection()
-    commands = conn.execute('SELECT * FROM commands WHERE bot_id = ? ORDER BY command',
-                           (bot_id,)).fetchall()
-    conn.close()
-    return commands
+    with db_connection() as conn:
+        commands = conn.execute('SELECT * FROM commands WHERE bot_id = ? ORDER BY command',
+                               (bot_id,)).fetchall()
+        return commands
 
 def add_command(bot_id, command, response_type, response_content, url_link=None, button_text=None):
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute('''INSERT INTO commands (bot_id, command, response_type, response_content, url_link, button_text)
-                     VALUES (?, ?, ?, ?, ?, ?)''',
-                  (bot_id, command, response_type, response_content, url_link, button_text))
-    conn.commit()
-    command_id = cursor.lastrowid
-    conn.close()
+    with db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute('''INSERT INTO commands (bot_id, command, response_type, response_content, url_link, button_text)
+                         VALUES (?, ?, ?, ?, ?, ?)''',
+                      (bot_id, command, response_type, response_content, url_link, button_text))
+        conn.commit()
+        command_id = cursor.lastrowid
+    config_cache.invalidate(bot_id)
     return command_id
 
 def update_command(command_id, response_type, response_content, url_link=None, button_text=None):
-    conn = get_db_connection()
-    conn.execute('''UPDATE commands SET response_type = ?, response_content = ?, url_link = ?, button_text = ?
-                   WHERE id = ?''',
-                (response_type, response_content, url_link, button_text, command_id))
-    conn.commit()
-    conn.close()
+    with db_connection() as conn:
+        command = conn.execute('''UPDATE commands SET response_type = ?, response_content = ?, url_link = ?, button_text = ?
+                                  WHERE id = ? RETURNING bot_id''',
+                               (response_type, response_content, url_link, button_text, command_id)).fetchone()
+        conn.commit()
+    if command:
+        config_cache.invalidate(command['bot_id'])
 
 def delete_command(command_id):
-    conn = get_db_connection()
-    conn.execute('DELETE FROM commands WHERE id = ?', (command_id,))
-    conn.commit()
-    conn.close()
+    with db_connection() as conn:
+        command = conn.execute('DELETE FROM commands WHERE id = ? RETURNING bot_id', (command_id,)).fetchone()
+        conn.commit()
+    if command:
+        config_cache.invalidate(command['bot_id'])
+
+def _load_mining_settings(bot_id):
+    with db_connection() as conn:
+        return conn.execute('SELECT * FROM mining_settings WHERE bot_id = ?', (bot_id,)).fetchone()
 
 def get_mining_settings(bot_id):
-    conn = get_db_connection()
-    settings = conn.execute('SELECT * FROM mining_settings WHERE bot_id = ?', (bot_id,)).fetchone()
-    conn.close()
-    return settings
+    return config_cache.get(bot_id, 'mining_settings', _load_mining_settings)
 
 def save_mining_settings(bot_id, settings):
-    conn = get_db_connection()
-    cursor = conn.cursor()
+    with db_connection() as conn:
+        cursor = conn.cursor()
+
+        existing = cursor.execute('SELECT id FROM mining_settings WHERE bot_id = ?', (bot_id,)).fetchone()
+
+        if existing:
+            cursor.execute('''UPDATE mining_settings SET
+                             coin_name = ?, coin_symbol = ?, initial_balance = ?, tap_reward = ?,
+                             max_energy = ?, energy_recharge_rate = ?, primary_color = ?,
+                             secondary_color = ?, text_color = ?, background_color = ?, background_image_url = ?
+                             WHERE bot_id = ?''',
+                          (settings['coin_name'], settings['coin_symbol'], settings['initial_balance'],
+                           settings['tap_reward'], settings['max_energy'], settings['energy_recharge_rate'],
+                           settings['primary_color'], settings['secondary_color'], settings['text_color'],
+                           settings['background_color'], settings.get('background_image_url'), bot_id))
+        else:
+            cursor.execute('''INSERT INTO mining_settings
+                             (bot_id, coin_name, coin_symbol, initial_balance, tap_reward, max_energy,
+                              energy_recharge_rate, primary_color, secondary_color, text_color,
+                              background_color, background_image_url)
+                             VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)''',
+                          (bot_id, settings['coin_name'], settings['coin_symbol'], settings['initial_balance'],
+                           settings['tap_reward'], settings['max_energy'], settings['energy_recharge_rate'],
+                           settings['primary_color'], settings['secondary_color'], settings['text_color'],
+                           settings['background_color'], settings.get('background_image_url')))
 
-    existing = cursor.execute('SELECT id FROM mining_settings WHERE bot_id = ?', (bot_id,)).fetchone()
-
-    if existing:
-        cursor.execute('''UPDATE mining_settings SET
-                         coin_name = ?, coin_symbol = ?, initial_balance = ?, tap_reward = ?,
-                         max_energy = ?, energy_recharge_rate = ?, primary_color = ?,
-                         secondary_color = ?, text_color = ?, background_color = ?, background_image_url = ?
-                         WHERE bot_id = ?''',
-                      (settings['coin_name'], settings['coin_symbol'], settings['initial_balance'],
-                       settings['tap_reward'], settings['max_energy'], settings['energy_recharge_rate'],
-                       settings['primary_color'], settings['secondary_color'], settings['text_color'],
-                       settings['background_color'], settings.get('background_image_url'), bot_id))
-    else:
-        cursor.execute('''INSERT INTO mining_settings
-                         (bot_id, coin_name, coin_symbol, initial_balance, tap_reward, max_energy,
-                          energy_recharge_rate, primary_color, secondary_color, text_color,
-                          background_color, background_image_url)
-                         VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)''',
-                      (bot_id, settings['coin_name'], settings['coin_symbol'], settings['initial_balance'],
-                       settings['tap_reward'], settings['max_energy'], settings['energy_recharge_rate'],
-                       settings['primary_color'], settings['secondary_color'], settings['text_color'],
-                       settings['background_color'], settings.get('background_image_url')))
+        conn.commit()
+    config_cache.invalidate(bot_id)
 
-    conn.commit()
-    conn.close()
+def _load_shop_items(bot_id):
+    with db_connection() as conn:
+        return conn.execute('SELECT * FROM shop_items WHERE bot_id = ? AND is_active = 1', (bot_id,)).fetchall()
 
 def get_shop_items(bot_id):
-    conn = get_db_connection()
-    items = conn.execute('SELECT * FROM shop_items WHERE bot_id = ? AND is_active = 1', (bot_id,)).fetchall()
-    conn.close()
-    return items
+    return config_cache.get(bot_id, 'shop_items', _load_shop_items)
 
 def add_shop_item(bot_id, item_name, item_description, price, currency, reward_amount=None, reward_type=None):
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute('''INSERT INTO shop_items (bot_id, item_name, item_description, price, currency, reward_amount, reward_type)
-                     VALUES (?, ?, ?, ?, ?, ?, ?)''',
-                  (bot_id, item_name, item_description, price, currency, reward_amount, reward_type))
-    conn.commit()
-    item_id = cursor.lastrowid
-    conn.close()
+    with db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute('''INSERT INTO shop_items (bot_id, item_name, item_description, price, currency, reward_amount, reward_type)
+                         VALUES (?, ?, ?, ?, ?, ?, ?)''',
+                      (bot_id, item_name, item_description, price, currency, reward_amount, reward_type))
+        conn.commit()
+        item_id = cursor.lastrowid
+    config_cache.invalidate(bot_id)
     return item_id
 
 def delete_shop_item(item_id):
-    conn = get_db_connection()
-    conn.execute('UPDATE shop_items SET is_active = 0 WHERE id = ?', (item_id,))
-    conn.commit()
-    conn.close()
+    with db_connection() as conn:
+        item = conn.execute('UPDATE shop_items SET is_active = 0 WHERE id = ? RETURNING bot_id', (item_id,)).fetchone()
+        conn.commit()
+    if item:
+        config_cache.invalidate(item['bot_id'])
+
+def _load_tasks(bot_id):
+    with db_connection() as conn:
+        return conn.execute('SELECT * FROM tasks WHERE bot_id = ? AND is_active = 1', (bot_id,)).fetchall()
 
 def get_tasks(bot_id):
-    conn = get_db_connection()
-    tasks = conn.execute('SELECT * FROM tasks WHERE bot_id = ? AND is_active = 1', (bot_id,)).fetchall()
-    conn.close()
-    return tasks
+    return config_cache.get(bot_id, 'tasks', _load_tasks)
 
 def add_task(bot_id, task_name, task_description, task_type, reward_amount, reward_type, requirement_value):
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute('''INSERT INTO tasks (bot_id, task_name, task_description, task_type, reward_amount, reward_type, requirement_value)
-                     VALUES (?, ?, ?, ?, ?, ?, ?)''',
-                  (bot_id, task_name, task_description, task_type, reward_amount, reward_type, requirement_value))
-    conn.commit()
-    task_id = cursor.lastrowid
-    conn.close()
+    with db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute('''INSERT INTO tasks (bot_id, task_name, task_description, task_type, reward_amount, reward_type, requirement_value)
+                         VALUES (?, ?, ?, ?, ?, ?, ?)''',
+                      (bot_id, task_name, task_description, task_type, reward_amount, reward_type, requirement_value))
+        conn.commit()
+        task_id = cursor.lastrowid
+    config_cache.invalidate(bot_id)
     return task_id
 
 def delete_task(task_id):
-    conn = get_db_connection()
-    conn.execute('UPDATE tasks SET is_active = 0 WHERE id = ?', (task_id,))
-    conn.commit()
-    conn.close()
+    with db_connection() as conn:
+        task = conn.execute('UPDATE tasks SET is_active = 0 WHERE id = ? RETURNING bot_id', (task_id,)).fetchone()
+        conn.commit()
+    if task:
+        config_cache.invalidate(task['bot_id'])
 
 def get_or_create_user_progress(bot_id, telegram_user_id):
-    conn = get_db_connection()
-    cursor = conn.cursor()
-
-    progress = cursor.execute('SELECT * FROM user_progress WHERE bot_id = ? AND telegram_user_id = ?',
-                             (bot_id, telegram_user_id)).fetchone()
+    with db_connection() as conn:
+        cursor = conn.cursor()
 
-    if not progress:
-        settings = get_mining_settings(bot_id)
-        initial_balance = settings['initial_balance'] if settings else 0
-        max_energy = settings['max_energy'] if settings else 1000
-
-        cursor.execute('''INSERT INTO user_progress (bot_id, telegram_user_id, coin_balance, energy)
-                         VALUES (?, ?, ?, ?)''',
-                      (bot_id, telegram_user_id, initial_balance, max_energy))
-        conn.commit()
         progress = cursor.execute('SELECT * FROM user_progress WHERE bot_id = ? AND telegram_user_id = ?',
                                  (bot_id, telegram_user_id)).fetchone()
 
-    conn.close()
-    return progress
+        if not progress:
+            settings = get_mining_settings(bot_id)
+            initial_balance = settings['initial_balance'] if settings else 0
+            max_energy = settings['max_energy'] if settings else 1000
+
+            cursor.execute('''INSERT OR IGNORE INTO user_progress (bot_id, telegram_user_id, coin_balance, energy)
+                             VALUES (?, ?, ?, ?)''',
+                          (bot_id, telegram_user_id, initial_balance, max_energy))
+            conn.commit()
+            progress = cursor.execute('SELECT * FROM user_progress WHERE bot_id = ? AND telegram_user_id = ?',
+                                     (bot_id, telegram_user_id)).fetchone()
+
+        return progress
+
+def get_leaderboard_players(bot_id, limit):
+    """The bot's best `limit` players and its player count, both read off the leaderboard index"""
+    with db_connection() as conn:
+        players = conn.execute('''SELECT telegram_user_id, coin_balance FROM user_progress
+                                  WHERE bot_id = ? ORDER BY coin_balance DESC, telegram_user_id LIMIT ?''',
+                               (bot_id, limit)).fetchall()
+        total = conn.execute('SELECT COUNT(*) FROM user_progress WHERE bot_id = ?', (bot_id,)).fetchone()[0]
+        return players, total
+
+def get_leaderboard_rank(bot_id, telegram_user_id, limit, coin_balance=None):
+    """(rank, coin_balance) of one player, or None if they have not played; rank is None past `limit`.
+
+    Counts the players ahead on the leaderboard index, stopping after
+    `limit` of them, so a lookup costs at most `limit` index steps.
+    `coin_balance` overrides the stored balance, e.g. with a fresher cached one.
+    """
+    with db_connection() as conn:
+        if coin_balance is None:
+            row = conn.execute('SELECT coin_balance FROM user_progress WHERE bot_id = ? AND telegram_user_id = ?',
+                               (bot_id, telegram_user_id)).fetchone()
+            if row is None:
+                return None
+            coin_balance = row['coin_balance']
+        ahead = conn.execute('''SELECT (SELECT COUNT(*) FROM (SELECT 1 FROM user_progress
+                                                         WHERE bot_id = :bot_id AND coin_balance > :balance
+                                                         LIMIT :limit))
+                                   + (SELECT COUNT(*) FROM (SELECT 1 FROM user_progress
+                                                         WHERE bot_id = :bot_id AND coin_balance = :balance
+                                                           AND telegram_user_id < :user_id LIMIT :limit))''',
+                             {'bot_id': bot_id, 'balance': coin_balance, 'user_id': telegram_user_id,
+                              'limit': limit}).fetchone()[0]
+        return (ahead + 1 if ahead < limit else None), coin_balance
 
 def update_user_progress(bot_id, telegram_user_id, coin_balance, energy, total_taps):
-    conn = get_db_connection()
-    conn.execute('''UPDATE user_progress SET coin_balance = ?, energy = ?, total_taps = ?, last_tap_time = CURRENT_TIMESTAMP
-                   WHERE bot_id = ? AND telegram_user_id = ?''',
-                (coin_balance, energy, total_taps, bot_id, telegram_user_id))
-    conn.commit()
-    conn.close()
+    with db_connection() as conn:
+        conn.execute('''UPDATE user_progress SET coin_balance = ?, energy = ?, total_taps = ?, last_tap_time = CURRENT_TIMESTAMP
+                       WHERE bot_id = ? AND telegram_user_id = ?''',
+                    (coin_balance, energy, total_taps, bot_id, telegram_user_id))
+        conn.commit()
+
+def _apply_analytics_rollups(conn, rows):
+    totals = {}
+    daily = {}
+    commands = {}
+    seen_users = set()
+    for bot_id, telegram_user_id, event_type, event_data in rows:
+        bot_totals = totals.setdefault(bot_id, [0, 0, 0])
+        bot_totals[0] += 1
+        if event_type == 'message':
+            bot_totals[1] += 1
+        daily[(bot_id, event_type)] = daily.get((bot_id, event_type), 0) + 1
+        if event_type == 'command' and event_data is not None:
+            commands[(bot_id, event_data)] = commands.get((bot_id, event_data), 0) + 1
+        if telegram_user_id is not None:
+            seen_users.add((bot_id, telegram_user_id))
+
+    for bot_id, telegram_user_id in seen_users:
+        cursor = conn.execute('INSERT OR IGNORE INTO analytics_rollup_users (bot_id, telegram_user_id) VALUES (?, ?)',
+                              (bot_id, telegram_user_id))
+        if cursor.rowcount:
+            totals[bot_id][2] += 1
+
+    conn.executemany('''INSERT INTO analytics_rollup_bot (bot_id, total_events, total_messages, unique_users)
+                        VALUES (?, ?, ?, ?)
+                        ON CONFLICT(bot_id) DO UPDATE SET
+                            total_events = total_events + excluded.total_events,
+                            total_messages = total_messages + excluded.total_messages,
+                            unique_users = unique_users + excluded.unique_users''',
+                     [(bot_id, *counts) for bot_id, counts in totals.items()])
+    conn.executemany('''INSERT INTO analytics_rollup_daily (bot_id, day, event_type, count)
+                        VALUES (?, date('now'), ?, ?)
+                        ON CONFLICT(bot_id, day, event_type) DO UPDATE SET count = count + excluded.count''',
+                     [(bot_id, event_type, count) for (bot_id, event_type), count in daily.items()])
+    conn.executemany('''INSERT INTO analytics_rollup_commands (bot_id, event_data, count)
+                        VALUES (?, ?, ?)
+                        ON CONFLICT(bot_id, event_data) DO UPDATE SET count = count + excluded.count''',
+                     [(bot_id, event_data, count) for (bot_id, event_data), count in commands.items()])
+
+def insert_analytics_rows(conn, rows):
+    """Insert raw analytics rows and their rollups on `conn` without committing"""
+    conn.executemany('INSERT INTO analytics (bot_id, telegram_user_id, event_type, event_data) VALUES (?, ?, ?, ?)',
+                     rows)
+    _apply_analytics_rollups(conn, rows)
+
+def write_analytics_events(rows):
+    with db_connection() as conn:
+        try:
+            insert_analytics_rows(conn, rows)
+            conn.commit()
+            return
+        except sqlite3.IntegrityError:
+            conn.rollback()
+
+        # A row for a since-deleted bot fails its foreign key; keep the rest of the batch.
+        for row in rows:
+            try:
+                insert_analytics_rows(conn, [row])
+                conn.commit()
+            except sqlite3.IntegrityError:
+                conn.rollback()
+
+analytics_writer = register_service(AnalyticsWriter(write_analytics_events))
 
 def log_analytics_event(bot_id, telegram_user_id, event_type, event_data=None):
-    conn = get_db_connection()
     event_data_json = json.dumps(event_data) if event_data else None
-    conn.execute('INSERT INTO analytics (bot_id, telegram_user_id, event_type, event_data) VALUES (?, ?, ?, ?)',
-                (bot_id, telegram_user_id, event_type, event_data_json))
-    conn.commit()
-    conn.close()
+    row = (bot_id, telegram_user_id, event_type, event_data_json)
+    if ANALYTICS_WRITE_MODE == 'sync':
+        write_analytics_events([row])
+    else:
+        analytics_writer.submit(row)
+
+def flush_analytics():
+    analytics_writer.flush()
+
+def get_bots_analytics(bot_ids):
+    """Dashboard stats for many bots at once, in a fixed number of queries"""
+    bot_ids = list(bot_ids)
+    stats = {bot_id: {'total_messages': 0, 'unique_users': 0, 'command_stats': []} for bot_id in bot_ids}
+    if not bot_ids:
+        return stats
+
+    placeholders = ', '.join('?' * len(bot_ids))
+    with db_connection() as conn:
+        totals = conn.execute(
+            f'SELECT bot_id, total_messages, unique_users FROM analytics_rollup_bot WHERE bot_id IN ({placeholders})',
+            bot_ids).fetchall()
+        for row in totals:
+            stats[row['bot_id']]['total_messages'] = row['total_messages']
+            stats[row['bot_id']]['unique_users'] = row['unique_users']
+
+        command_stats = conn.execute(
+            f'''SELECT bot_id, event_data, count FROM analytics_rollup_commands
+                WHERE bot_id IN ({placeholders}) ORDER BY bot_id, event_data''',
+            bot_ids).fetchall()
+        for row in command_stats:
+            stats[row['bot_id']]['command_stats'].append(row)
+
+    return stats
 
 def get_bot_analytics(bot_id):
-    conn = get_db_connection()
-
-    total_messages = conn.execute(
-        'SELECT COUNT(*) as count FROM analytics WHERE bot_id = ? AND event_type = "message"',
-        (bot_id,)).fetchone()['count']
-
-    unique_users = conn.execute(
-        'SELECT COUNT(DISTINCT telegram_user_id) as count FROM analytics WHERE bot_id = ?',
-        (bot_id,)).fetchone()['count']
-
-    command_stats = conn.execute(
-        'SELECT event_data, COUNT(*) as count FROM analytics WHERE bot_id = ? AND event_type = "command" GROUP BY event_data',
-        (bot_id,)).fetchall()
-
-    conn.close()
-
-    return {
-        'total_messages': total_messages,
-        'unique_users': unique_users,
-        'command_stats': command_stats
-    }
+    return get_bots_analytics([bot_id])[bot_id]
+
+def get_bot_daily_analytics(bot_id, days=30):
+    with db_connection() as conn:
+        return conn.execute('''SELECT day, event_type, count FROM analytics_rollup_daily
+                               WHERE bot_id = ? AND day >= date('now', ?)
+                               ORDER BY day, event_type''',
+                            (bot_id, f'-{int(days)} days')).fetchall()
+
+def rebuild_analytics_rollups(bot_id=None):
+    """Recompute every rollup table (or one bot's rows) from the raw analytics events"""
+    flush_analytics()
+    bot_filter = 'AND bot_id = ?' if bot_id is not None else ''
+    params = (bot_id,) if bot_id is not None else ()
+
+    with db_connection() as conn:
+        conn.execute('BEGIN IMMEDIATE')
+        for table in ('analytics_rollup_bot', 'analytics_rollup_daily',
+                      'analytics_rollup_commands', 'analytics_rollup_users'):
+            conn.execute(f'DELETE FROM {table} WHERE 1 = 1 {bot_filter}', params)
+
+        conn.execute(f'''INSERT INTO analytics_rollup_users (bot_id, telegram_user_id, first_seen)
+                         SELECT bot_id, telegram_user_id, MIN(timestamp) FROM analytics
+                         WHERE telegram_user_id IS NOT NULL {bot_filter}
+                         GROUP BY bot_id, telegram_user_id''', params)
+        conn.execute(f'''INSERT INTO analytics_rollup_daily (bot_id, day, event_type, count)
+                         SELECT bot_id, date(timestamp), event_type, COUNT(*) FROM analytics
+                         WHERE 1 = 1 {bot_filter}
+                         GROUP BY bot_id, date(timestamp), event_type''', params)
+        conn.execute(f'''INSERT INTO analytics_rollup_commands (bot_id, event_data, count)
+                         SELECT bot_id, event_data, COUNT(*) FROM analytics
+                         WHERE event_type = 'command' AND event_data IS NOT NULL {bot_filter}
+                         GROUP BY bot_id, event_data''', params)
+        conn.execute(f'''INSERT INTO analytics_rollup_bot (bot_id, total_events, total_messages, unique_users)
+                         SELECT b.id,
+                                (SELECT COALESCE(SUM(count), 0) FROM analytics_rollup_daily d WHERE d.bot_id = b.id),
+                                (SELECT COALESCE(SUM(count), 0) FROM analytics_rollup_daily d
+                                 WHERE d.bot_id = b.id AND d.event_type = 'message'),
+                                (SELECT COUNT(*) FROM analytics_rollup_users u WHERE u.bot_id = b.id)
+                         FROM bots b
+                         WHERE 1 = 1 {bot_filter.replace('bot_id', 'b.id')}''', params)
+        conn.commit()
 
 def get_bot_unique_users(bot_id):
-    conn = get_db_connection()
-    users = conn.execute('''
-        SELECT 
-            up.telegram_user_id,
-            up.coin_balance,
-            up.energy,
-            up.total_taps,
-            up.level,
-            up.referred_by,
-            COUNT(DISTINCT a.id) as total_interactions,
-            MIN(a.timestamp) as first_seen,
-            MAX(a.timestamp) as last_seen
-        FROM user_progress up
-        LEFT JOIN analytics a ON up.bot_id = a.bot_id AND up.telegram_user_id = a.telegram_user_id
-        WHERE up.bot_id = ?
-        GROUP BY up.telegram_user_id
-        ORDER BY last_seen DESC
-    ''', (bot_id,)).fetchall()
-    conn.close()
-    return users
+    with db_connection() as conn:
+        users = conn.execute('''
+            SELECT 
+                up.telegram_user_id,
+                up.coin_balance,
+                up.energy,
+                up.total_taps,
+                up.level,
+                up.referred_by,
+                COUNT(DISTINCT a.id) as total_interactions,
+                MIN(a.timestamp) as first_seen,
+                MAX(a.timestamp) as last_seen
+            FROM user_progress up
+            LEFT JOIN analytics a ON up.bot_id = a.bot_id AND up.telegram_user_id = a.telegram_user_id
+            WHERE up.bot_id = ?
+            GROUP BY up.telegram_user_id
+            ORDER BY last_seen DESC
+        ''', (bot_id,)).fetchall()
+        return users
 
 def get_user_analytics(bot_id, telegram_user_id):
-    conn = get_db_connection()
-    
-    events = conn.execute('''
-        SELECT event_type, event_data, timestamp
-        FROM analytics
-        WHERE bot_id = ? AND telegram_user_id = ?
-        ORDER BY timestamp DESC
-        LIMIT 50
-    ''', (bot_id, telegram_user_id)).fetchall()
+    with db_connection() as conn:
+        events = conn.execute('''
+            SELECT event_type, event_data, timestamp
+            FROM analytics
+            WHERE bot_id = ? AND telegram_user_id = ?
+            ORDER BY timestamp DESC
+            LIMIT 50
+        ''', (bot_id, telegram_user_id)).fetchall()
     
-    message_count = conn.execute(
-        'SELECT COUNT(*) as count FROM analytics WHERE bot_id = ? AND telegram_user_id = ? AND event_type = "message"',
-        (bot_id, telegram_user_id)).fetchone()['count']
+        message_count = conn.execute(
+            'SELECT COUNT(*) as count FROM analytics WHERE bot_id = ? AND telegram_user_id = ? AND event_type = "message"',
+            (bot_id, telegram_user_id)).fetchone()['count']
     
-    command_count = conn.execute(
-        'SELECT COUNT(*) as count FROM analytics WHERE bot_id = ? AND telegram_user_id = ? AND event_type = "command"',
-        (bot_id, telegram_user_id)).fetchone()['count']
-    
-    tap_count = conn.execute(
-        'SELECT COUNT(*) as count FROM analytics WHERE bot_id = ? AND telegram_user_id = ? AND event_type = "tap"',
-        (bot_id, telegram_user_id)).fetchone()['count']
-    
-    conn.close()
+        command_count = conn.execute(
+            'SELECT COUNT(*) as count FROM analytics WHERE bot_id = ? AND telegram_user_id = ? AND event_type = "command"',
+            (bot_id, telegram_user_id)).fetchone()['count']
     
-    return {
-        'events': events,
-        'message_count': message_count,
-        'command_count': command_count,
-        'tap_count': tap_count
-    }
+        tap_count = conn.execute(
+            'SELECT COUNT(*) as count FROM analytics WHERE bot_id = ? AND telegram_user_id = ? AND event_type = "tap"',
+            (bot_id, telegram_user_id)).fetchone()['count']
+
+        return {
+            'events': events,
+            'message_count': message_count,
+            'command_count': command_count,
+            'tap_count': tap_count
+        }
 
 
 def get_user_analytics(bot_id, telegram_user_id):
     """Get analytics for a specific user"""
-    conn = get_db_connection()
-    
-    # Get message count
-    message_count = conn.execute('''
-        SELECT COUNT(*) as count FROM analytics 
-        WHERE bot_id = ? AND telegram_user_id = ? AND event_type = 'message'
-    ''', (bot_id, telegram_user_id)).fetchone()['count']
+    with db_connection() as conn:
+        # Get message count
+        message_count = conn.execute('''
+            SELECT COUNT(*) as count FROM analytics 
+            WHERE bot_id = ? AND telegram_user_id = ? AND event_type = 'message'
+        ''', (bot_id, telegram_user_id)).fetchone()['count']
     
-    # Get command count
-    command_count = conn.execute('''
-        SELECT COUNT(*) as count FROM analytics 
-        WHERE bot_id = ? AND telegram_user_id = ? AND event_type = 'command'
-    ''', (bot_id, telegram_user_id)).fetchone()['count']
+        # Get command count
+        command_count = conn.execute('''
+            SELECT COUNT(*) as count FROM analytics 
+            WHERE bot_id = ? AND telegram_user_id = ? AND event_type = 'command'
+        ''', (bot_id, telegram_user_id)).fetchone()['count']
     
-    # Get tap count
-    tap_count = conn.execute('''
-        SELECT COUNT(*) as count FROM analytics 
-        WHERE bot_id = ? AND telegram_user_id = ? AND event_type = 'tap'
-    ''', (bot_id, telegram_user_id)).fetchone()['count']
-    
-    # Get recent events
-    events = conn.execute('''
-        SELECT event_type, event_data, timestamp 
-        FROM analytics 
-        WHERE bot_id = ? AND telegram_user_id = ?
-        ORDER BY timestamp DESC
-        LIMIT 50
-    ''', (bot_id, telegram_user_id)).fetchall()
-    
-    conn.close()
+        # Get tap count
+        tap_count = conn.execute('''
+            SELECT COUNT(*) as count FROM analytics 
+            WHERE bot_id = ? AND telegram_user_id = ? AND event_type = 'tap'
+        ''', (bot_id, telegram_user_id)).fetchone()['count']
     
-    return {
-        'message_count': message_count,
-        'command_count': command_count,
-        'tap_count': tap_count,
-        'events': events
-    }
+        # Get recent events
+        events = conn.execute('''
+            SELECT event_type, event_data, timestamp 
+            FROM analytics 
+            WHERE bot_id = ? AND telegram_user_id = ?
+            ORDER BY timestamp DESC
+            LIMIT 50
+        ''', (bot_id, telegram_user_id)).fetchall()
+
+        return {
+            'message_count': message_count,
+            'command_count': command_count,
+            'tap_count': tap_count,
+            'events': events
+        }
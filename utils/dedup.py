@@ -0,0 +1,92 @@
+import itertools
+import os
+import threading
+import time
+from collections import deque
+
+from utils.database import db_connection
+
+UPDATE_DEDUP_SIZE = int(os.getenv('UPDATE_DEDUP_SIZE', 100000))
+UPDATE_DEDUP_RETENTION_HOURS = int(os.getenv('UPDATE_DEDUP_RETENTION_HOURS', 48))
+
+class UpdateDeduplicator:
+    """Drops Telegram updates that were already accepted, keyed by (bot_id, update_id).
+
+    The most recent `max_recent` keys are kept in memory (a dict plus a ring
+    that evicts the oldest), so a redelivery is usually rejected with a
+    single set lookup. Keys missing from memory are recorded in the
+    `processed_updates` table, which catches redeliveries seen by another
+    worker process or before a restart. Rows older than `retention_hours`
+    are purged; Telegram stops redelivering long before that.
+    """
+
+    def __init__(self, max_recent=UPDATE_DEDUP_SIZE, retention_hours=UPDATE_DEDUP_RETENTION_HOURS):
+        self.max_recent = max_recent
+        self.retention_hours = retention_hours
+        # key -> generation of its ring entry; entries left behind by `forget` no longer match.
+        self._recent = {}
+        self._ring = deque()
+        self._generations = itertools.count()
+        self._lock = threading.Lock()
+        self._last_purge = 0.0
+        self._stats = {'accepted': 0, 'duplicates_memory': 0, 'duplicates_db': 0}
+
+    def _remember(self, key):
+        generation = next(self._generations)
+        self._recent[key] = generation
+        self._ring.append((key, generation))
+        while len(self._ring) > self.max_recent:
+            old_key, old_generation = self._ring.popleft()
+            if self._recent.get(old_key) == old_generation:
+                del self._recent[old_key]
+
+    def accept(self, bot_id, update_id):
+        """Record the update and return True, or return False if it was seen before"""
+        key = (bot_id, update_id)
+        with self._lock:
+            if key in self._recent:
+                self._stats['duplicates_memory'] += 1
+                return False
+            # Claimed in memory first so concurrent redeliveries in this process stop here.
+            self._remember(key)
+
+        try:
+            with db_connection() as conn:
+                inserted = conn.execute('INSERT OR IGNORE INTO processed_updates (bot_id, update_id) VALUES (?, ?)',
+                                        (bot_id, update_id)).rowcount
+                conn.commit()
+        except Exception:
+            self.forget(bot_id, update_id)
+            raise
+
+        with self._lock:
+            self._stats['accepted' if inserted else 'duplicates_db'] += 1
+            purge = time.monotonic() - self._last_purge >= 3600
+            if purge:
+                self._last_purge = time.monotonic()
+        if purge:
+            self._purge()
+        return bool(inserted)
+
+    def forget(self, bot_id, update_id):
+        """Undo `accept`, e.g. when the update could not be queued and Telegram will send it again"""
+        key = (bot_id, update_id)
+        with self._lock:
+            # The ring entry stays until it ages out, but no longer matches if the key is accepted again.
+            self._recent.pop(key, None)
+        with db_connection() as conn:
+            conn.execute('DELETE FROM processed_updates WHERE bot_id = ? AND update_id = ?', (bot_id, update_id))
+            conn.commit()
+
+    def _purge(self):
+        with db_connection() as conn:
+            conn.execute("DELETE FROM processed_updates WHERE received_at < datetime('now', ?)",
+                         (f'-{self.retention_hours} hours',))
+            conn.commit()
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats['recent'] = len(self._recent)
+        stats['max_recent'] = self.max_recent
+        return stats
@@ -0,0 +1,61 @@
+import hashlib
+import os
+import threading
+from datetime import datetime, timezone
+
+from flask import make_response, request
+from werkzeug.http import is_resource_modified
+from werkzeug.security import safe_join
+
+STATIC_CACHE_MAX_AGE = int(os.getenv('STATIC_CACHE_MAX_AGE', 31536000))
+
+_static_versions = {}
+_lock = threading.Lock()
+
+def static_file_version(static_folder, filename):
+    """Short content hash of a static file, recomputed only when it changes on disk; None if missing"""
+    path = safe_join(static_folder, filename)
+    if path is None:
+        return None
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    signature = (stat.st_mtime_ns, stat.st_size)
+    with _lock:
+        entry = _static_versions.get(path)
+    if entry is not None and entry[0] == signature:
+        return entry[1]
+    with open(path, 'rb') as f:
+        version = hashlib.sha256(f.read()).hexdigest()[:12]
+    with _lock:
+        _static_versions[path] = (signature, version)
+    return version
+
+def static_cache_control(static_folder, filename, requested_version):
+    """Cache-Control for a static file: a year and immutable when the URL carries its current hash.
+
+    Unversioned URLs (the manifest, service worker and icons they list) and
+    URLs with an outdated hash are revalidated on every use instead.
+    """
+    if requested_version and requested_version == static_file_version(static_folder, filename):
+        return f'public, max-age={STATIC_CACHE_MAX_AGE}, immutable'
+    return 'no-cache'
+
+def conditional_page(etag, last_modified, render):
+    """Response for a rendered page that browsers revalidate with If-None-Match / If-Modified-Since.
+
+    `etag` must change whenever the rendered output would; `render()` is only
+    called when the client's copy is out of date, otherwise the answer is an
+    empty 304. `last_modified` is unix time or None.
+    """
+    modified_at = datetime.fromtimestamp(last_modified, timezone.utc) if last_modified else None
+    if is_resource_modified(request.environ, etag=etag, last_modified=modified_at):
+        response = make_response(render())
+    else:
+        response = make_response('', 304)
+    response.set_etag(etag)
+    if modified_at is not None:
+        response.last_modified = modified_at
+    response.headers['Cache-Control'] = 'private, no-cache'
+    return response
@@ -0,0 +1,162 @@
+import os
+import threading
+import time
+from bisect import bisect_left, insort
+from collections import OrderedDict
+
+LEADERBOARD_MAX_BOTS = int(os.getenv('LEADERBOARD_MAX_BOTS', 256))
+LEADERBOARD_TOP_SIZE = int(os.getenv('LEADERBOARD_TOP_SIZE', 100))
+LEADERBOARD_REFRESH_INTERVAL = float(os.getenv('LEADERBOARD_REFRESH_INTERVAL', 60))
+LEADERBOARD_RANK_LIMIT = int(os.getenv('LEADERBOARD_RANK_LIMIT', 10000))
+LEADERBOARD_RANK_CACHE_SIZE = int(os.getenv('LEADERBOARD_RANK_CACHE_SIZE', 10000))
+
+class TopPlayers:
+    """The `size` richest players of one bot, kept sorted by coin balance.
+
+    Entries are (-coin_balance, telegram_user_id) tuples in a sorted list of
+    at most `size`, so updates and ranks cost O(size) whatever the number of
+    players. `total` is the bot's player count when it was loaded.
+    """
+
+    def __init__(self, players, size, total):
+        self.size = size
+        self.total = total
+        self._balances = {}
+        self._keys = []
+        for telegram_user_id, coin_balance in players:
+            self._balances[telegram_user_id] = coin_balance
+            self._keys.append((-coin_balance, telegram_user_id))
+        self._keys.sort()
+        # With fewer players than places, every player of the bot is listed.
+        self._complete = len(self._keys) < size
+
+    def update(self, telegram_user_id, coin_balance):
+        """Apply a balance change; False when the board no longer knows its last places"""
+        key = (-coin_balance, telegram_user_id)
+        old_balance = self._balances.get(telegram_user_id)
+        if old_balance == coin_balance:
+            return True
+        if old_balance is not None:
+            old_key = (-old_balance, telegram_user_id)
+            del self._keys[bisect_left(self._keys, old_key)]
+            del self._balances[telegram_user_id]
+            if not self._complete and key > old_key and (not self._keys or key > self._keys[-1]):
+                # Fell below the last place; whoever really comes next is not on the board.
+                return False
+        elif self._complete:
+            self.total += 1
+        elif not self._keys or key > self._keys[-1]:
+            return True
+        self._balances[telegram_user_id] = coin_balance
+        insort(self._keys, key)
+        if len(self._keys) > self.size:
+            del self._balances[self._keys.pop()[1]]
+            self._complete = False
+        return True
+
+    def rank(self, telegram_user_id):
+        """1-based position of a listed player, or None if they are not on the board"""
+        coin_balance = self._balances.get(telegram_user_id)
+        if coin_balance is None:
+            return None
+        return bisect_left(self._keys, (-coin_balance, telegram_user_id)) + 1
+
+    def balance(self, telegram_user_id):
+        return self._balances.get(telegram_user_id)
+
+    def top(self, limit):
+        return [(telegram_user_id, -negative_balance) for negative_balance, telegram_user_id in self._keys[:limit]]
+
+class LeaderboardIndex:
+    """Top players per bot, loaded on first use and kept current incrementally.
+
+    `load(bot_id, limit)` returns the bot's best `limit` (telegram_user_id,
+    coin_balance) pairs and its player count. Balance changes made in this
+    process are applied with `record`; each board is also reloaded every
+    `refresh_interval` seconds to pick up changes made by other worker
+    processes. At most `max_bots` boards are kept, least recently used first out.
+
+    Players not on a board are ranked by `rank(bot_id, telegram_user_id,
+    rank_limit)`, which returns (rank, coin_balance), with rank None past
+    `rank_limit`, or None for unknown players. Those ranks are approximate:
+    each is kept for `refresh_interval` seconds, for up to `rank_cache_size`
+    players.
+    """
+
+    def __init__(self, load, rank, top_size=LEADERBOARD_TOP_SIZE, max_bots=LEADERBOARD_MAX_BOTS,
+                 refresh_interval=LEADERBOARD_REFRESH_INTERVAL, rank_limit=LEADERBOARD_RANK_LIMIT,
+                 rank_cache_size=LEADERBOARD_RANK_CACHE_SIZE):
+        self.load = load
+        self.rank = rank
+        self.top_size = top_size
+        self.max_bots = max_bots
+        self.refresh_interval = refresh_interval
+        self.rank_limit = rank_limit
+        self.rank_cache_size = rank_cache_size
+        self._boards = OrderedDict()
+        self._ranks = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _board(self, bot_id):
+        now = time.monotonic()
+        with self._lock:
+            entry = self._boards.get(bot_id)
+            if entry is not None and now - entry[1] < self.refresh_interval:
+                self._boards.move_to_end(bot_id)
+                return entry[0]
+
+        players, total = self.load(bot_id, self.top_size)
+        board = TopPlayers(players, self.top_size, total)
+        with self._lock:
+            self._boards[bot_id] = (board, now)
+            self._boards.move_to_end(bot_id)
+            while len(self._boards) > self.max_bots:
+                self._boards.popitem(last=False)
+        return board
+
+    def record(self, bot_id, telegram_user_id, coin_balance):
+        with self._lock:
+            entry = self._boards.get(bot_id)
+            if entry is not None and not entry[0].update(int(telegram_user_id), coin_balance):
+                del self._boards[bot_id]
+
+    def drop(self, bot_id):
+        with self._lock:
+            self._boards.pop(bot_id, None)
+
+    def snapshot(self, bot_id, telegram_user_id=None, limit=10):
+        board = self._board(bot_id)
+        with self._lock:
+            top = board.top(limit)
+            result = {
+                'total_players': board.total,
+                'top': [{'rank': position, 'telegram_user_id': user_id, 'coin_balance': coin_balance}
+                        for position, (user_id, coin_balance) in enumerate(top, 1)]
+            }
+            if telegram_user_id is not None:
+                result['user'] = {'rank': board.rank(telegram_user_id),
+                                  'coin_balance': board.balance(telegram_user_id)}
+        if telegram_user_id is not None and result['user']['rank'] is None:
+            found = self._off_board_rank(bot_id, telegram_user_id)
+            if found is not None:
+                result['user'] = {'rank': found[0], 'coin_balance': found[1]}
+                if found[0] is None:
+                    result['user']['rank_over'] = self.rank_limit
+        return result
+
+    def _off_board_rank(self, bot_id, telegram_user_id):
+        key = (bot_id, telegram_user_id)
+        now = time.monotonic()
+        with self._lock:
+            entry = self._ranks.get(key)
+            if entry is not None and now - entry[1] < self.refresh_interval:
+                self._ranks.move_to_end(key)
+                return entry[0]
+
+        found = self.rank(bot_id, telegram_user_id, self.rank_limit)
+        with self._lock:
+            self._ranks[key] = (found, now)
+            self._ranks.move_to_end(key)
+            while len(self._ranks) > self.rank_cache_size:
+                self._ranks.popitem(last=False)
+        return found
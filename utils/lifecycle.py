@@ -0,0 +1,22 @@
+import atexit
+
+_services = []
+
+def register_service(service):
+    """Have `service.stop()` called when the process exits; returns the service.
+
+    Services stop in reverse order of registration. Whatever is registered
+    later (the update poller and dispatcher) feeds work into what was
+    registered before it (the outbox, progress cache and analytics writer),
+    so producers drain before the writers they depend on stop.
+    """
+    _services.append(service)
+    return service
+
+@atexit.register
+def _stop_on_shutdown():
+    for service in reversed(_services):
+        try:
+            service.stop()
+        except Exception as e:
+            print(f"Shutdown error in {type(service).__name__}: {e}")
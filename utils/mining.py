@@ -0,0 +1,273 @@
+import hashlib
+import json
+import math
+import os
+import time
+from datetime import datetime, timezone
+
+from utils.lifecycle import register_service
+from utils.database import (
+    db_connection, insert_analytics_rows, get_or_create_user_progress, log_analytics_event,
+    get_leaderboard_players, get_leaderboard_rank
+)
+from utils.leaderboard import LeaderboardIndex
+from utils.notifier import ChangeNotifier
+from utils.progress_cache import ProgressCache
+
+MAX_TAPS_PER_SECOND = int(os.getenv('MAX_TAPS_PER_SECOND', 20))
+MAX_TAPS_PER_BATCH = int(os.getenv('MAX_TAPS_PER_BATCH', 200))
+# Well under the worker's 32 request threads; mini-apps beyond this fall back to plain polling.
+PROGRESS_LONG_POLL_WAITERS = int(os.getenv('PROGRESS_LONG_POLL_WAITERS', 8))
+
+# Same fallbacks get_or_create_user_progress uses for bots without mining settings
+DEFAULT_MINING_SETTINGS = {'initial_balance': 0, 'max_energy': 1000}
+
+progress_notifier = ChangeNotifier(PROGRESS_LONG_POLL_WAITERS)
+
+
+def regenerate_energy(energy, energy_updated_at, mining_settings, now=None):
+    """Return (energy, as_of) after applying regeneration up to `now`.
+
+    Energy recharges by `energy_recharge_rate` units per minute up to
+    `max_energy`. `as_of` only advances by whole recharged units, so the
+    partial progress towards the next unit is kept when the result is
+    persisted.
+    """
+    now = time.time() if now is None else now
+    max_energy = mining_settings['max_energy']
+    rate = mining_settings['energy_recharge_rate']
+
+    if energy_updated_at is None or energy >= max_energy:
+        return min(energy, max_energy), now
+    if rate <= 0:
+        return energy, energy_updated_at
+
+    seconds_per_unit = 60 / rate
+    recovered = int((now - energy_updated_at) / seconds_per_unit)
+    if energy + recovered >= max_energy:
+        return max_energy, now
+    return energy + recovered, energy_updated_at + recovered * seconds_per_unit
+
+def refill_tap_tokens(tokens, tokens_at, max_rate, now):
+    """Taps the per-user rate bucket holds at `now`: it refills at `max_rate` per second
+    and holds at most one second's worth, so back-to-back batches cannot exceed the rate."""
+    if tokens is None or tokens_at is None:
+        return float(max_rate)
+    return min(float(max_rate), tokens + (now - tokens_at) * max_rate)
+
+def progress_with_energy(progress, mining_settings, now=None):
+    """Progress row as a dict, with `energy` replaced by its current derived value"""
+    progress = dict(progress)
+    progress['stored_energy'] = progress['energy']
+    if mining_settings:
+        progress['energy'], _ = regenerate_energy(progress['energy'], progress['energy_updated_at'],
+                                                  mining_settings, now)
+    return progress
+
+def _load_progress(bot_id, telegram_user_id):
+    progress = dict(get_or_create_user_progress(bot_id, telegram_user_id))
+    if progress['last_tap_time']:
+        last_tap = datetime.strptime(progress['last_tap_time'], '%Y-%m-%d %H:%M:%S')
+        progress['last_tap_at'] = last_tap.replace(tzinfo=timezone.utc).timestamp()
+    return progress
+
+def _write_progress_changes(changes):
+    with db_connection() as conn:
+        conn.executemany('''UPDATE user_progress
+                            SET coin_balance = coin_balance + ?, total_taps = total_taps + ?,
+                                energy = ?, energy_updated_at = ?,
+                                last_tap_time = COALESCE(datetime(?, 'unixepoch'), last_tap_time),
+                                tap_tokens = ?, tap_tokens_at = ?
+                            WHERE bot_id = ? AND telegram_user_id = ?''',
+                         [(coin_delta, taps_delta, energy, energy_updated_at, last_tap_at, tap_tokens, tap_tokens_at,
+                           bot_id, telegram_user_id)
+                          for ((bot_id, telegram_user_id), coin_delta, taps_delta, energy, energy_updated_at,
+                               last_tap_at, tap_tokens, tap_tokens_at) in changes])
+        conn.commit()
+
+progress_cache = register_service(ProgressCache(_load_progress, _write_progress_changes))
+
+def _load_leaderboard(bot_id, limit):
+    players, total = get_leaderboard_players(bot_id, limit)
+    balances = {row['telegram_user_id']: row['coin_balance'] for row in players}
+    # Taps still in the progress cache have not reached the table. Cached balances only grow
+    # (purchases write to the table directly), so overlaying them keeps the top `limit` exact.
+    balances.update(progress_cache.balances(bot_id))
+    return sorted(balances.items(), key=lambda player: (-player[1], player[0]))[:limit], total
+
+def _leaderboard_rank(bot_id, telegram_user_id, limit):
+    return get_leaderboard_rank(bot_id, telegram_user_id, limit, progress_cache.balance(bot_id, telegram_user_id))
+
+leaderboard = LeaderboardIndex(_load_leaderboard, _leaderboard_rank)
+
+def read_progress(bot_id, telegram_user_id, mining_settings):
+    """Current progress for one user, from the hot-state cache when it is enabled"""
+    if progress_cache.enabled:
+        progress = progress_cache.read(bot_id, telegram_user_id)
+    else:
+        progress = get_or_create_user_progress(bot_id, telegram_user_id)
+    return progress_with_energy(progress, mining_settings)
+
+def progress_etag(progress):
+    """Version tag for a progress record; energy regeneration alone does not change it"""
+    state = (progress['coin_balance'], progress['total_taps'], progress['level'],
+             progress['stored_energy'], progress['energy_updated_at'])
+    return hashlib.sha1(repr(state).encode()).hexdigest()[:16]
+
+def ensure_user_progress(conn, bot_id, telegram_user_id, mining_settings):
+    conn.execute('''INSERT OR IGNORE INTO user_progress
+                    (bot_id, telegram_user_id, coin_balance, energy, energy_updated_at)
+                    VALUES (?, ?, ?, ?, ?)''',
+                 (bot_id, telegram_user_id, mining_settings['initial_balance'], mining_settings['max_energy'],
+                  time.time()))
+
+# One statement does the whole tap: the CTEs (materialized, so they are read before the row
+# changes) regenerate energy and refill the rate bucket as regenerate_energy and
+# refill_tap_tokens do and work out how many taps fit, and the UPDATE only touches the row
+# when at least one does.
+TAP_SQL = '''
+    WITH current AS MATERIALIZED (
+        SELECT id, energy, energy_updated_at,
+               CAST((:now - energy_updated_at) * :recharge_rate / 60 AS INTEGER) AS recovered,
+               CASE WHEN tap_tokens IS NULL OR tap_tokens_at IS NULL THEN :max_rate
+                    ELSE MIN(:max_rate, tap_tokens + (:now - tap_tokens_at) * :max_rate) END AS tokens
+        FROM user_progress WHERE bot_id = :bot_id AND telegram_user_id = :telegram_user_id
+    ), regenerated AS MATERIALIZED (
+        SELECT id, tokens,
+               CASE WHEN energy_updated_at IS NULL OR energy >= :max_energy THEN MIN(energy, :max_energy)
+                    WHEN :recharge_rate <= 0 THEN energy
+                    ELSE MIN(:max_energy, energy + recovered) END AS energy,
+               CASE WHEN energy_updated_at IS NULL OR energy >= :max_energy THEN :now
+                    WHEN :recharge_rate <= 0 THEN energy_updated_at
+                    WHEN energy + recovered >= :max_energy THEN :now
+                    ELSE energy_updated_at + recovered * 60.0 / :recharge_rate END AS as_of
+        FROM current
+    ), tap AS MATERIALIZED (
+        SELECT id, energy, as_of, tokens,
+               CASE WHEN :max_rate IS NULL THEN MIN(:count, energy)
+                    ELSE MIN(:count, energy, CAST(tokens AS INTEGER)) END AS applied
+        FROM regenerated
+    )
+    UPDATE user_progress
+    SET coin_balance = coin_balance + :tap_reward * (SELECT applied FROM tap),
+        energy = (SELECT energy - applied FROM tap),
+        energy_updated_at = (SELECT as_of FROM tap),
+        total_taps = total_taps + (SELECT applied FROM tap),
+        last_tap_time = CURRENT_TIMESTAMP,
+        tap_tokens = CASE WHEN :max_rate IS NULL THEN tap_tokens ELSE (SELECT tokens - applied FROM tap) END,
+        tap_tokens_at = CASE WHEN :max_rate IS NULL THEN tap_tokens_at ELSE :now END
+    WHERE id = (SELECT id FROM tap) AND (SELECT applied FROM tap) > 0
+    RETURNING coin_balance, energy, total_taps, (SELECT applied FROM tap) AS applied
+'''
+
+def apply_taps(bot_id, telegram_user_id, mining_settings, count=1, max_rate=None):
+    """Spend energy on up to `count` taps, capped by regenerated energy and the user's `max_rate` bucket.
+
+    Returns (progress, applied) with the updated coin_balance, energy and total_taps.
+    """
+    if progress_cache.enabled:
+        return _apply_taps_cached(bot_id, telegram_user_id, mining_settings, count, max_rate)
+
+    with db_connection() as conn:
+        ensure_user_progress(conn, bot_id, telegram_user_id, mining_settings)
+        row = conn.execute(TAP_SQL, {
+            'bot_id': bot_id, 'telegram_user_id': telegram_user_id, 'now': time.time(), 'count': count,
+            'max_rate': max_rate, 'max_energy': mining_settings['max_energy'],
+            'recharge_rate': mining_settings['energy_recharge_rate'], 'tap_reward': mining_settings['tap_reward']
+        }).fetchone()
+        if row is None:
+            conn.commit()
+            current = conn.execute('SELECT * FROM user_progress WHERE bot_id = ? AND telegram_user_id = ?',
+                                   (bot_id, telegram_user_id)).fetchone()
+            progress = progress_with_energy(current, mining_settings)
+            return {'coin_balance': progress['coin_balance'], 'energy': progress['energy'],
+                    'total_taps': progress['total_taps']}, 0
+        applied = row['applied']
+        insert_analytics_rows(conn, [(bot_id, telegram_user_id, 'tap', None)] * applied)
+        conn.commit()
+    leaderboard.record(bot_id, telegram_user_id, row['coin_balance'])
+    progress_notifier.notify((bot_id, telegram_user_id))
+    return {'coin_balance': row['coin_balance'], 'energy': row['energy'], 'total_taps': row['total_taps']}, applied
+
+def _apply_taps_cached(bot_id, telegram_user_id, mining_settings, count, max_rate):
+    now = time.time()
+
+    def spend(record):
+        energy, as_of = regenerate_energy(record['energy'], record['energy_updated_at'], mining_settings, now)
+        applied = min(count, energy)
+        if max_rate:
+            tokens = refill_tap_tokens(record['tap_tokens'], record['tap_tokens_at'], max_rate, now)
+            applied = min(applied, int(tokens))
+        if applied > 0:
+            if max_rate:
+                record['tap_tokens'] = tokens - applied
+                record['tap_tokens_at'] = now
+            record['coin_balance'] += mining_settings['tap_reward'] * applied
+            record['total_taps'] += applied
+            record['energy'] = energy - applied
+            record['energy_updated_at'] = as_of
+            record['last_tap_at'] = now
+            energy -= applied
+        return {'coin_balance': record['coin_balance'], 'energy': energy,
+                'total_taps': record['total_taps']}, max(applied, 0)
+
+    progress, applied = progress_cache.mutate(bot_id, telegram_user_id, spend)
+    if applied:
+        leaderboard.record(bot_id, telegram_user_id, progress['coin_balance'])
+        progress_notifier.notify((bot_id, telegram_user_id))
+    for _ in range(applied):
+        log_analytics_event(bot_id, telegram_user_id, 'tap')
+    return progress, applied
+
+def purchase_item(bot_id, telegram_user_id, item_id, mining_settings, purchase_id=None):
+    """Buy a coin-priced shop item in one transaction.
+
+    The balance is debited with a conditional UPDATE, and the ledger row and
+    analytics row are written in the same transaction. A repeated
+    `purchase_id` returns the original outcome without charging again.
+    Returns a dict with `status` ('ok', 'duplicate', 'not_found',
+    'wrong_currency' or 'insufficient') and, on success, `coin_balance`.
+    """
+    # The row is debited directly, so write back and drop any cached copy around it.
+    progress_cache.evict(bot_id, telegram_user_id)
+    with db_connection() as conn:
+        # Take the write lock up front: this transaction reads before it writes.
+        conn.execute('BEGIN IMMEDIATE')
+        if purchase_id is not None:
+            previous = conn.execute('''SELECT coin_balance_after FROM purchases
+                                       WHERE bot_id = ? AND telegram_user_id = ? AND purchase_id = ?''',
+                                    (bot_id, telegram_user_id, purchase_id)).fetchone()
+            if previous:
+                return {'status': 'duplicate', 'coin_balance': previous['coin_balance_after']}
+
+        item = conn.execute('''SELECT price, currency FROM shop_items
+                               WHERE id = ? AND bot_id = ? AND is_active = 1''',
+                            (item_id, bot_id)).fetchone()
+        if not item:
+            return {'status': 'not_found'}
+        if item['currency'] != 'coins':
+            return {'status': 'wrong_currency'}
+        # Prices are stored as REAL but balances are whole coins; a fractional price rounds up,
+        # and this one value is what is checked, debited and recorded.
+        price = math.ceil(item['price'])
+
+        ensure_user_progress(conn, bot_id, telegram_user_id, mining_settings or DEFAULT_MINING_SETTINGS)
+        progress = conn.execute('''UPDATE user_progress SET coin_balance = coin_balance - ?
+                                   WHERE bot_id = ? AND telegram_user_id = ? AND coin_balance >= ?
+                                   RETURNING coin_balance''',
+                                (price, bot_id, telegram_user_id, price)).fetchone()
+        if progress is None:
+            conn.commit()
+            return {'status': 'insufficient'}
+
+        conn.execute('''INSERT INTO purchases (bot_id, telegram_user_id, item_id, price, purchase_id, coin_balance_after)
+                        VALUES (?, ?, ?, ?, ?, ?)''',
+                     (bot_id, telegram_user_id, item_id, price, purchase_id, progress['coin_balance']))
+        insert_analytics_rows(conn, [(bot_id, telegram_user_id, 'shop_purchase',
+                                      json.dumps({'item_id': item_id, 'price': price}))])
+        conn.commit()
+
+    progress_cache.evict(bot_id, telegram_user_id)
+    leaderboard.record(bot_id, telegram_user_id, progress['coin_balance'])
+    progress_notifier.notify((bot_id, telegram_user_id))
+    return {'status': 'ok', 'coin_balance': progress['coin_balance']}
@@ -0,0 +1,61 @@
+import threading
+from contextlib import contextmanager
+
+class ChangeNotifier:
+    """Lets request threads wait for a change to a specific key.
+
+    A listener registers before reading the current state, so a change that
+    lands between the read and the wait is never missed:
+
+        with notifier.listen(key) as changed:
+            state = read()
+            if changed is not None and state == known:
+                changed.wait(timeout)
+
+    At most `max_listeners` threads wait at once; beyond that `listen`
+    yields None and the caller answers straight away, so waiters can never
+    take all of a worker's request threads.
+    """
+
+    def __init__(self, max_listeners):
+        self.max_listeners = max_listeners
+        self._listeners = {}
+        self._count = 0
+        self._lock = threading.Lock()
+        self._stats = {'waits': 0, 'refused': 0}
+
+    @contextmanager
+    def listen(self, key):
+        with self._lock:
+            if self._count >= self.max_listeners:
+                self._stats['refused'] += 1
+                event = None
+            else:
+                event = threading.Event()
+                self._listeners.setdefault(key, set()).add(event)
+                self._count += 1
+                self._stats['waits'] += 1
+        try:
+            yield event
+        finally:
+            if event is not None:
+                with self._lock:
+                    self._count -= 1
+                    listeners = self._listeners.get(key)
+                    if listeners is not None:
+                        listeners.discard(event)
+                        if not listeners:
+                            del self._listeners[key]
+
+    def notify(self, key):
+        with self._lock:
+            listeners = list(self._listeners.get(key, ()))
+        for event in listeners:
+            event.set()
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats['listeners'] = self._count
+        stats['max_listeners'] = self.max_listeners
+        return stats
@@ -0,0 +1,403 @@
+import json
+import os
+import threading
+import time
+from bisect import insort
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from utils.database import db_connection
+from utils.telegram_api import TelegramBotAPI
+
+OUTBOX_BOT_RATE = float(os.getenv('OUTBOX_BOT_RATE', 30))
+OUTBOX_CHAT_RATE = float(os.getenv('OUTBOX_CHAT_RATE', 1))
+OUTBOX_GROUP_RATE = float(os.getenv('OUTBOX_GROUP_RATE', 20 / 60))
+OUTBOX_SENDERS = int(os.getenv('OUTBOX_SENDERS', 8))
+OUTBOX_BATCH_SIZE = int(os.getenv('OUTBOX_BATCH_SIZE', 200))
+OUTBOX_POLL_INTERVAL = float(os.getenv('OUTBOX_POLL_INTERVAL', 1.0))
+OUTBOX_CLAIM_TIMEOUT = float(os.getenv('OUTBOX_CLAIM_TIMEOUT', 120))
+OUTBOX_MAX_ATTEMPTS = int(os.getenv('OUTBOX_MAX_ATTEMPTS', 5))
+OUTBOX_RETENTION_HOURS = int(os.getenv('OUTBOX_RETENTION_HOURS', 24))
+
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BULK = 1
+
+# Chat actions are not messages, so they do not use up a chat's message rate.
+UNMETERED_CHAT_METHODS = frozenset({'sendChatAction'})
+
+# Calls that can safely be repeated after a timeout or server error, when it is unknown whether
+# Telegram carried them out. Anything else (sendMessage, sendPhoto) could reach the user twice.
+IDEMPOTENT_METHODS = frozenset({'sendChatAction', 'editMessageText', 'deleteMessage',
+                                'setWebhook', 'deleteWebhook', 'getMe'})
+
+class TokenBucket:
+    """Allows `rate` events per second with bursts of up to `capacity`"""
+
+    __slots__ = ('rate', 'capacity', 'tokens', 'updated')
+
+    def __init__(self, rate, capacity, now):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = now
+
+    def wait_time(self, now):
+        """Seconds until a token is available (0 if one is available now)"""
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self):
+        self.tokens -= 1
+
+def insert_outbox_rows(conn, rows):
+    """Queue (bot_id, chat_id, method, params, priority) rows in the caller's transaction.
+
+    The dispatcher picks them up on its next poll. Returns the new ids.
+    """
+    return [conn.execute('''INSERT INTO telegram_outbox (bot_id, chat_id, method, params, priority)
+                            VALUES (?, ?, ?, ?, ?) RETURNING id''',
+                         (bot_id, chat_id, method, json.dumps(params), priority)).fetchone()[0]
+            for bot_id, chat_id, method, params, priority in rows]
+
+class OutboundScheduler:
+    """Rate-limited, durable sender for Bot API calls.
+
+    `enqueue` stores the call in the `telegram_outbox` table and returns its
+    id; a dispatcher thread sends it once the per-bot bucket (`bot_rate`
+    messages per second) and the per-chat bucket (`chat_rate`, or
+    `group_rate` for groups and channels) allow it. Interactive calls are
+    sent before bulk ones, and calls to the same chat keep their order.
+    A 429 pauses the bot for the `retry_after` Telegram asks for. Network
+    errors and 5xx responses are retried with backoff, up to `max_attempts`
+    times, only for IDEMPOTENT_METHODS. Other calls fail with "Delivery
+    unknown", since Telegram may have delivered them anyway. Rows claimed by a process that died are picked up again after
+    `claim_timeout` seconds. `get_client(bot_id)` returns the
+    TelegramBotAPI to send with, or None if the bot no longer exists.
+
+    The buckets are per process, so with several worker processes the
+    rates should be divided between them.
+    """
+
+    def __init__(self, get_client, bot_rate=OUTBOX_BOT_RATE, chat_rate=OUTBOX_CHAT_RATE,
+                 group_rate=OUTBOX_GROUP_RATE, senders=OUTBOX_SENDERS, batch_size=OUTBOX_BATCH_SIZE,
+                 poll_interval=OUTBOX_POLL_INTERVAL, claim_timeout=OUTBOX_CLAIM_TIMEOUT,
+                 max_attempts=OUTBOX_MAX_ATTEMPTS):
+        self.get_client = get_client
+        self.bot_rate = bot_rate
+        self.chat_rate = chat_rate
+        self.group_rate = group_rate
+        self.senders = senders
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval
+        self.claim_timeout = claim_timeout
+        self.max_attempts = max_attempts
+        self._queue = []
+        self._in_flight = 0
+        self._bot_buckets = {}
+        self._chat_buckets = {}
+        self._paused = {}
+        self._sent_times = deque()
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._thread = None
+        self._executor = None
+        self._pid = None
+        self._stopping = False
+        self._last_purge = 0.0
+        self._stats = {'enqueued': 0, 'sent': 0, 'failed': 0, 'retried': 0, 'rate_limited': 0, 'unknown': 0}
+
+    def start(self):
+        with self._lock:
+            self._ensure_started()
+
+    def _ensure_started(self):
+        # Started lazily so each forked worker process gets its own dispatcher.
+        if self._thread is not None and self._pid == os.getpid() and self._thread.is_alive():
+            return
+        if self._pid != os.getpid():
+            self._queue = []
+            self._in_flight = 0
+            self._executor = None
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.senders, thread_name_prefix='outbox-sender')
+        self._pid = os.getpid()
+        self._stopping = False
+        self._thread = threading.Thread(target=self._run, name='outbox-dispatcher', daemon=True)
+        self._thread.start()
+
+    def enqueue(self, bot_id, chat_id, method, params, priority=PRIORITY_INTERACTIVE):
+        now = time.time()
+        # Claimed for this process straight away, so the dispatcher does not have to read it back.
+        with db_connection() as conn:
+            message_id = conn.execute('''INSERT INTO telegram_outbox
+                                         (bot_id, chat_id, method, params, priority, status, claimed_at)
+                                         VALUES (?, ?, ?, ?, ?, 'sending', ?) RETURNING id''',
+                                      (bot_id, chat_id, method, json.dumps(params), priority, now)).fetchone()['id']
+            conn.commit()
+        message = {'id': message_id, 'bot_id': bot_id, 'chat_id': chat_id, 'method': method, 'params': params,
+                   'priority': priority, 'attempts': 0, 'not_before': 0.0}
+        with self._lock:
+            self._ensure_started()
+            insort(self._queue, (priority, message_id, message))
+            self._stats['enqueued'] += 1
+        self._wakeup.set()
+        return message_id
+
+    def client(self, bot_id, priority=PRIORITY_INTERACTIVE):
+        """TelegramBotAPI-compatible client whose calls go through this scheduler"""
+        return QueuedTelegramBotAPI(self, bot_id, priority)
+
+    def _claim(self, now):
+        with self._lock:
+            queued = [(now, entry[1], now - self.claim_timeout / 2) for entry in self._queue]
+        with db_connection() as conn:
+            # Renew the claims on messages still waiting here, so they are not taken over as abandoned.
+            conn.executemany('UPDATE telegram_outbox SET claimed_at = ? WHERE id = ? AND claimed_at < ?', queued)
+            rows = conn.execute('''UPDATE telegram_outbox SET status = 'sending', claimed_at = ?
+                                   WHERE id IN (SELECT id FROM telegram_outbox
+                                                WHERE (status = 'pending' AND not_before <= ?)
+                                                   OR (status = 'sending' AND claimed_at < ?)
+                                                ORDER BY priority, id LIMIT ?)
+                                   RETURNING id, bot_id, chat_id, method, params, priority, attempts, not_before''',
+                                (now, now, now - self.claim_timeout,
+                                 max(0, self.batch_size - len(queued)))).fetchall()
+            conn.commit()
+        with self._lock:
+            queued = {entry[1] for entry in self._queue}
+            for row in rows:
+                # A message of ours can come back if its claim lapsed; it is already queued.
+                if row['id'] in queued:
+                    continue
+                message = dict(row)
+                message['params'] = json.loads(message['params'])
+                insort(self._queue, (message['priority'], message['id'], message))
+
+    def _purge(self):
+        with db_connection() as conn:
+            conn.execute('''DELETE FROM telegram_outbox
+                            WHERE finished_at IS NOT NULL AND finished_at < datetime('now', ?)''',
+                         (f'-{OUTBOX_RETENTION_HOURS} hours',))
+            conn.commit()
+
+    def _bot_bucket(self, bot_id, now):
+        bucket = self._bot_buckets.get(bot_id)
+        if bucket is None:
+            bucket = self._bot_buckets[bot_id] = TokenBucket(self.bot_rate, self.bot_rate, now)
+        return bucket
+
+    def _chat_bucket(self, bot_id, chat_id, now):
+        key = (bot_id, chat_id)
+        bucket = self._chat_buckets.get(key)
+        if bucket is None:
+            # Negative chat ids and '@username' ids are groups and channels.
+            group = not isinstance(chat_id, int) or chat_id < 0
+            bucket = self._chat_buckets[key] = TokenBucket(self.group_rate if group else self.chat_rate, 1, now)
+        return bucket
+
+    def _dispatch(self, now):
+        """Hand every message the limits allow to the senders; return seconds until the next one is due"""
+        ready = []
+        next_due = now + self.poll_interval
+        with self._lock:
+            waiting = []
+            blocked_chats = set()
+            for entry in self._queue:
+                message = entry[2]
+                bot_id, chat = message['bot_id'], (message['bot_id'], message['chat_id'])
+                if chat in blocked_chats or len(ready) + self._in_flight >= self.senders * 4:
+                    waiting.append(entry)
+                    continue
+                delay = max(message['not_before'], self._paused.get(bot_id, 0.0)) - now
+                if delay <= 0:
+                    bot_bucket = self._bot_bucket(bot_id, now)
+                    delay = bot_bucket.wait_time(now)
+                    chat_bucket = None
+                    if message['method'] not in UNMETERED_CHAT_METHODS:
+                        chat_bucket = self._chat_bucket(bot_id, message['chat_id'], now)
+                        delay = max(delay, chat_bucket.wait_time(now))
+                    if delay <= 0:
+                        bot_bucket.take()
+                        if chat_bucket is not None:
+                            chat_bucket.take()
+                        ready.append(message)
+                        continue
+                # Later messages to this chat wait behind this one.
+                blocked_chats.add(chat)
+                waiting.append(entry)
+                next_due = min(next_due, now + delay)
+            self._queue = waiting
+            self._in_flight += len(ready)
+
+        for message in ready:
+            self._executor.submit(self._send, message)
+        return max(0.0, next_due - now)
+
+    def reserve(self, bot_id, chat_id, max_wait=None):
+        """Book a message sent outside the queue against the same per-bot and per-chat limits.
+
+        Returns the seconds to wait before sending it. The tokens are taken
+        straight away, so queued messages wait behind it. With `max_wait`,
+        nothing is booked and None is returned if the wait would be longer.
+        """
+        now = time.time()
+        with self._lock:
+            bot_bucket = self._bot_bucket(bot_id, now)
+            chat_bucket = self._chat_bucket(bot_id, chat_id, now)
+            delay = max(bot_bucket.wait_time(now), chat_bucket.wait_time(now), self._paused.get(bot_id, 0.0) - now)
+            if max_wait is not None and delay > max_wait:
+                return None
+            bot_bucket.take()
+            chat_bucket.take()
+        return max(0.0, delay)
+
+    def _send(self, message):
+        try:
+            client = self.get_client(message['bot_id'])
+            if client is None:
+                result = {'ok': False, 'error_code': 404, 'description': 'Bot not found'}
+            else:
+                result = client.call(message['method'], message['params'])
+        except Exception as e:
+            result = {'ok': False, 'description': str(e)}
+        try:
+            self._record_result(message, result)
+        except Exception as e:
+            print(f"Outbox error: {e}")
+        finally:
+            with self._lock:
+                self._in_flight -= 1
+            self._wakeup.set()
+
+    def _record_result(self, message, result):
+        now = time.time()
+        if result.get('ok'):
+            self._finish(message['id'], 'sent', None)
+            with self._lock:
+                self._stats['sent'] += 1
+                self._sent_times.append(now)
+            return
+
+        error_code = result.get('error_code')
+        description = result.get('description', 'Unknown error')
+        if error_code == 429:
+            retry_after = (result.get('parameters') or {}).get('retry_after', 1)
+            with self._lock:
+                self._stats['rate_limited'] += 1
+                self._paused[message['bot_id']] = max(self._paused.get(message['bot_id'], 0.0), now + retry_after)
+            self._retry(message, now + retry_after, description)
+        elif (error_code is None or error_code >= 500) and message['method'] in IDEMPOTENT_METHODS \
+                and message['attempts'] + 1 < self.max_attempts:
+            message['attempts'] += 1
+            with self._lock:
+                self._stats['retried'] += 1
+            self._retry(message, now + min(60, 2 ** message['attempts']), description)
+        else:
+            if error_code is None or error_code >= 500:
+                # 4xx (blocked bot, unknown chat, bad markup) are routine and only recorded on the row.
+                print(f"Outbox send failed for bot {message['bot_id']}: {description}")
+                if message['method'] not in IDEMPOTENT_METHODS:
+                    # The message may still have been delivered; sending it again could duplicate it.
+                    description = f"Delivery unknown: {description}"
+                    with self._lock:
+                        self._stats['unknown'] += 1
+            self._finish(message['id'], 'failed', description)
+            with self._lock:
+                self._stats['failed'] += 1
+
+    def _retry(self, message, not_before, error):
+        message['not_before'] = not_before
+        # Keep the claim fresh until the retry is due so no other process takes it over.
+        with db_connection() as conn:
+            conn.execute('''UPDATE telegram_outbox SET attempts = ?, not_before = ?, claimed_at = ?, last_error = ?
+                            WHERE id = ?''',
+                         (message['attempts'], not_before, not_before, error, message['id']))
+            conn.commit()
+        with self._lock:
+            insort(self._queue, (message['priority'], message['id'], message))
+
+    def _finish(self, message_id, status, error):
+        with db_connection() as conn:
+            conn.execute('''UPDATE telegram_outbox SET status = ?, last_error = ?, finished_at = CURRENT_TIMESTAMP
+                            WHERE id = ?''', (status, error, message_id))
+            conn.commit()
+
+    def _run(self):
+        last_claim = 0.0
+        while not self._stopping:
+            now = time.time()
+            try:
+                if now - last_claim >= self.poll_interval:
+                    last_claim = now
+                    self._claim(now)
+                    if now - self._last_purge >= 3600:
+                        self._last_purge = now
+                        self._purge()
+                    self._forget_idle_buckets(now)
+                wait = self._dispatch(time.time())
+            except Exception as e:
+                print(f"Outbox error: {e}")
+                wait = self.poll_interval
+            self._wakeup.wait(wait)
+            self._wakeup.clear()
+
+    def _forget_idle_buckets(self, now):
+        with self._lock:
+            for buckets in (self._chat_buckets, self._bot_buckets):
+                for key in [key for key, bucket in buckets.items() if now - bucket.updated > 60]:
+                    del buckets[key]
+            for bot_id in [bot_id for bot_id, until in self._paused.items() if until < now]:
+                del self._paused[bot_id]
+            while self._sent_times and now - self._sent_times[0] > 60:
+                self._sent_times.popleft()
+
+    def stop(self, timeout=5.0):
+        """Stop dispatching and hand unsent messages back to the outbox for the next start"""
+        with self._lock:
+            self._stopping = True
+            thread, executor = self._thread, self._executor
+            own_process = self._pid == os.getpid()
+        self._wakeup.set()
+        if not own_process:
+            return
+        if thread is not None:
+            thread.join(timeout)
+        if executor is not None:
+            executor.shutdown(wait=True)
+        with self._lock:
+            self._executor = None
+            unsent, self._queue = [entry[2]['id'] for entry in self._queue], []
+        if unsent:
+            with db_connection() as conn:
+                conn.executemany("UPDATE telegram_outbox SET status = 'pending' WHERE id = ? AND status = 'sending'",
+                                 [(message_id,) for message_id in unsent])
+                conn.commit()
+
+    def stats(self):
+        now = time.time()
+        with self._lock:
+            stats = dict(self._stats)
+            stats['queued'] = len(self._queue)
+            stats['in_flight'] = self._in_flight
+            stats['paused_bots'] = sum(1 for until in self._paused.values() if until > now)
+            stats['sent_last_minute'] = sum(1 for sent_at in self._sent_times if now - sent_at <= 60)
+        with db_connection() as conn:
+            stats['outbox_pending'] = conn.execute(
+                "SELECT COUNT(*) FROM telegram_outbox WHERE status IN ('pending', 'sending')").fetchone()[0]
+        return stats
+
+class QueuedTelegramBotAPI(TelegramBotAPI):
+    """TelegramBotAPI whose calls are queued on an OutboundScheduler instead of sent inline"""
+
+    def __init__(self, scheduler, bot_id, priority=PRIORITY_INTERACTIVE):
+        self.scheduler = scheduler
+        self.bot_id = bot_id
+        self.priority = priority
+
+    def call(self, method, params=None, timeout=None):
+        params = params or {}
+        try:
+            message_id = self.scheduler.enqueue(self.bot_id, params.get('chat_id', 0), method, params, self.priority)
+        except Exception as e:
+            return {'ok': False, 'description': str(e)}
+        return {'ok': True, 'result': {'outbox_id': message_id}}
@@ -0,0 +1,175 @@
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from utils.database import get_bot_ids, get_update_offset, save_update_offset, update_bot_webhook
+
+# 'webhook' (default) or 'polling'; see UpdatePoller
+TELEGRAM_UPDATE_MODE = os.getenv('TELEGRAM_UPDATE_MODE', 'webhook')
+POLLING_WORKERS = int(os.getenv('POLLING_WORKERS', 16))
+POLLING_TIMEOUT = int(os.getenv('POLLING_TIMEOUT', 25))
+POLLING_SHORT_INTERVAL = float(os.getenv('POLLING_SHORT_INTERVAL', 2))
+POLLING_BATCH_SIZE = int(os.getenv('POLLING_BATCH_SIZE', 100))
+POLLING_REFRESH_INTERVAL = float(os.getenv('POLLING_REFRESH_INTERVAL', 30))
+
+class UpdatePoller:
+    """Fetches updates for many bots with getUpdates long-polls.
+
+    An alternative to webhooks for deployments without a public HTTPS
+    address. Polls run on a pool of `workers` threads. While every bot has
+    a thread of its own, each holds a getUpdates long-poll of `timeout`
+    seconds. With more bots than workers a long-poll would keep the other
+    bots waiting for its whole timeout, so every bot is short-polled
+    instead: getUpdates returns at once and is repeated every
+    `short_interval` seconds, or right away while full batches keep
+    coming. Each update is passed to
+    `submit(bot_id, update)`, which returns False when it cannot take more
+    right now; the offset then stays on that update so it is fetched again.
+    Offsets are stored in `bot_update_offsets` after every batch, so a
+    restart continues where the last run stopped. The set of bots is
+    re-read every `refresh_interval` seconds. `get_client(bot_id)` returns
+    the TelegramBotAPI to poll with, or None if the bot no longer exists.
+
+    Telegram allows one getUpdates consumer per bot, so run a single
+    poller across all processes.
+    """
+
+    def __init__(self, get_client, submit, workers=POLLING_WORKERS, timeout=POLLING_TIMEOUT,
+                 batch_size=POLLING_BATCH_SIZE, refresh_interval=POLLING_REFRESH_INTERVAL, get_bots=get_bot_ids,
+                 short_interval=POLLING_SHORT_INTERVAL):
+        self.get_client = get_client
+        self.submit = submit
+        self.workers = workers
+        self.timeout = timeout
+        self.short_interval = short_interval
+        self.batch_size = batch_size
+        self.refresh_interval = refresh_interval
+        self.get_bots = get_bots
+        self._bot_ids = []
+        self._offsets = {}
+        self._active = set()
+        self._retry_at = {}
+        self._failures = {}
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._thread = None
+        self._executor = None
+        self._pid = None
+        self._stopping = False
+        self._started_at = None
+        self._stats = {'polls': 0, 'updates': 0, 'deferred': 0, 'errors': 0, 'webhooks_removed': 0}
+
+    def start(self):
+        with self._lock:
+            if self._thread is not None and self._pid == os.getpid() and self._thread.is_alive():
+                return
+            self._pid = os.getpid()
+            self._stopping = False
+            self._started_at = time.monotonic()
+            self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='update-poller')
+            self._thread = threading.Thread(target=self._run, name='update-poller', daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        last_refresh = None
+        while not self._stopping:
+            now = time.monotonic()
+            try:
+                if last_refresh is None or now - last_refresh >= self.refresh_interval:
+                    last_refresh = now
+                    self._bot_ids = self.get_bots()
+                with self._lock:
+                    due = [bot_id for bot_id in self._bot_ids
+                           if bot_id not in self._active and self._retry_at.get(bot_id, 0) <= now]
+                    self._active.update(due)
+                for bot_id in due:
+                    self._executor.submit(self._poll, bot_id)
+            except Exception as e:
+                print(f"Update polling error: {e}")
+            self._wakeup.wait(1.0)
+            self._wakeup.clear()
+
+    def _poll(self, bot_id):
+        try:
+            self._poll_once(bot_id)
+        except Exception as e:
+            print(f"Update polling error for bot {bot_id}: {e}")
+            self._back_off(bot_id)
+        finally:
+            with self._lock:
+                self._active.discard(bot_id)
+            self._wakeup.set()
+
+    def _poll_once(self, bot_id):
+        client = self.get_client(bot_id)
+        if client is None:
+            return
+        if bot_id not in self._offsets:
+            self._offsets[bot_id] = get_update_offset(bot_id)
+
+        long_poll = self._long_polling()
+        result = client.get_updates(self._offsets[bot_id], self.timeout if long_poll else 0, self.batch_size, ['message'])
+        with self._lock:
+            self._stats['polls'] += 1
+        if not result.get('ok'):
+            if result.get('error_code') == 409:
+                # A webhook is still set for this bot; polling replaces it.
+                client.delete_webhook()
+                update_bot_webhook(bot_id, None)
+                with self._lock:
+                    self._stats['webhooks_removed'] += 1
+                return
+            print(f"getUpdates failed for bot {bot_id}: {result.get('description')}")
+            self._back_off(bot_id, (result.get('parameters') or {}).get('retry_after'))
+            return
+
+        updates = result.get('result', [])
+        next_offset = self._offsets[bot_id]
+        accepted = 0
+        for update in updates:
+            if not self.submit(bot_id, update):
+                # Picked up again by the next poll.
+                self._back_off(bot_id, 1)
+                break
+            next_offset = update['update_id'] + 1
+            accepted += 1
+
+        with self._lock:
+            self._failures.pop(bot_id, None)
+            self._stats['updates'] += accepted
+            self._stats['deferred'] += len(updates) - accepted
+            if not long_poll and len(updates) < self.batch_size:
+                retry_at = time.monotonic() + self.short_interval
+                self._retry_at[bot_id] = max(self._retry_at.get(bot_id, 0), retry_at)
+        if next_offset != self._offsets[bot_id]:
+            save_update_offset(bot_id, next_offset)
+            self._offsets[bot_id] = next_offset
+
+    def _long_polling(self):
+        return len(self._bot_ids) <= self.workers
+
+    def _back_off(self, bot_id, delay=None):
+        with self._lock:
+            self._stats['errors'] += delay is None
+            failures = self._failures[bot_id] = self._failures.get(bot_id, 0) + 1
+            self._retry_at[bot_id] = time.monotonic() + (delay if delay is not None else min(60, 2 ** failures))
+
+    def stop(self, timeout=5.0):
+        self._stopping = True
+        self._wakeup.set()
+        if self._thread is not None and self._pid == os.getpid():
+            self._thread.join(timeout)
+            # Polls in progress end on their own within the long-poll timeout.
+            self._executor.shutdown(wait=False, cancel_futures=True)
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats['bots'] = len(self._bot_ids)
+            stats['active_polls'] = len(self._active)
+            stats['long_polling'] = self._long_polling()
+        elapsed = time.monotonic() - self._started_at if self._started_at else 0
+        stats['updates_per_second'] = stats['updates'] / elapsed if elapsed else 0.0
+        stats['mode'] = TELEGRAM_UPDATE_MODE
+        return stats
@@ -0,0 +1,223 @@
+import os
+import shlex
+import threading
+import time
+from collections import OrderedDict
+
+PROGRESS_CACHE_SIZE = int(os.getenv('PROGRESS_CACHE_SIZE', 10000))
+PROGRESS_FLUSH_INTERVAL = float(os.getenv('PROGRESS_FLUSH_INTERVAL', 2.0))
+
+def worker_processes():
+    """Worker processes serving the app, as far as WEB_CONCURRENCY or GUNICORN_CMD_ARGS tell"""
+    workers = os.getenv('WEB_CONCURRENCY')
+    args = shlex.split(os.getenv('GUNICORN_CMD_ARGS', ''))
+    for i, arg in enumerate(args):
+        if arg in ('-w', '--workers') and i + 1 < len(args):
+            workers = args[i + 1]
+        elif arg.startswith('--workers='):
+            workers = arg.split('=', 1)[1]
+    try:
+        return max(int(workers or 1), 1)
+    except ValueError:
+        return 1
+
+# Energy is written back as an absolute value, so with several worker processes each one would
+# spend its own copy and the last flush would win. The cache only runs in single-process setups.
+if PROGRESS_CACHE_SIZE and worker_processes() > 1:
+    print(f"Progress cache disabled: {worker_processes()} worker processes share the database")
+    PROGRESS_CACHE_SIZE = 0
+
+# Written back as they are; coin_balance and total_taps are written as deltas.
+ABSOLUTE_FIELDS = ('energy', 'energy_updated_at', 'last_tap_at', 'tap_tokens', 'tap_tokens_at')
+
+class ProgressCache:
+    """Bounded LRU of hot user_progress records with write-back flushing.
+
+    Records are keyed by (bot_id, telegram_user_id). Mutations happen in
+    memory; coin and tap changes are tracked as deltas (so a flush adds to
+    whatever is in the database) and energy is written as an absolute value.
+    Dirty records reach the database at most `flush_interval` seconds later,
+    or immediately when they are evicted. A `max_entries` of 0 disables the
+    cache. Only safe with a single worker process: another process writing
+    the same rows would have its energy overwritten by the next flush.
+    """
+
+    def __init__(self, load, write_batch, max_entries=PROGRESS_CACHE_SIZE,
+                 flush_interval=PROGRESS_FLUSH_INTERVAL):
+        self.load = load
+        self.write_batch = write_batch
+        self.max_entries = max_entries
+        self.flush_interval = flush_interval
+        self._records = OrderedDict()
+        self._retry = []
+        self._lock = threading.Lock()
+        self._write_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._thread = None
+        self._pid = None
+        self._stopping = False
+        self._stats = {'hits': 0, 'misses': 0, 'evictions': 0, 'flushes': 0, 'flushed_records': 0,
+                       'failed_flushes': 0, 'last_flush_time': 0.0, 'max_flush_time': 0.0}
+
+    @property
+    def enabled(self):
+        return self.max_entries > 0
+
+    def _ensure_started(self):
+        if self._thread is not None and self._pid == os.getpid() and self._thread.is_alive():
+            return
+        self._pid = os.getpid()
+        self._stopping = False
+        self._thread = threading.Thread(target=self._run, name='progress-flusher', daemon=True)
+        self._thread.start()
+
+    def _get_record(self, key):
+        """Return the live record for `key`, loading it on a miss. Caller must hold no lock."""
+        with self._lock:
+            self._ensure_started()
+            record = self._records.get(key)
+            if record is not None:
+                self._records.move_to_end(key)
+                self._stats['hits'] += 1
+                return record, []
+
+        loaded = dict(self.load(*key))
+        loaded.update({'coin_delta': 0, 'taps_delta': 0, 'dirty': False})
+        for field in ABSOLUTE_FIELDS:
+            loaded.setdefault(field, None)
+
+        evicted = []
+        with self._lock:
+            record = self._records.get(key)
+            if record is not None:
+                self._stats['hits'] += 1
+                return record, []
+            self._stats['misses'] += 1
+            self._records[key] = loaded
+            while len(self._records) > self.max_entries:
+                old_key, old_record = self._records.popitem(last=False)
+                self._stats['evictions'] += 1
+                if old_record['dirty']:
+                    evicted.append(self._take_changes(old_key, old_record))
+        return loaded, evicted
+
+    def _take_changes(self, key, record):
+        changes = (key, record['coin_delta'], record['taps_delta'], *(record[field] for field in ABSOLUTE_FIELDS))
+        record['coin_delta'] = 0
+        record['taps_delta'] = 0
+        record['dirty'] = False
+        return changes
+
+    def _with_record(self, key, fn):
+        while True:
+            record, evicted = self._get_record(key)
+            if evicted:
+                self._write(evicted)
+            with self._lock:
+                # The record may have been evicted between loading it and taking the lock.
+                if self._records.get(key) is record:
+                    return fn(record)
+
+    def read(self, bot_id, telegram_user_id):
+        return self._with_record((bot_id, telegram_user_id), lambda record: {
+            k: v for k, v in record.items() if k not in ('coin_delta', 'taps_delta', 'dirty')
+        })
+
+    def balance(self, bot_id, telegram_user_id):
+        """Cached coin_balance of one user, or None if the record is not cached"""
+        with self._lock:
+            record = self._records.get((bot_id, telegram_user_id))
+            return record['coin_balance'] if record is not None else None
+
+    def balances(self, bot_id):
+        """{telegram_user_id: coin_balance} of the bot's cached records, flushed or not"""
+        with self._lock:
+            return {key[1]: record['coin_balance'] for key, record in self._records.items() if key[0] == bot_id}
+
+    def mutate(self, bot_id, telegram_user_id, fn):
+        """Run `fn(record)` under the cache lock and return its result.
+
+        `fn` may change coin_balance/total_taps (the deltas are tracked
+        automatically) and the ABSOLUTE_FIELDS.
+        """
+        def state(record):
+            return (record['coin_balance'], record['total_taps'], *(record[field] for field in ABSOLUTE_FIELDS))
+
+        def apply(record):
+            coin_balance, total_taps = record['coin_balance'], record['total_taps']
+            before = state(record)
+            result = fn(record)
+            if before != state(record):
+                record['coin_delta'] += record['coin_balance'] - coin_balance
+                record['taps_delta'] += record['total_taps'] - total_taps
+                record['dirty'] = True
+            return result
+
+        return self._with_record((bot_id, telegram_user_id), apply)
+
+    def evict(self, bot_id, telegram_user_id):
+        """Write back and drop one record, e.g. before the database row is changed directly"""
+        with self._lock:
+            record = self._records.pop((bot_id, telegram_user_id), None)
+            changes = self._take_changes((bot_id, telegram_user_id), record) if record and record['dirty'] else None
+        if changes:
+            self._write([changes])
+
+    def _write(self, changes):
+        started = time.perf_counter()
+        try:
+            with self._write_lock:
+                self.write_batch(changes)
+        except Exception as e:
+            print(f"Progress flush error: {e}")
+            with self._lock:
+                self._stats['failed_flushes'] += 1
+                for change in changes:
+                    record = self._records.get(change[0])
+                    if record is None:
+                        # Evicted in the meantime; retry the change on the next flush.
+                        self._retry.append(change)
+                        continue
+                    record['coin_delta'] += change[1]
+                    record['taps_delta'] += change[2]
+                    record['dirty'] = True
+            return
+        elapsed = time.perf_counter() - started
+        with self._lock:
+            self._stats['flushes'] += 1
+            self._stats['flushed_records'] += len(changes)
+            self._stats['last_flush_time'] = elapsed
+            self._stats['max_flush_time'] = max(self._stats['max_flush_time'], elapsed)
+
+    def flush(self):
+        with self._lock:
+            changes, self._retry = self._retry, []
+            changes += [self._take_changes(key, record) for key, record in self._records.items() if record['dirty']]
+        if changes:
+            self._write(changes)
+
+    def _run(self):
+        while not self._stopping:
+            self._wakeup.wait(self.flush_interval)
+            self.flush()
+
+    def stop(self):
+        self._stopping = True
+        self._wakeup.set()
+        self.flush()
+
+    def clear(self):
+        self.flush()
+        with self._lock:
+            self._records.clear()
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats['entries'] = len(self._records)
+            stats['dirty_entries'] = sum(1 for record in self._records.values() if record['dirty']) + len(self._retry)
+        lookups = stats['hits'] + stats['misses']
+        stats['hit_ratio'] = stats['hits'] / lookups if lookups else 0.0
+        stats['max_entries'] = self.max_entries
+        stats['flush_interval'] = self.flush_interval
+        return stats
@@ -1,57 +1,147 @@
+import asyncio
+import hashlib
+import hmac
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from urllib.parse import parse_qsl
 
 import requests
-import json
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+TELEGRAM_POOL_SIZE = int(os.getenv('TELEGRAM_POOL_SIZE', 32))
+TELEGRAM_TIMEOUT = float(os.getenv('TELEGRAM_TIMEOUT', 10))
+TELEGRAM_CONNECT_TIMEOUT = float(os.getenv('TELEGRAM_CONNECT_TIMEOUT', 5))
+TELEGRAM_RETRIES = int(os.getenv('TELEGRAM_RETRIES', 3))
+TELEGRAM_BACKOFF = float(os.getenv('TELEGRAM_BACKOFF', 0.5))
+TELEGRAM_CLIENT_CACHE_SIZE = int(os.getenv('TELEGRAM_CLIENT_CACHE_SIZE', 1024))
+WEBAPP_INIT_DATA_MAX_AGE = int(os.getenv('WEBAPP_INIT_DATA_MAX_AGE', 86400))
+
+_session = None
+_session_pid = None
+_session_lock = threading.Lock()
+_stats = {'requests': 0, 'failures': 0, 'total_time': 0.0, 'max_time': 0.0}
+
+def get_session():
+    """Keep-alive HTTP session shared by every bot in this process.
+
+    Connections to api.telegram.org are pooled (up to TELEGRAM_POOL_SIZE)
+    and reused across requests. Failed connects are retried with
+    exponential backoff, as nothing reached Telegram; 502/503/504 responses
+    only for GET. Bot API calls are POSTs such as sendMessage that a proxy
+    may have passed on before failing, so retrying them could send twice.
+    """
+    global _session, _session_pid
+    with _session_lock:
+        # Created per process so forked workers do not share sockets.
+        if _session is None or _session_pid != os.getpid():
+            retry = Retry(total=TELEGRAM_RETRIES, connect=TELEGRAM_RETRIES, read=0, status=TELEGRAM_RETRIES,
+                          status_forcelist=(502, 503, 504), allowed_methods=frozenset({'GET'}),
+                          backoff_factor=TELEGRAM_BACKOFF, raise_on_status=False)
+            adapter = HTTPAdapter(pool_connections=4, pool_maxsize=TELEGRAM_POOL_SIZE, max_retries=retry)
+            session = requests.Session()
+            session.mount('https://', adapter)
+            _session, _session_pid = session, os.getpid()
+        return _session
+
+def _request(method, url, timeout=TELEGRAM_TIMEOUT, **kwargs):
+    started = time.perf_counter()
+    failed = True
+    try:
+        response = get_session().request(method, url, timeout=(TELEGRAM_CONNECT_TIMEOUT, timeout), **kwargs)
+        data = response.json()
+        failed = not data.get('ok')
+        return data
+    finally:
+        elapsed = time.perf_counter() - started
+        with _session_lock:
+            _stats['requests'] += 1
+            _stats['failures'] += failed
+            _stats['total_time'] += elapsed
+            _stats['max_time'] = max(_stats['max_time'], elapsed)
+
+def get_telegram_stats():
+    with _session_lock:
+        stats = dict(_stats)
+    stats['avg_time'] = stats['total_time'] / stats['requests'] if stats['requests'] else 0.0
+    stats['pool_size'] = TELEGRAM_POOL_SIZE
+    stats['clients'] = len(_clients)
+    return stats
 
 class TelegramBotAPI:
     def __init__(self, bot_token):
         self.bot_token = bot_token
         self.base_url = f"https://api.telegram.org/bot{bot_token}"
-    
-    def set_webhook(self, webhook_url):
-        """Set webhook for the bot"""
-        url = f"{self.base_url}/setWebhook"
-        params = {'url': webhook_url}
+
+    def call(self, method, params=None, timeout=TELEGRAM_TIMEOUT):
+        """Call a Bot API method; errors are returned as {'ok': False, 'description': ...}"""
         try:
-            response = requests.post(url, json=params, timeout=10)
-            return response.json()
+            return _request('POST', f"{self.base_url}/{method}", timeout=timeout, json=params or {})
         except Exception as e:
             return {'ok': False, 'description': str(e)}
-    
-    def send_message(self, chat_id, text, reply_markup=None):
+
+    def get_updates(self, offset=None, timeout=25, limit=100, allowed_updates=None):
+        """Long-poll for new updates (only works while no webhook is set)"""
+        params = {'timeout': timeout, 'limit': limit}
+        if offset is not None:
+            params['offset'] = offset
+        if allowed_updates is not None:
+            params['allowed_updates'] = allowed_updates
+        # The HTTP read has to outlast the long-poll itself.
+        return self.call('getUpdates', params, timeout=timeout + TELEGRAM_TIMEOUT)
+
+    def delete_webhook(self):
+        """Remove the webhook so updates can be fetched with getUpdates"""
+        return self.call('deleteWebhook')
+
+    def set_webhook(self, webhook_url):
+        """Set webhook for the bot"""
+        return self.call('setWebhook', {'url': webhook_url})
+
+    def send_message(self, chat_id, text, reply_markup=None, parse_mode='HTML'):
         """Send a text message"""
-        url = f"{self.base_url}/sendMessage"
         params = {
             'chat_id': chat_id,
-            'text': text,
-            'parse_mode': 'HTML'
+            'text': text
         }
+        if parse_mode:
+            params['parse_mode'] = parse_mode
         if reply_markup:
             params['reply_markup'] = reply_markup
-        try:
-            response = requests.post(url, json=params, timeout=10)
-            return response.json()
-        except Exception as e:
-            return {'ok': False, 'description': str(e)}
-    
+        return self.call('sendMessage', params)
+
+    def edit_message_text(self, chat_id, message_id, text, parse_mode=None):
+        """Replace the text of a message the bot sent"""
+        params = {
+            'chat_id': chat_id,
+            'message_id': message_id,
+            'text': text
+        }
+        if parse_mode:
+            params['parse_mode'] = parse_mode
+        return self.call('editMessageText', params)
+
+    def send_chat_action(self, chat_id, action='typing'):
+        """Show a status such as 'typing...' in the chat for a few seconds"""
+        return self.call('sendChatAction', {'chat_id': chat_id, 'action': action})
+
     def send_photo(self, chat_id, photo_url, caption=None):
         """Send a photo message"""
-        url = f"{self.base_url}/sendPhoto"
         params = {
             'chat_id': chat_id,
             'photo': photo_url
         }
         if caption:
             params['caption'] = caption
-        try:
-            response = requests.post(url, json=params, timeout=10)
-            return response.json()
-        except Exception as e:
-            return {'ok': False, 'description': str(e)}
-    
+        return self.call('sendPhoto', params)
+
     def create_inline_keyboard(self, buttons):
         """Create inline keyboard markup"""
         return json.dumps({'inline_keyboard': buttons})
-    
+
     def create_web_app_keyboard(self, button_text, web_app_url):
         """Create web app keyboard"""
         return json.dumps({
@@ -61,14 +151,84 @@ class TelegramBotAPI:
             }]]
         })
 
+class AsyncTelegramBotAPI:
+    """asyncio front end for TelegramBotAPI.
+
+    Each call runs on a worker thread over the shared pooled session, with at
+    most `concurrency` requests in flight, so a coroutine can fan out many
+    sends with `asyncio.gather` without opening extra connections.
+    """
+
+    def __init__(self, bot_token, concurrency=TELEGRAM_POOL_SIZE):
+        self.api = get_telegram_client(bot_token)
+        self.concurrency = concurrency
+        self._semaphore = None
+
+    async def call(self, method, params=None):
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.concurrency)
+        async with self._semaphore:
+            return await asyncio.to_thread(self.api.call, method, params)
+
+    async def send_message(self, chat_id, text, reply_markup=None):
+        params = {'chat_id': chat_id, 'text': text, 'parse_mode': 'HTML'}
+        if reply_markup:
+            params['reply_markup'] = reply_markup
+        return await self.call('sendMessage', params)
+
+    async def send_photo(self, chat_id, photo_url, caption=None):
+        params = {'chat_id': chat_id, 'photo': photo_url}
+        if caption:
+            params['caption'] = caption
+        return await self.call('sendPhoto', params)
+
+_clients = OrderedDict()
+_clients_lock = threading.Lock()
+
+def get_telegram_client(bot_token):
+    """Shared TelegramBotAPI for a token, kept in a small LRU registry"""
+    with _clients_lock:
+        client = _clients.get(bot_token)
+        if client is not None:
+            _clients.move_to_end(bot_token)
+            return client
+        client = _clients[bot_token] = TelegramBotAPI(bot_token)
+        while len(_clients) > TELEGRAM_CLIENT_CACHE_SIZE:
+            _clients.popitem(last=False)
+        return client
+
 def validate_bot_token(bot_token):
     """Validate bot token by calling getMe endpoint"""
     url = f"https://api.telegram.org/bot{bot_token}/getMe"
     try:
-        response = requests.get(url, timeout=10)
-        data = response.json()
+        data = _request('GET', url)
         if data.get('ok'):
             return data.get('result')
         return None
     except Exception:
         return None
+
+def verify_webapp_init_data(init_data, bot_token, max_age=WEBAPP_INIT_DATA_MAX_AGE):
+    """Telegram user id from a Mini App's `Telegram.WebApp.initData`, or None unless the bot signed it.
+
+    The hash is checked as Telegram documents it: HMAC-SHA256 of the sorted
+    fields under a key derived from the bot token. Data older than
+    `max_age` seconds is refused too.
+    """
+    if not init_data or not bot_token:
+        return None
+    fields = dict(parse_qsl(init_data, keep_blank_values=True))
+    received = fields.pop('hash', '')
+    data_check = '\n'.join(f'{key}={value}' for key, value in sorted(fields.items()))
+    secret = hmac.new(b'WebAppData', bot_token.encode(), hashlib.sha256).digest()
+    expected = hmac.new(secret, data_check.encode(), hashlib.sha256).hexdigest()
+    if not hmac.compare_digest(expected, received):
+        return None
+    try:
+        auth_date = int(fields.get('auth_date', 0))
+        user_id = int(json.loads(fields['user'])['id'])
+    except (KeyError, TypeError, ValueError):
+        return None
+    if max_age and time.time() - auth_date > max_age:
+        return None
+    return user_id
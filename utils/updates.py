@@ -0,0 +1,133 @@
+import os
+import threading
+import time
+from collections import deque
+
+WEBHOOK_WORKERS = int(os.getenv('WEBHOOK_WORKERS', 8))
+WEBHOOK_MAX_PENDING = int(os.getenv('WEBHOOK_MAX_PENDING', 5000))
+
+class UpdateDispatcher:
+    """Worker pool for Telegram updates with per-chat ordering.
+
+    `submit(key, update)` queues an update and returns immediately; a pool
+    of `workers` threads hands each one to `handle(update)`. Updates that
+    share a key (normally the bot and chat) are processed one at a time in
+    arrival order, while different keys run in parallel, so one slow chat
+    does not hold up the others. At most `max_pending` updates are queued;
+    beyond that `submit` returns False. With `workers` set to 0 updates are
+    handled inline by the caller.
+    """
+
+    def __init__(self, handle, workers=WEBHOOK_WORKERS, max_pending=WEBHOOK_MAX_PENDING):
+        self.handle = handle
+        self.workers = workers
+        self.max_pending = max_pending
+        self._chats = {}
+        self._ready = deque()
+        self._pending = 0
+        self._busy = 0
+        self._lock = threading.Lock()
+        self._has_work = threading.Condition(self._lock)
+        self._threads = []
+        self._pid = None
+        self._stopping = False
+        self._stats = {'submitted': 0, 'processed': 0, 'failed': 0, 'rejected': 0,
+                       'total_wait_time': 0.0, 'max_wait_time': 0.0,
+                       'total_handle_time': 0.0, 'max_handle_time': 0.0}
+
+    def _ensure_started(self):
+        # Started lazily so each forked worker process gets its own pool.
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            self._threads = []
+        self._stopping = False
+        self._threads = [thread for thread in self._threads if thread.is_alive()]
+        while len(self._threads) < self.workers:
+            thread = threading.Thread(target=self._run, name=f'update-worker-{len(self._threads)}', daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def submit(self, key, update):
+        if self.workers <= 0:
+            with self._lock:
+                self._stats['submitted'] += 1
+            self._process(update, time.monotonic())
+            return True
+
+        with self._lock:
+            if self._pending >= self.max_pending:
+                self._stats['rejected'] += 1
+                return False
+            self._ensure_started()
+            queue = self._chats.get(key)
+            if queue is None:
+                # The chat is idle: schedule it. Otherwise the worker that owns it picks this up next.
+                queue = self._chats[key] = deque()
+                self._ready.append(key)
+                self._has_work.notify()
+            queue.append((update, time.monotonic()))
+            self._pending += 1
+            self._stats['submitted'] += 1
+        return True
+
+    def _process(self, update, queued_at):
+        started = time.monotonic()
+        try:
+            self.handle(update)
+            failed = False
+        except Exception as e:
+            print(f"Update handling error: {e}")
+            failed = True
+        finished = time.monotonic()
+        with self._lock:
+            self._stats['failed' if failed else 'processed'] += 1
+            self._stats['total_wait_time'] += started - queued_at
+            self._stats['max_wait_time'] = max(self._stats['max_wait_time'], started - queued_at)
+            self._stats['total_handle_time'] += finished - started
+            self._stats['max_handle_time'] = max(self._stats['max_handle_time'], finished - started)
+
+    def _run(self):
+        while True:
+            with self._lock:
+                while not self._ready and not self._stopping:
+                    self._has_work.wait()
+                if not self._ready:
+                    return
+                key = self._ready.popleft()
+                update, queued_at = self._chats[key].popleft()
+                self._busy += 1
+
+            self._process(update, queued_at)
+
+            with self._lock:
+                self._busy -= 1
+                self._pending -= 1
+                if self._chats[key]:
+                    # Go to the back of the line so busy chats take turns with the rest.
+                    self._ready.append(key)
+                    self._has_work.notify()
+                else:
+                    del self._chats[key]
+
+    def stop(self, timeout=10.0):
+        """Finish the queued updates, waiting up to `timeout` seconds"""
+        with self._lock:
+            self._stopping = True
+            self._has_work.notify_all()
+            threads = list(self._threads) if self._pid == os.getpid() else []
+        deadline = time.monotonic() + timeout
+        for thread in threads:
+            thread.join(max(0.0, deadline - time.monotonic()))
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats['queued'] = self._pending - self._busy
+            stats['in_progress'] = self._busy
+            stats['active_chats'] = len(self._chats)
+        done = stats['processed'] + stats['failed']
+        stats['avg_wait_time'] = stats['total_wait_time'] / done if done else 0.0
+        stats['avg_handle_time'] = stats['total_handle_time'] / done if done else 0.0
+        stats['workers'] = self.workers
+        stats['max_pending'] = self.max_pending
+        return stats